@@ -1,14 +1,16 @@
 """ Scripts processing pcap files and generating text output and figures """
 
 import argparse
+import csv
 import os
 import re
 import sys
-from multiprocessing import Process
+import tempfile
+from multiprocessing import Process, Queue
 import gc
+import itertools
 import time
-
-import pyshark
+import zlib
 
 #from trafficAnalyzer import *  #Import statement below, after package files are checked
 
@@ -36,7 +38,10 @@ DEV = TRAFFIC_ANA_DIR + "/Device.py"
 DNS_TRACK = TRAFFIC_ANA_DIR + "/DNSTracker.py"
 INIT = TRAFFIC_ANA_DIR + "/__init__.py"
 IP = TRAFFIC_ANA_DIR + "/IP.py"
+JOURNAL = TRAFFIC_ANA_DIR + "/Journal.py"
+MANIFEST = TRAFFIC_ANA_DIR + "/Manifest.py"
 NODE = TRAFFIC_ANA_DIR + "/Node.py"
+PCAP_READER = TRAFFIC_ANA_DIR + "/PcapReader.py"
 STAT = TRAFFIC_ANA_DIR + "/Stats.py"
 UTIL = TRAFFIC_ANA_DIR + "/Utils.py"
 GEO_DIR = DEST_DIR + "/geoipdb"
@@ -45,8 +50,10 @@ GEO_DB_COUNTRY = GEO_DIR + "/GeoLite2-Country.mmdb"
 AUX_DIR = DEST_DIR + "/aux"
 IP_TO_ORG = AUX_DIR + "/ipToOrg.csv"
 IP_TO_COUNTRY = AUX_DIR + "/ipToCountry.csv"
+HOST_CACHE = DEST_DIR + "/cache/hosts.sqlite"
+RIPE_DB = DEST_DIR + "/cache/ripe.sqlite"
 
-SCRIPTS = [CONSTS, DATA_PRES, DEV, DNS_TRACK, INIT, IP, NODE, STAT, UTIL]
+SCRIPTS = [CONSTS, DATA_PRES, DEV, DNS_TRACK, INIT, IP, JOURNAL, MANIFEST, NODE, PCAP_READER, STAT, UTIL]
 
 RED = "\033[31;1m"
 END = "\033[0m"
@@ -90,6 +97,11 @@ from trafficAnalyzer import Constants as c
 args = [] #Main args
 plots = [] #Graph args
 devices = None
+aux_map = None #Org and country tables, loaded once before the processes are started
+shared_hosts = None #Hosts file given with -s, if it is a single file
+result_queue = None #Rows sent by the processes to the process writing the output file
+timing = None #Stage timings, written with --timing
+journal = None #Commits of the rows in the output file, and the files that failed
 
 
 #isError is either 0 or 1
@@ -141,7 +153,7 @@ def check_files(direc, files, is_geo, description=""):
 
 
 def main():
-    global args, plots, devices
+    global args, plots, devices, aux_map, shared_hosts, result_queue, timing, journal
 
     start_time = time.time()
 
@@ -174,12 +186,33 @@ def main():
     parser.add_argument("-l", dest="ip_locs", default="")
     parser.add_argument("-r", dest="ip_attrs", default="")
     parser.add_argument("-h", dest="help", action="store_true", default=False)
+    parser.add_argument("--tshark-hosts", dest="tshark_hosts", action="store_true", default=False)
+    parser.add_argument("--reanalyze", dest="reanalyze", action="store_true", default=False)
+    parser.add_argument("--host-cache", dest="host_cache", default=HOST_CACHE)
+    parser.add_argument("--ripe-db", dest="ripe_db", default=RIPE_DB)
+    parser.add_argument("--prefix-table", dest="prefix_table", default="")
+    parser.add_argument("--all-devices", dest="all_devices", action="store_true", default=False)
+    parser.add_argument("--jobs", dest="jobs", default="")
+    parser.add_argument("--stream", dest="stream", action="store_true", default=False)
+    parser.add_argument("--window", dest="window", default="0")
+    parser.add_argument("--no-downsample", dest="no_downsample", action="store_true", default=False)
+    parser.add_argument("--timing", dest="timing", default="")
+    parser.add_argument("--timing-prom", dest="timing_prom", default="")
+    parser.add_argument("--shard", dest="shard", default="")
+    parser.add_argument("--shard-plan", dest="shard_plan", default="")
+    parser.add_argument("--merge-shards", dest="merge_shards", default="")
+    parser.add_argument("--overwrite", dest="overwrite", action="store_true", default=False)
 
     #Parse Arguments
     args = parser.parse_args()
 
     if args.help:
         print_usage(0)
+
+    #--merge-shards only merges the output files of the shards of OUT_CSV
+    if args.merge_shards != "":
+        merge_shards()
+        return
    
     #Parse plot options
     if args.plots is not None:
@@ -200,17 +233,19 @@ def main():
             print(c.PIE_STM, file=sys.stderr)
             exit(1)
 
-        if "ripecountry" == plt["ip_loc"]:
-            print(c.RP_STM, file=sys.stderr)
-            exit(1)
-
     #Error checking command line args and files
     #Check that GeoLite2 databases and aux scripts exist and have proper permissions
     errors = (check_files(GEO_DIR, [GEO_DB_CITY, GEO_DB_COUNTRY], True) or 
               check_files(AUX_DIR, [IP_TO_ORG, IP_TO_COUNTRY], False))
 
-    #check -i input dir
-    if args.in_dir == "":
+    #check -i input dir, or --jobs job list
+    if args.jobs != "":
+        if args.in_dir != "":
+            errors = True
+            print(c.JOBS_IN_DIR, file=sys.stderr)
+        if check_files(os.path.dirname(args.jobs), [args.jobs], False, "Job list"):
+            errors = True
+    elif args.in_dir == "":
         errors = True 
         print(c.NO_IN_DIR, file=sys.stderr)
     elif check_dir(args.in_dir, "Input pcap directory"):
@@ -219,7 +254,12 @@ def main():
     #check -m mac address
     no_mac_device = False
     valid_device_list = True
-    if args.mac_addr == "" and args.dev == "":
+    if args.all_devices and (args.mac_addr != "" or args.dev != ""):
+        errors = True
+        print(c.ALL_DEV_MAC, file=sys.stderr)
+    elif args.all_devices or args.jobs != "":
+        pass
+    elif args.mac_addr == "" and args.dev == "":
         no_mac_devce = errors = True
         print(c.NO_MAC, file=sys.stderr)
     elif args.mac_addr != "":
@@ -249,8 +289,16 @@ def main():
             else:
                 args.mac_addr = devices.getDeviceMac(args.dev)
 
-    #check -s hosts dir
-    if args.hosts_dir != "" and check_dir(args.hosts_dir, "Hosts directory"):
+    #check -s hosts dir or file
+    if args.hosts_dir != "" and os.path.isfile(args.hosts_dir):
+        if check_files(os.path.dirname(args.hosts_dir), [args.hosts_dir], False, "Hosts file"):
+            errors = True
+    elif args.hosts_dir != "" and check_dir(args.hosts_dir, "Hosts directory"):
+        errors = True
+
+    #check --prefix-table ASN/prefix table
+    if args.prefix_table != "" and check_files(os.path.dirname(args.prefix_table),
+                                               [args.prefix_table], False, "Prefix table"):
         errors = True
 
     #check -o output csv
@@ -272,6 +320,30 @@ def main():
         errors = True
         print(c.NON_POS % args.num_proc, file=sys.stderr)
 
+    #check --shard shard and --shard-plan shard plan
+    shard = None
+    if args.shard != "":
+        shard = parse_shard(args.shard)
+        if shard is None:
+            errors = True
+            print(c.INVAL_SHARD % args.shard, file=sys.stderr)
+    elif args.shard_plan != "":
+        errors = True
+        print(c.PLAN_NO_SHARD, file=sys.stderr)
+
+    if args.overwrite:
+        errors = True
+        print(c.OVERWRITE_NO_MERGE, file=sys.stderr)
+
+    #check --window window length
+    try:
+        args.window = float(args.window)
+        if args.window < 0:
+            raise ValueError
+    except ValueError:
+        errors = True
+        print(c.INVAL_WINDOW % args.window, file=sys.stderr)
+
     plot_types = ["", "stackplot", "lineplot", "scatterplot", "barplot", "pieplot", "barhplot"]
     ip_loc_types = ["country", "host", "tsharkhost", "ripecountry", "ip"]
     ip_attr_types = ["addrpcktsize", "addrpcktnum"]
@@ -311,41 +383,167 @@ def main():
                 errors = True
                 print(c.INVAL_ATTR % (plt["ip_attr"], plt["plt"]), file=sys.stderr)
 
+    #check --jobs job list entries
+    jobs = [{"pcap": args.in_dir, "dev": args.dev, "mac": args.mac_addr, "lab": args.lab,
+             "experiment": args.experiment, "network": args.network}]
+    if args.jobs != "" and not errors:
+        jobs, errors = load_jobs(args.jobs)
+
     if errors:
         print_usage(1)
     #End error checking
 
+    #Windowed counts are written per pcap file, so all shards share the directory
+    args.window_dir = os.path.splitext(args.out_file)[0] + "_windows"
+
+    #A shard writes its own output file, merged with the others by --merge-shards
+    if shard is not None:
+        args.out_file = shard_file(args.out_file, *shard)
+        print("Analyzing shard %s of %s into \"%s\"." % (shard[0], shard[1], args.out_file))
+
     #Create output file if it doesn't exist
-    if not os.path.isfile(args.out_file):
+    new_output = not os.path.isfile(args.out_file)
+    if new_output:
         DataPresentation.DomainExport.create_csv(args.out_file)
 
-    #Create the groups to run analysis with processes
-    raw_files = [ [] for _ in range(num_proc) ]
+    #The manifest records which pcap files already have rows in the output file
+    manifest = Manifest.Manifest.forOutput(args.out_file)
+    if new_output and len(manifest.entries) != 0:
+        manifest.clear()
 
-    index = 0
-    # Split the pcap files into num_proc groups
-    for root, dirs, files in os.walk(args.in_dir):
-        for filename in files:
-            if filename.endswith(".pcap") and not filename.startswith("."):
-                raw_files[index].append(root + "/" + filename)
-                index += 1
-                if index >= num_proc:
-                    index = 0
+    #The journal makes appending the rows of each pcap file atomic; rows left
+    #by an interrupted run are removed so their pcap files are analyzed again
+    journal = Journal.Journal.forOutput(args.out_file)
+    if new_output or not os.path.isfile(journal.fileName):
+        journal.reset()
+    else:
+        removed = journal.recover(manifest)
+        if removed != 0:
+            print("Removed %s bytes of uncommitted rows left in \"%s\" by an interrupted run."
+                  % (removed, args.out_file))
+
+    #Find the pcap files that are new or changed since they were last analyzed
+    pcap_files = []
+    file_info = {}
+    changed = []
+    skipped = 0
+    if args.jobs == "":
+        jobs[0]["files"] = find_pcaps(args.in_dir)
+    job_files = [(pcap_file, job) for job in jobs for pcap_file in job["files"]]
+    if shard is not None:
+        job_files = select_shard(job_files, shard)
+    for pcap_file, job in job_files:
+        info = Manifest.Manifest.fileInfo(pcap_file)
+        if not args.reanalyze and manifest.isCurrent(info):
+            skipped += 1
+            continue
+        #Each pcap file is in job_files once (load_jobs rejects duplicates)
+        if pcap_file in manifest:
+            changed.append(pcap_file)
+        file_info[pcap_file] = info
+        pcap_files.append((pcap_file, job))
+
+    if skipped != 0:
+        print("Skipping %s pcap files already analyzed in \"%s\"." % (skipped, args.out_file))
+
+    if len(changed) != 0:
+        print("Replacing the rows of %s pcap files analyzed again..." % len(changed))
+        journal.rewrite(changed)
+        DataPresentation.DomainExport.remove_rows(args.out_file, changed)
+        manifest.remove(changed)
+        journal.checkpoint()
+
+    #Processes take files from a shared queue, largest file first, so the
+    #long captures start early and no process is left with all of them
+    pcap_files.sort(key=lambda f: (-file_info[f[0]]["size"], f[0]))
+    work_queue = Queue()
+    for idx, (f, job) in enumerate(pcap_files):
+        work_queue.put((idx + 1, f, job))
+    for _ in range(num_proc):
+        work_queue.put(None)
+
+    #The spans are also needed for --timing-prom, so they are kept in a
+    #temporary file if --timing is not given
+    timing_file = args.timing
+    if args.timing_prom != "" and timing_file == "":
+        tmp_fd, timing_file = tempfile.mkstemp(suffix=".jsonl")
+        os.close(tmp_fd)
+    timing = Utils.Timing(timing_file)
+
+    #Load the tables shared by every pcap file once; the processes inherit them
+    with timing.span(c.Stage.LOAD, "main"):
+        aux_map = IP.IPMapping()
+        aux_map.loadOrgMapping(IP_TO_ORG)
+        aux_map.loadCountryMapping(IP_TO_COUNTRY)
+        if args.prefix_table != "":
+            aux_map.loadPrefixTable(args.prefix_table)
+        if os.path.isfile(args.hosts_dir):
+            shared_hosts = aux_map.readHostFile(args.hosts_dir)
+
+    #Reverse DNS and WHOIS results are kept between runs
+    if args.host_cache != "":
+        IP.setHostEnricher(IP.HostEnricher(IP.HostCache(args.host_cache)))
+
+    #RIPE IPmap locations for the RipeCountry method; made before the processes
+    #are started so they share its rate limit
+    IP.setRipeProbe(IP.RipeProbe(IP.SQLiteLocationStore(args.ripe_db)))
+
+    #matplotlib is only imported when there are plots; import it before the
+    #processes are started so each of them does not import it again
+    if len(plots) != 0:
+        DataPresentation.plt.importNow()
 
     gc.collect()
+    #Keep the garbage collector from touching the shared tables in the
+    #processes, which would copy their memory pages
+    gc.freeze()
+
+    #One process appends the rows of every pcap file to the output file
+    result_queue = Queue()
+    writer = Process(target=write_results, args=(result_queue, args.out_file, manifest, file_info))
+    writer.start()
 
     print("Analyzing input pcap files...")
+    journal.start(len(pcap_files))
     # run analysis with num_proc processes
     procs = []
-    for pid, files in enumerate(raw_files):
-        p = Process(target=run, args=(pid, files))
+    for pid in range(num_proc):
+        p = Process(target=run, args=(pid, work_queue, len(pcap_files)))
         procs.append(p)
         p.start()
 
     for p in procs:
         p.join()
 
+    result_queue.put(None)
+    writer.join()
+
+    journal.rewrite()
     DataPresentation.DomainExport.sort_csv(args.out_file)
+    journal.checkpoint()
+
+    #Failed pcap files have no rows in the output file, so the next run tries them again
+    failed = journal.failures({"P%s" % pid: p.exitcode for pid, p in enumerate(procs)})
+    if len(failed) != 0:
+        print("\n%s%s pcap files could not be analyzed:%s" % (RED, len(failed), END), file=sys.stderr)
+        for pcap_file, error in failed:
+            print("  %s: %s" % (pcap_file, error), file=sys.stderr)
+
+    #Pcap files with warnings have their rows in the output file, and are not analyzed again
+    warnings = journal.warnings()
+    if len(warnings) != 0:
+        print("\n%s%s pcap files were analyzed with warnings:%s"
+              % (RED, len(set(pcap_file for pcap_file, _ in warnings)), END), file=sys.stderr)
+        for pcap_file, warning in warnings:
+            print("  %s: %s" % (pcap_file, warning), file=sys.stderr)
+
+    if args.timing_prom != "":
+        timing.writePrometheus(args.timing_prom)
+        print("Stage timings written to \"%s\"" % args.timing_prom)
+        if args.timing == "":
+            os.remove(timing_file)
+    if args.timing != "":
+        print("Stage timings appended to \"%s\"" % args.timing)
 
     end_time = time.time()
     print("\nEnd time: %s" % time.strftime("%A %d %B %Y %H:%M:%S %Z", time.localtime(end_time)))
@@ -364,75 +562,408 @@ def main():
     print("\nDestintaion analysis finished.")
 
 
-def run(pid, pcap_files):
-    files_len = len(pcap_files)
-    for idx, f in enumerate(pcap_files):
-        perform_analysis(pid, idx + 1, files_len, f)
+'''
+Reads a job list: a CSV file with the header "pcap,device,experiment,lab,network"
+and one job per line. pcap is a pcap file or a directory of them, and
+device is a device name in the device list or a MAC address. Empty
+columns take the value of the matching command line option. A pcap file
+can only be in one job.
+'''
+def load_jobs(job_file):
+    errors = False
+    jobs = []
+    job_lines = {} #Line of the job of each pcap file
+    with open(job_file, newline="") as f:
+        for line_num, row in enumerate(csv.DictReader(f), 2):
+            row = {key.strip(): (val or "").strip() for key, val in row.items() if key is not None}
+            job = {"pcap": row.get("pcap", ""), "dev": row.get("device", "") or args.dev,
+                   "mac": args.mac_addr, "lab": row.get("lab", "") or args.lab,
+                   "experiment": row.get("experiment", "") or args.experiment,
+                   "network": row.get("network", "") or args.network}
+
+            if job["pcap"] == "" or not os.path.exists(job["pcap"]):
+                errors = True
+                print(c.JOB_NO_PCAP % (job_file, line_num, job["pcap"]), file=sys.stderr)
+
+            #The manifest and journal know a pcap file by its path only, so it
+            #can only be in one job; its devices are analyzed with --all-devices
+            job["files"] = find_pcaps(job["pcap"]) if job["pcap"] != "" else []
+            for pcap_file in job["files"]:
+                if pcap_file in job_lines:
+                    errors = True
+                    print(c.JOB_DUP_PCAP % (job_file, line_num, pcap_file, job_lines[pcap_file]),
+                          file=sys.stderr)
+                else:
+                    job_lines[pcap_file] = line_num
+
+            if args.all_devices or row.get("device", "") == "":
+                pass
+            elif re.match("([0-9a-f]{1,2}[:]){5}[0-9a-f]{1,2}$", job["dev"].lower()):
+                job["mac"] = Device.Device.normaliseMac(job["dev"]).lower()
+                job["dev"] = devices.getDeviceName(job["mac"]) or ""
+            elif devices.deviceInList(job["dev"]):
+                job["mac"] = devices.getDeviceMac(job["dev"])
+            else:
+                errors = True
+                print(c.JOB_NO_DEV % (job_file, line_num, job["dev"], args.dev_list), file=sys.stderr)
+
+            if not args.all_devices and job["mac"] == "" and row.get("device", "") == "":
+                errors = True
+                print(c.JOB_NO_MAC % (job_file, line_num), file=sys.stderr)
+
+            jobs.append(job)
+
+    return jobs, errors
+
+
+#Returns the shard I/N as (I, N), or None if it is not valid
+def parse_shard(value):
+    try:
+        idx, num = [int(val) for val in value.split("/")]
+    except ValueError:
+        return None
+    if num < 1 or idx < 1 or idx > num:
+        return None
+    return idx, num
+
+
+#Output file of shard idx of num
+def shard_file(out_file, idx, num):
+    return "%s_shard%sof%s.csv" % (os.path.splitext(out_file)[0], idx, num)
+
+
+'''
+Returns the (pcap file, job) pairs of shard idx of num. A pcap file goes to
+the shard given in the shard plan, if there is one, or else to the shard
+chosen by the CRC-32 of its path, so every machine running a shard of the
+same input selects the same files without talking to the others.
+'''
+def select_shard(job_files, shard):
+    idx, num = shard
+    plan = {}
+    if args.shard_plan != "":
+        plan = load_shard_plan(args.shard_plan, [f for f, _ in job_files], num)
+    return [(f, job) for f, job in job_files
+            if plan.get(f, zlib.crc32(f.encode("utf-8")) % num + 1) == idx]
+
+
+'''
+Reads the shard plan, a CSV file with the header "pcap,size,shard,shards",
+or creates it if it does not exist. The plan is made by giving each pcap
+file, largest first, to the shard with the smallest total size so far, so
+two machines creating it at the same time write the same plan. Paths in
+the plan are normalised like the paths in the manifest, so a plan written
+by hand may use relative paths.
+'''
+def load_shard_plan(plan_file, pcap_files, num):
+    plan = {}
+    if os.path.isfile(plan_file):
+        with open(plan_file, newline="") as f:
+            for row in csv.DictReader(f):
+                if int(row["shards"]) != num:
+                    print(c.PLAN_SHARDS % (plan_file, row["shards"], num), file=sys.stderr)
+                    exit(1)
+                plan[Manifest.Manifest.key(row["pcap"])] = int(row["shard"])
+
+        missing = sorted(set(f for f in pcap_files if f not in plan))
+        if len(missing) != 0:
+            print(c.PLAN_MISSING % (len(missing), plan_file), file=sys.stderr)
+            for pcap_file in missing:
+                print("  " + pcap_file, file=sys.stderr)
+        return plan
+
+    sizes = sorted(((os.path.getsize(f), f) for f in set(pcap_files)), key=lambda s: (-s[0], s[1]))
+    totals = [0] * num
+    rows = []
+    for size, pcap_file in sizes:
+        shard = min(range(num), key=lambda i: (totals[i], i))
+        totals[shard] += size
+        plan[pcap_file] = shard + 1
+        rows.append((pcap_file, size, shard + 1, num))
+
+    plan_dir = os.path.dirname(plan_file) or "."
+    tmp_fd, tmp_file = tempfile.mkstemp(dir=plan_dir, suffix=".csv")
+    with os.fdopen(tmp_fd, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["pcap", "size", "shard", "shards"])
+        writer.writerows(rows)
+    os.chmod(tmp_file, 0o644)
+    os.replace(tmp_file, plan_file)
+    print("Shard plan of %s pcap files written to \"%s\"." % (len(rows), plan_file))
+    return plan
+
+
+#Merges the output files of shards 1 to N of the output file, and their manifests
+def merge_shards():
+    try:
+        num = int(args.merge_shards)
+        if num < 1:
+            raise ValueError
+    except ValueError:
+        print(c.INVAL_MERGE % args.merge_shards, file=sys.stderr)
+        print_usage(1)
+
+    if not args.out_file.endswith(".csv"):
+        print(c.WRONG_EXT % ("Output file", "CSV (.csv)", args.out_file), file=sys.stderr)
+        print_usage(1)
+
+    #The merged shards replace the output file, so rows of earlier runs are only
+    #dropped if the user asks for it
+    if not args.overwrite and has_rows(args.out_file):
+        print(c.MERGE_EXISTS % args.out_file, file=sys.stderr)
+        exit(1)
+
+    shard_files = [shard_file(args.out_file, idx, num) for idx in range(1, num + 1)]
+    missing = False
+    for idx, f in enumerate(shard_files, 1):
+        if not os.path.isfile(f):
+            missing = True
+            print(c.NO_SHARD_OUT % (idx, num, f), file=sys.stderr)
+    if missing:
+        exit(1)
+
+    print("Merging %s shards into \"%s\"..." % (num, args.out_file))
+    try:
+        DataPresentation.DomainExport.merge_csv(args.out_file, shard_files)
+    except ValueError as e:
+        print(c.MERGE_ERR % e, file=sys.stderr)
+        exit(1)
+    Manifest.Manifest.forOutput(args.out_file).merge([Manifest.Manifest.forOutput(f) for f in shard_files])
+    Journal.Journal.forOutput(args.out_file).reset()
+    print("Shards merged into \"%s\"." % args.out_file)
+
+
+#Returns whether the CSV file exists and has rows after its header
+def has_rows(csv_file):
+    if not os.path.isfile(csv_file):
+        return False
+    with open(csv_file, newline="") as f:
+        return any(row for row in itertools.islice(csv.reader(f), 1, None))
+
+
+#Returns the pcap file, or the pcap files in the directory, at path. The
+#paths are normalised like the keys of the manifest, so a pcap file has the
+#same path in the output however IN_DIR was given
+def find_pcaps(path):
+    if os.path.isfile(path):
+        return [Manifest.Manifest.key(path)]
+
+    pcap_files = []
+    for root, dirs, files in os.walk(path):
+        for filename in files:
+            if filename.endswith(".pcap") and not filename.startswith("."):
+                pcap_files.append(Manifest.Manifest.key(os.path.join(root, filename)))
+    return pcap_files
+
+
+def run(pid, work_queue, files_len):
+    for idx, f, job in iter(work_queue.get, None):
+        journal.begin(f, "P%s" % pid)
+        try:
+            perform_analysis(pid, idx, files_len, f, job)
+        except Exception as e:
+            fail(pid, f, "%s: %s" % (type(e).__name__, e))
         gc.collect()
 
 
-def perform_analysis(pid, idx, files_len, pcap_file):
+#Reports that a pcap file could not be analyzed, and why
+def fail(pid, pcap_file, error):
+    print("  %sP%s: Error: Cannot analyze \"%s\": %s. Skipping file.%s"
+          % (RED, pid, pcap_file, error, END), file=sys.stderr)
+    journal.fail(pcap_file, "P%s" % pid, error)
+
+
+#Reports a problem that does not stop a pcap file from being analyzed
+def warn(pid, pcap_file, warning):
+    print("  %sP%s: Warning: %s.%s" % (RED, pid, warning, END), file=sys.stderr)
+    journal.warn(pcap_file, "P%s" % pid, warning)
+
+
+#Reports the frames the reader of a pcap file skipped
+def warn_skipped(pid, pcap_file, cap):
+    if cap.runts != 0:
+        warn(pid, pcap_file, "%s frames shorter than their link-layer header were skipped" % cap.runts)
+    if cap.truncated:
+        warn(pid, pcap_file, "The last packet record is cut short and was skipped")
+
+
+#Appends the rows of each pcap file to the output file, and commits them in
+#the journal once they are on disk
+def write_results(result_queue, out_file, manifest, file_info):
+    with open(out_file, "a") as f:
+        for pid, pcap_file, csv_data in iter(result_queue.get, None):
+            f.write(csv_data)
+            f.flush()
+            os.fsync(f.fileno())
+            journal.commit(file_info[pcap_file], f.tell())
+            manifest.add(file_info[pcap_file])
+            if csv_data != "":
+                print("  P%s: Analyzed data from \"%s\" successfully written to \"%s\""
+                      % (pid, pcap_file, out_file))
+
+
+def perform_analysis(pid, idx, files_len, pcap_file, job):
     print("P%s (%s/%s): Processing pcap file \"%s\"..." % (pid, idx, files_len, pcap_file))
-    cap = pyshark.FileCapture(pcap_file, use_json=True)
-    Utils.sysUsage("PCAP file loading")
-    cap.close()
-    base_ts = 0
+    worker = "P%s" % pid
+    total = timing.span(c.Stage.TOTAL, worker, pcap_file)
+    total.start()
     try:
-        if args.no_time_shift:
-            cap[0]
-        else:
-            base_ts = float(cap[0].frame_info.time_epoch)
-    except KeyError:
-        print(c.NO_PCKT % pcap_file, file=sys.stderr)
+        cap = PcapReader.PcapReader(pcap_file)
+    except OSError as e:
+        fail(pid, pcap_file, "Cannot open the file: %s" % e.strerror)
         return
 
-    node_id = Node.NodeId(args.mac_addr, args.ip_addr)
-    node_stats = Node.NodeStats(node_id, base_ts, devices)
-
     print("  P%s: Processing packets..." % pid)
+    decode = timing.span(c.Stage.DECODE, worker, pcap_file)
+    aggregate = timing.span(c.Stage.AGGREGATE, worker, pcap_file)
+    hosts = timing.span(c.Stage.HOSTS, worker, pcap_file)
     try:
-        for packet in cap:
-            node_stats.processPacket(packet)
-    except:
-        print("  %sP%s: Error: There is something wrong with \"%s\". Skipping file.%s"
-              % (RED, pid, pcap_file, END), file=sys.stderr)
+        with cap:
+            packets = iter(cap)
+            try:
+                first = next(packets)
+            except StopIteration:
+                warn_skipped(pid, pcap_file, cap)
+                print(c.NO_PCKT % pcap_file, file=sys.stderr)
+                result_queue.put((pid, pcap_file, ""))
+                return
+
+            base_ts = 0
+            if not args.no_time_shift:
+                base_ts = float(first.frame_info.time_epoch)
+
+            #With --stream, the per packet series are only kept, on disk, if there are plots
+            series = c.Series.MEMORY
+            if args.stream:
+                series = c.Series.DISK if len(plots) != 0 else c.Series.NONE
+
+            if args.all_devices:
+                nodes = Node.Nodes(base_ts, devices, series, args.window)
+                process = nodes.processPacket
+            else:
+                node_id = Node.NodeId(job["mac"], args.ip_addr)
+                node_stats = Node.NodeStats(node_id, base_ts, devices, series, args.window)
+                nodes = [node_stats]
+                process = node_stats.processPacket
+            tracker = DNSTracker.Tracker()
+
+            process(first)
+            tracker.processPacket(first)
+            if timing.enabled:
+                pckt_num = process_packets_timed(packets, process, tracker, decode, aggregate, hosts)
+            else:
+                pckt_num = 1
+                for packet in packets:
+                    process(packet)
+                    tracker.processPacket(packet)
+                    pckt_num += 1
+    except Exception as e:
+        error = "%s: %s" % (type(e).__name__, e)
+        if cap.packetNum != 0:
+            error = "Packet %s: %s" % (cap.packetNum, error)
+        fail(pid, pcap_file, error)
         return
 
-    del cap
-
-    Utils.sysUsage("Packets processed")
+    warn_skipped(pid, pcap_file, cap)
+    for span in (total, decode, aggregate, hosts):
+        span.packets = pckt_num
 
     print("  P%s: Mapping IP to host..." % pid)
+    hosts.start()
     ip_map = IP.IPMapping()
-    if args.hosts_dir != "":
+    host_file = ""
+    if args.hosts_dir != "" and shared_hosts is None:
         host_file = args.hosts_dir + "/" + os.path.basename(pcap_file)[:-4] + "txt"
-        ip_map.extractFromFile(pcap_file, host_file)
-    else:
-        ip_map.extractFromFile(pcap_file)
 
-    ip_map.loadOrgMapping(IP_TO_ORG)
-    ip_map.loadCountryMapping(IP_TO_COUNTRY)
+    if args.tshark_hosts:
+        ip_map.extractFromFile(pcap_file, host_file, shared_hosts)
+    else:
+        ip_map.extractFromTracker(tracker, host_file, shared_hosts)
 
-    Utils.sysUsage("TShark hosts loaded")
+    ip_map.shareMappings(aux_map)
+    hosts.stop()
+    for span in (decode, aggregate, hosts):
+        span.end()
 
+    #With --all-devices, every device in the device list that has traffic
+    #gets its own rows, named after the device, and its plots in FIG_DIR/DEV/
+    nodes = sorted(nodes, key=lambda n: n.nodeId.deviceName or "")
     print("  P%s: Generating CSV output..." % pid)
-    de = DataPresentation.DomainExport(node_stats.stats.stats, ip_map, GEO_DB_CITY, GEO_DB_COUNTRY)
-    de.loadDiffIPFor("eth") if args.find_diff else de.loadIPFor("eth")
-    de.loadDomains(args.dev, args.lab, args.experiment, args.network, pcap_file, str(base_ts))
-    de.exportDataRows(args.out_file)
-
-    print("  P%s: Analyzed data from \"%s\" successfully written to \"%s\""
-          % (pid, pcap_file, args.out_file))
-
-    Utils.sysUsage("Data exported")
-
+    with timing.span(c.Stage.EXPORT, worker, pcap_file) as span:
+        span.packets = pckt_num
+        csv_data = []
+        for node_stats in nodes:
+            device = node_stats.nodeId.deviceName if args.all_devices else job["dev"]
+            de = DataPresentation.DomainExport(node_stats.stats.stats, ip_map, GEO_DB_CITY, GEO_DB_COUNTRY)
+            de.loadDiffIPFor("eth") if args.find_diff else de.loadIPFor("eth")
+            de.loadDomains(device, job["lab"], job["experiment"], job["network"], pcap_file, str(base_ts))
+            csv_data.append(de.getCsvData())
+
+        #Windowed counts go to their own file per pcap file, written by this process
+        if args.window:
+            we = DataPresentation.WindowExport(args.window)
+            for node_stats in nodes:
+                device = node_stats.nodeId.deviceName if args.all_devices else job["dev"]
+                we.loadWindowsFor(node_stats.stats.stats, "eth", device)
+            window_file = DataPresentation.WindowExport.window_file(args.window_dir, pcap_file)
+            we.save(window_file, pcap_file)
+            print("  P%s: Windowed counts written to \"%s\"" % (pid, window_file))
+
+    result_queue.put((pid, pcap_file, "".join(csv_data)))
+
+    #The rows are already committed, so a plot that fails is only a warning;
+    #the pcap file is not analyzed again
     if len(plots) != 0:
         print("  P%s: Generating plots..." % pid)
-        pm = DataPresentation.PlotManager(node_stats.stats.stats, plots)
-        pm.ipMap = ip_map
-        pm.generatePlot(pid, pcap_file, args.fig_dir, GEO_DB_CITY, GEO_DB_COUNTRY)
-
-        Utils.sysUsage("Plots generated")
+        with timing.span(c.Stage.PLOT, worker, pcap_file) as span:
+            span.packets = pckt_num
+            for node_stats in nodes:
+                fig_dir = args.fig_dir
+                if args.all_devices:
+                    fig_dir = os.path.join(args.fig_dir, node_stats.nodeId.deviceName)
+                try:
+                    pm = DataPresentation.PlotManager(node_stats.stats.stats, plots)
+                    pm.ipMap = ip_map
+                    pm.downsample = not args.no_downsample
+                    pm.generatePlot(pid, pcap_file, fig_dir, GEO_DB_CITY, GEO_DB_COUNTRY)
+                except Exception as e:
+                    warn(pid, pcap_file, "Plots not generated in \"%s\": %s: %s"
+                         % (fig_dir, type(e).__name__, e))
+
+    total.stop()
+    total.end()
+
+
+#Processes the packets like the loop in perform_analysis, timing the reading
+#of each packet, its counting and its name tracking. Timing the CPU time of
+#every packet would cost more than processing it, so the CPU time of the
+#whole loop is divided between the three in proportion to their wall time
+def process_packets_timed(packets, process, tracker, decode, aggregate, hosts):
+    pckt_num = 1
+    wall = [0.0, 0.0, 0.0]
+    clock = time.perf_counter
+    begin = time.time()
+    cpu_start = time.process_time()
+    t0 = clock()
+    for packet in packets:
+        t1 = clock()
+        process(packet)
+        t2 = clock()
+        tracker.processPacket(packet)
+        t3 = clock()
+        wall[0] += t1 - t0
+        wall[1] += t2 - t1
+        wall[2] += t3 - t2
+        t0 = t3
+        pckt_num += 1
+    #The end of the capture is found by one last read
+    wall[0] += clock() - t0
+    cpu = time.process_time() - cpu_start
+
+    loop_wall = sum(wall)
+    for span, stage_wall in zip((decode, aggregate, hosts), wall):
+        span.add(stage_wall, cpu * stage_wall / loop_wall if loop_wall > 0 else 0.0, begin)
+    return pckt_num
 
 
 if __name__ == "__main__":
@@ -0,0 +1,168 @@
+""" Generates synthetic IoT traffic pcap files for benchmarking """
+
+import argparse
+import heapq
+import random
+import socket
+import struct
+
+#Addresses of the synthetic network
+GATEWAY_MAC = "02:00:00:00:00:01"
+RESOLVER_IP = "192.168.0.1"
+DEVICE_MAC = "02:00:00:01:{:02x}:{:02x}"
+DEVICE_IP = "192.168.{}.{}"
+
+ETH_IPV4 = 0x0800
+IP_PROTO_TCP = 6
+IP_PROTO_UDP = 17
+PCAP_HEADER = struct.pack("<IHHiIII", 0xA1B2C3D4, 2, 4, 0, 0, 65535, 1)
+
+
+class Destination(object):
+    def __init__(self, idx, rng):
+        self.ip = "{}.{}.{}.{}".format(rng.randint(1, 223), rng.randint(0, 255), rng.randint(0, 255),
+                                      rng.randint(1, 254))
+        self.host = "host{}.service{}.example.com".format(idx, idx % 17)
+        self.port = rng.choice([80, 443, 443, 443, 8883, 123])
+
+
+'''
+Traffic of one device: a stream of (timestamp, frame) in time order.
+Packets arrive at rate per second on average; a dns share of them start a
+new connection (a DNS query and answer, then a TLS ClientHello or HTTP
+request naming the destination), the others are data packets of random
+size to or from one of the device's destinations.
+'''
+class DeviceTraffic(object):
+    def __init__(self, idx, destinations, args, seed):
+        self.rng = random.Random(seed)
+        self.mac = DEVICE_MAC.format(idx // 256, idx % 256)
+        self.ip = DEVICE_IP.format(idx // 240, 10 + idx % 240)
+        self.name = "device{}".format(idx)
+        self.destinations = self.rng.sample(destinations, min(len(destinations), args.dest_per_device))
+        self.rate = args.rate
+        self.dns = args.dns
+        self.start = args.start
+        self.duration = args.duration
+        self.ports = {}
+
+    def packets(self):
+        ts = self.start + self.rng.expovariate(self.rate)
+        while ts < self.start + self.duration:
+            dest = self.rng.choice(self.destinations)
+            if self.rng.random() < self.dns or dest.ip not in self.ports:
+                for frame in self.connect(dest):
+                    yield ts, frame
+                    ts += 0.0005
+            else:
+                yield ts, self.data(dest)
+            ts += self.rng.expovariate(self.rate)
+
+    def connect(self, dest):
+        sport = self.ports[dest.ip] = self.rng.randint(32768, 60999)
+        query_id = self.rng.randint(0, 65535)
+        yield self.udp(self.mac, GATEWAY_MAC, self.ip, RESOLVER_IP, sport, 53, dns(query_id, dest.host))
+        yield self.udp(GATEWAY_MAC, self.mac, RESOLVER_IP, self.ip, 53, sport,
+                       dns(query_id, dest.host, dest.ip))
+        if dest.port == 80:
+            payload = "GET / HTTP/1.1\r\nHost: {}\r\n\r\n".format(dest.host).encode("ascii")
+        else:
+            payload = client_hello(dest.host)
+        yield self.tcp(self.mac, GATEWAY_MAC, self.ip, dest.ip, sport, dest.port, payload)
+
+    def data(self, dest):
+        size = int(self.rng.choice([40, 60, 120, 300, 600, 1400, 1400]) * self.rng.uniform(0.8, 1.0))
+        payload = bytes(size)
+        sport = self.ports[dest.ip]
+        if self.rng.random() < 0.5:
+            return self.tcp(self.mac, GATEWAY_MAC, self.ip, dest.ip, sport, dest.port, payload)
+        return self.tcp(GATEWAY_MAC, self.mac, dest.ip, self.ip, dest.port, sport, payload)
+
+    def udp(self, src_mac, dst_mac, src_ip, dst_ip, sport, dport, payload):
+        segment = struct.pack("!HHHH", sport, dport, 8 + len(payload), 0) + payload
+        return ethernet(src_mac, dst_mac, ipv4(src_ip, dst_ip, IP_PROTO_UDP, segment))
+
+    def tcp(self, src_mac, dst_mac, src_ip, dst_ip, sport, dport, payload):
+        segment = struct.pack("!HHIIBBHHH", sport, dport, 1, 1, 5 << 4, 0x18, 65535, 0, 0) + payload
+        return ethernet(src_mac, dst_mac, ipv4(src_ip, dst_ip, IP_PROTO_TCP, segment))
+
+
+def ethernet(src_mac, dst_mac, payload):
+    return (bytes.fromhex(dst_mac.replace(":", "")) + bytes.fromhex(src_mac.replace(":", ""))
+            + struct.pack("!H", ETH_IPV4) + payload)
+
+
+def ipv4(src_ip, dst_ip, proto, payload):
+    return (struct.pack("!BBHHHBBH", 0x45, 0, 20 + len(payload), 0, 0, 64, proto, 0)
+            + socket.inet_aton(src_ip) + socket.inet_aton(dst_ip) + payload)
+
+
+def dns_name(name):
+    return b"".join(bytes([len(label)]) + label.encode("ascii") for label in name.split(".")) + b"\x00"
+
+
+#A DNS query for host, or the response with an A record for ip
+def dns(query_id, host, ip=None):
+    flags = 0x8180 if ip is not None else 0x0100
+    msg = struct.pack("!HHHHHH", query_id, flags, 1, 1 if ip is not None else 0, 0, 0)
+    msg += dns_name(host) + struct.pack("!HH", 1, 1)
+    if ip is not None:
+        msg += struct.pack("!HHHIH", 0xC00C, 1, 1, 300, 4) + socket.inet_aton(ip)
+    return msg
+
+
+def client_hello(host):
+    name = host.encode("ascii")
+    sni = struct.pack("!HBH", len(name) + 3, 0, len(name)) + name
+    exts = struct.pack("!HH", 0, len(sni)) + sni
+    body = (b"\x03\x03" + bytes(32) + b"\x00" + struct.pack("!H", 2) + b"\x13\x01" + b"\x01\x00"
+            + struct.pack("!H", len(exts)) + exts)
+    handshake = b"\x01" + struct.pack("!I", len(body))[1:] + body
+    return b"\x16\x03\x01" + struct.pack("!H", len(handshake)) + handshake
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generates a deterministic synthetic IoT traffic pcap"
+                                     " file, and the device list to analyze it with.")
+    parser.add_argument("-o", dest="out_file", default="synthetic.pcap", help="output pcap file")
+    parser.add_argument("-c", dest="dev_list", default="",
+                        help="output device list (Default = OUT_FILE with .txt extension)")
+    parser.add_argument("--devices", type=int, default=10, help="number of devices (Default = 10)")
+    parser.add_argument("--destinations", type=int, default=200,
+                        help="number of destinations shared by the devices (Default = 200)")
+    parser.add_argument("--dest-per-device", dest="dest_per_device", type=int, default=20,
+                        help="destinations each device talks to (Default = 20)")
+    parser.add_argument("--rate", type=float, default=50,
+                        help="packets per second of each device (Default = 50)")
+    parser.add_argument("--dns", type=float, default=0.02,
+                        help="share of packets starting a new connection with a DNS lookup"
+                             " (Default = 0.02)")
+    parser.add_argument("--duration", type=float, default=600, help="seconds of traffic (Default = 600)")
+    parser.add_argument("--start", type=float, default=1556329377, help="Unix time of the first packet")
+    parser.add_argument("--seed", type=int, default=1, help="random seed (Default = 1)")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    destinations = [Destination(i, rng) for i in range(args.destinations)]
+    devices = [DeviceTraffic(i, destinations, args, args.seed * 100003 + i) for i in range(args.devices)]
+
+    count = 0
+    with open(args.out_file, "wb") as f:
+        f.write(PCAP_HEADER)
+        for ts, frame in heapq.merge(*[device.packets() for device in devices], key=lambda p: p[0]):
+            usec = int(round(ts * 1e6))
+            f.write(struct.pack("<IIII", usec // 1000000, usec % 1000000, len(frame), len(frame)))
+            f.write(frame)
+            count += 1
+
+    dev_list = args.dev_list or args.out_file.rsplit(".", 1)[0] + ".txt"
+    with open(dev_list, "w") as f:
+        for device in devices:
+            f.write("{} {}\n".format(device.mac, device.name))
+
+    print("Wrote {} packets of {} devices to \"{}\" and the device list to \"{}\"."
+          .format(count, len(devices), args.out_file, dev_list))
+
+
+if __name__ == "__main__":
+    main()
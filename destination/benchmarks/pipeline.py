@@ -0,0 +1,224 @@
+""" Times each stage of the destination analysis of one pcap file """
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import types
+
+DEST_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, DEST_DIR)
+
+from trafficAnalyzer import *
+from trafficAnalyzer import Constants as c
+
+GEO_DB_CITY = DEST_DIR + "/geoipdb/GeoLite2-City.mmdb"
+GEO_DB_COUNTRY = DEST_DIR + "/geoipdb/GeoLite2-Country.mmdb"
+IP_TO_ORG = DEST_DIR + "/aux/ipToOrg.csv"
+IP_TO_COUNTRY = DEST_DIR + "/aux/ipToCountry.csv"
+GEN_PCAP = os.path.join(os.path.dirname(os.path.abspath(__file__)), "gen_pcap.py")
+
+#Plots drawn by the plot stage; IP addresses are used as locations so no lookups are timed
+PLOTS = ["stackplot", "lineplot", "scatterplot", "barplot"]
+
+
+#Peak resident set size of the process so far, in MB
+def peak_rss():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    #Linux reports kilobytes, macOS bytes
+    return rss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+'''
+Runs the stages one after the other and records the wall time, the packets
+per second and the peak RSS of the process after each one. The peak RSS is
+a high-water mark, so a stage only raises it if it needs more memory than
+the stages before it.
+'''
+class Benchmark(object):
+    def __init__(self, packets=0):
+        self.packets = packets
+        self.results = []
+
+    def run(self, name, func, *args, per_packet=True):
+        start = time.perf_counter()
+        res = func(*args)
+        secs = time.perf_counter() - start
+        self.results.append({"stage": name, "seconds": secs,
+                             "packets_per_sec": self.packets / secs if per_packet and secs > 0 else None,
+                             "peak_rss_mb": peak_rss()})
+        return res
+
+    def skip(self, name, reason):
+        self.results.append({"stage": name, "skipped": reason})
+
+    #Adds a note to the last stage, shown under the table
+    def note(self, note):
+        self.results[-1]["note"] = note
+
+    def report(self):
+        print("%-12s %10s %14s %14s" % ("stage", "seconds", "packets/s", "peak RSS MB"))
+        for res in self.results:
+            if "skipped" in res:
+                print("%-12s %s" % (res["stage"], "skipped: " + res["skipped"]))
+            else:
+                rate = res["packets_per_sec"]
+                print("%-12s %10.3f %14s %14.1f" % (res["stage"] + ("*" if "note" in res else ""),
+                                                    res["seconds"], "-" if rate is None else "%.0f" % rate,
+                                                    res["peak_rss_mb"]))
+        for res in self.results:
+            if "note" in res:
+                print("\n* %s: %s" % (res["stage"], res["note"]))
+
+
+'''
+Stands in for a GeoLite2 database that is not installed, so the export stage
+can still be timed. Every address is located in the same place, so the
+stage does all of its work except searching the database, and its time is
+a lower bound.
+'''
+class StubGeoReader(object):
+    def __init__(self):
+        self.location = types.SimpleNamespace(
+            country=types.SimpleNamespace(iso_code="US"),
+            subdivisions=types.SimpleNamespace(most_specific=types.SimpleNamespace(name="Massachusetts")),
+            city=types.SimpleNamespace(name="Boston"))
+
+    def city(self, ip):
+        return self.location
+
+
+def load_tables():
+    aux_map = IP.IPMapping()
+    aux_map.loadOrgMapping(IP_TO_ORG)
+    aux_map.loadCountryMapping(IP_TO_COUNTRY)
+    return aux_map
+
+
+def decode(pcap_file):
+    with PcapReader.PcapReader(pcap_file) as cap:
+        return list(cap)
+
+
+def aggregate(packets, devices, mac, series):
+    base_ts = float(packets[0].frame_info.time_epoch)
+    if mac == "":
+        nodes = Node.Nodes(base_ts, devices, series, 0)
+    else:
+        nodes = Node.NodeStats(Node.NodeId(mac, ""), base_ts, devices, series, 0)
+    for packet in packets:
+        nodes.processPacket(packet)
+    return sorted(nodes if mac == "" else [nodes], key=lambda n: n.nodeId.deviceName or "")
+
+
+def extract_hosts(packets, aux_map):
+    tracker = DNSTracker.Tracker()
+    for packet in packets:
+        tracker.processPacket(packet)
+    ip_map = IP.IPMapping()
+    ip_map.extractFromTracker(tracker)
+    ip_map.shareMappings(aux_map)
+    return ip_map
+
+
+def export(nodes, ip_map, pcap_file, base_ts):
+    csv_data = []
+    for node_stats in nodes:
+        device = node_stats.nodeId.deviceName or node_stats.nodeId.mac
+        de = DataPresentation.DomainExport(node_stats.stats.stats, ip_map, GEO_DB_CITY, GEO_DB_COUNTRY)
+        de.loadIPFor("eth")
+        de.loadDomains(device, "lab", "benchmark", "network", pcap_file, str(base_ts))
+        csv_data.append(de.getCsvData())
+    return "".join(csv_data)
+
+
+def plot(nodes, ip_map, pcap_file, fig_dir):
+    plots = [{"plt": plt, "prot_snd": "eth-snd", "prot_rcv": "eth-rcv", "ip_loc": "ip",
+              "ip_attr": "addrpcktsize"} for plt in PLOTS]
+    for node_stats in nodes:
+        device = node_stats.nodeId.deviceName or node_stats.nodeId.mac
+        pm = DataPresentation.PlotManager(node_stats.stats.stats, plots)
+        pm.ipMap = ip_map
+        pm.generatePlot(0, pcap_file, os.path.join(fig_dir, device), GEO_DB_CITY, GEO_DB_COUNTRY)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Times each stage of the destination analysis of a"
+                                     " pcap file: packet decoding, NodeStats aggregation, IPMapping"
+                                     " host extraction, DomainExport and plotting.")
+    parser.add_argument("pcap", nargs="?", default="",
+                        help="pcap file to analyze (Default = a synthetic pcap made by gen_pcap.py)")
+    parser.add_argument("-c", dest="dev_list", default="",
+                        help="device list (Default = PCAP with .txt extension)")
+    parser.add_argument("-m", dest="mac_addr", default="",
+                        help="MAC address of the device to analyze (Default = every device in the list)")
+    parser.add_argument("--stream", dest="stream", action="store_true", default=False,
+                        help="keep the per packet series on disk, as analyze.py --stream with plots")
+    parser.add_argument("--no-plots", dest="no_plots", action="store_true", default=False,
+                        help="skip the plot stage")
+    parser.add_argument("--json", dest="json_file", default="",
+                        help="append the results as a JSON line to this file")
+    parser.add_argument("--gen-args", dest="gen_args", default="--duration 600",
+                        help="arguments of gen_pcap.py when no pcap file is given"
+                             " (Default = \"--duration 600\")")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        pcap_file = args.pcap
+        if pcap_file == "":
+            pcap_file = os.path.join(tmp_dir, "synthetic.pcap")
+            subprocess.run([sys.executable, GEN_PCAP, "-o", pcap_file] + args.gen_args.split(), check=True)
+        dev_list = args.dev_list or pcap_file.rsplit(".", 1)[0] + ".txt"
+
+        devices = Device.Devices(dev_list)
+        mac = Device.Device.normaliseMac(args.mac_addr) if args.mac_addr != "" else ""
+        series = c.Series.DISK if args.stream else c.Series.MEMORY
+
+        #Reverse DNS and WHOIS lookups would time the network, so they find nothing
+        IP.setHostEnricher(IP.HostEnricher(lookups={IP.HostEnricher.HOST: lambda ip: "",
+                                                    IP.HostEnricher.WHOIS: lambda ip: ""}))
+
+        bench = Benchmark()
+        packets = bench.run("decode", decode, pcap_file)
+        if len(packets) == 0:
+            print("\"%s\" contains no packets." % pcap_file, file=sys.stderr)
+            exit(1)
+        bench.packets = len(packets)
+        #Packets per second of the decode stage are only known once it is done
+        bench.results[0]["packets_per_sec"] = len(packets) / bench.results[0]["seconds"]
+
+        aux_map = bench.run("tables", load_tables, per_packet=False)
+        nodes = bench.run("aggregate", aggregate, packets, devices, mac, series)
+        ip_map = bench.run("hosts", extract_hosts, packets, aux_map)
+
+        missing = [db for db in (GEO_DB_CITY, GEO_DB_COUNTRY) if not os.path.isfile(db)]
+        for db in missing:
+            IP.geoReaders[db] = StubGeoReader()
+        bench.run("export", export, nodes, ip_map, pcap_file, packets[0].frame_info.time_epoch)
+        if len(missing) != 0:
+            bench.note("GeoLite2 databases not found in \"%s\"; timed with a stub reader that"
+                       " does not search a database, so real runs take longer"
+                       % os.path.dirname(GEO_DB_CITY))
+
+        if args.no_plots:
+            bench.skip("plot", "--no-plots")
+        else:
+            bench.run("plot", plot, nodes, ip_map, pcap_file, os.path.join(tmp_dir, "figures"))
+
+    print("\n%s packets of %s devices in \"%s\"\n"
+          % (len(packets), len(nodes), args.pcap or "synthetic.pcap"))
+    bench.report()
+
+    if args.json_file != "":
+        with open(args.json_file, "a") as f:
+            f.write(json.dumps({"pcap": args.pcap, "gen_args": args.gen_args if args.pcap == "" else "",
+                                "packets": len(packets), "devices": len(nodes), "stream": args.stream,
+                                "time": time.time(), "stages": bench.results}) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+""" Measures the startup time of the destination analyzer """
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+DEST_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+#Each case is run in a new interpreter from the destination directory
+CASES = [
+    ("python", "pass"),
+    ("trafficAnalyzer", "from trafficAnalyzer import *"),
+    ("analyze.py -h", None),
+]
+#Heavy dependencies, which trafficAnalyzer should only import on first use
+DEPENDENCIES = ["numpy", "pandas", "matplotlib.pyplot", "geoip2.database", "mysql.connector",
+                "whois", "tldextract"]
+
+
+def time_command(cmd, runs):
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(cmd, cwd=DEST_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times), min(times)
+
+
+def command(code):
+    if code is None:
+        return [sys.executable, "analyze.py", "-h"]
+    return [sys.executable, "-c", code]
+
+
+#Returns the modules imported by "from trafficAnalyzer import *" that take
+#the longest, cumulatively, according to "python -X importtime"
+def import_times(top):
+    res = subprocess.run([sys.executable, "-X", "importtime", "-c", "from trafficAnalyzer import *"],
+                         cwd=DEST_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                         universal_newlines=True)
+    times = []
+    for line in res.stderr.splitlines():
+        fields = line.split("|")
+        if len(fields) == 3 and fields[1].strip().isdigit():
+            times.append((int(fields[1]), fields[2].strip()))
+    return sorted(times, reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measures the startup time of analyze.py.")
+    parser.add_argument("-r", dest="runs", type=int, default=10, help="runs of each case (Default = 10)")
+    parser.add_argument("-t", dest="top", type=int, default=15,
+                        help="number of slowest imports listed (Default = 15)")
+    parser.add_argument("--deps", dest="deps", action="store_true", default=False,
+                        help="also time importing each heavy dependency on its own")
+    args = parser.parse_args()
+
+    cases = list(CASES)
+    if args.deps:
+        cases.extend(("import " + dep, "import " + dep) for dep in DEPENDENCIES)
+
+    print("%-28s %10s %10s" % ("case", "median ms", "min ms"))
+    for name, code in cases:
+        median, fastest = time_command(command(code), args.runs)
+        print("%-28s %10.1f %10.1f" % (name, median * 1000, fastest * 1000))
+
+    print("\nSlowest imports of trafficAnalyzer (cumulative):")
+    for usec, module in import_times(args.top):
+        print("%10.1f ms  %s" % (usec / 1000, module))
+
+    res = subprocess.run([sys.executable, "-c", "import sys; from trafficAnalyzer import *; "
+                          "print(' '.join(d for d in %r if d in sys.modules))" % DEPENDENCIES],
+                         cwd=DEST_DIR, stdout=subprocess.PIPE, universal_newlines=True)
+    loaded = res.stdout.strip()
+    print("\nHeavy dependencies imported at startup: %s" % (loaded if loaded != "" else "none"))
+
+
+if __name__ == "__main__":
+    main()
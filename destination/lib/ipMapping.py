@@ -1,15 +1,15 @@
 import sys
 
-from trafficAnalyser import IP
+from trafficAnalyzer import IP
 
 if __name__ == "__main__":
     with open(sys.argv[1]) as f:
         lines = f.readlines()
 
-    ripe = IP.RipeProbe()
+    ripe = IP.RipeProbe(IP.MySQLLocationStore())
 
-    for line in lines:
-        ip, _ = line.split()
-        country = ripe.getIPLocation(ip.strip(), 'countryCodeAlpha2')
+    ips = [line.split()[0].strip() for line in lines]
+    countries = ripe.getIPLocations(ips, 'countryCodeAlpha2')
 
-        print(ip, country)
+    for ip in ips:
+        print(ip, countries[ip])
@@ -5,13 +5,21 @@ country=$2
 output=${3:-"experiment_${country}.csv"}
 lab=${4:-"icl"}
 network=${5:-"icl"}
+numProc=${6:-"4"}
 
+deviceList="aux/devices_${country}.txt"
+jobList=$(mktemp "${TMPDIR:-/tmp}/jobs.XXXXXX")
+
+#Write one job per pcap file and analyze them all with a single analyze.py run
+echo "pcap,device,experiment,lab,network" > $jobList
 for f in $(find $expDir -name "*.pcap" | grep -v companion | grep "2019-05-08_"); do
 	device=$(echo $f | sed 's,'"$expDir"'/\([^\/]\+\).*,\1,g')
 	experiment=$(echo $f | sed 's,'"$expDir"'/\([^\/]\+\)/\([^\/]\+\).*,\2,g')
 	#mac=$(grep " $device\$" aux/devices_${country}.txt | gawk '{print $1}')
-  deviceList="aux/devices_${country}.txt"
 
-	echo python ../analyze.py -i $f -s ../aux/tshark_all.hosts -d $device -c $deviceList -e $experiment -b $lab -n $network -o $output
-	python ../analyze.py -i $f -s ../aux/tshark_all.hosts -d $device -c $deviceList -e $experiment -b $lab -n $network -o $output
+	echo "$f,$device,$experiment,$lab,$network" >> $jobList
 done;
+
+echo python ../analyze.py --jobs $jobList -s ../aux/tshark_all.hosts -c $deviceList -o $output -n $numProc
+python ../analyze.py --jobs $jobList -s ../aux/tshark_all.hosts -c $deviceList -o $output -n $numProc
+rm -f $jobList
@@ -0,0 +1,17 @@
+import os
+import sys
+
+import pytest
+
+DEST_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+#The tests import trafficAnalyzer the way analyze.py does, from the destination directory
+sys.path.insert(0, DEST_DIR)
+
+
+#analyze.py as a module; it looks for trafficAnalyzer next to the script it was run as
+@pytest.fixture
+def analyze(monkeypatch):
+    monkeypatch.setattr(sys, "argv", [os.path.join(DEST_DIR, "analyze.py")])
+    import analyze
+    return analyze
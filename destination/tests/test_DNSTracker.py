@@ -0,0 +1,97 @@
+import socket
+import struct
+
+from trafficAnalyzer.DNSTracker import Tracker
+from trafficAnalyzer.PcapReader import FrameInfo, Layer, Packet
+
+DEV_IP = "192.168.0.10"
+RESOLVER_IP = "192.168.0.1"
+
+
+def packet(transport, src, dst, sport, dport, payload):
+    p = Packet(FrameInfo(0.0, 0, 1))
+    p.addLayer(Layer("ip", src=src, dst=dst))
+    p.addLayer(Layer(transport, srcport=sport, dstport=dport))
+    p.payload = payload
+    return p
+
+
+def dns_name(name):
+    return b"".join(bytes([len(label)]) + label.encode("ascii") for label in name.split(".")) + b"\x00"
+
+
+#A DNS response to a query for host, with a CNAME to cname if given and then A records for ips
+def dns_response(host, ips, cname=None):
+    answers = b""
+    count = len(ips)
+    owner = b"\xc0\x0c"
+    if cname is not None:
+        rdata = dns_name(cname)
+        answers += owner + struct.pack("!HHIH", 5, 1, 300, len(rdata)) + rdata
+        count += 1
+        owner = dns_name(cname)
+    for ip in ips:
+        answers += owner + struct.pack("!HHIH", 1, 1, 300, 4) + socket.inet_aton(ip)
+    return (struct.pack("!HHHHHH", 1, 0x8180, 1, count, 0, 0) + dns_name(host) + struct.pack("!HH", 1, 1)
+            + answers)
+
+
+def client_hello(host):
+    name = host.encode("ascii")
+    sni = struct.pack("!HBH", len(name) + 3, 0, len(name)) + name
+    exts = struct.pack("!HH", 0, len(sni)) + sni
+    body = (b"\x03\x03" + bytes(32) + b"\x00" + struct.pack("!H", 2) + b"\x13\x01" + b"\x01\x00"
+            + struct.pack("!H", len(exts)) + exts)
+    handshake = b"\x01" + struct.pack("!I", len(body))[1:] + body
+    return b"\x16\x03\x01" + struct.pack("!H", len(handshake)) + handshake
+
+
+def test_dns_answers_map_to_the_queried_name():
+    tracker = Tracker()
+    tracker.processPacket(packet("udp", RESOLVER_IP, DEV_IP, 53, 40000,
+                                 dns_response("api.example.com", ["1.2.3.4", "1.2.3.5"],
+                                              cname="edge.cdn.example.net")))
+    assert tracker.getHosts() == [("1.2.3.4", "api.example.com"), ("1.2.3.5", "api.example.com")]
+    assert tracker.getQuestion("1.2.3.4", "edge.cdn.example.net") == "api.example.com"
+    assert tracker.getQuestion("1.2.3.4", "other.example.com") is None
+
+
+def test_dns_over_tcp_and_queries():
+    tracker = Tracker()
+    response = dns_response("tcp.example.com", ["5.6.7.8"])
+    tracker.processPacket(packet("tcp", RESOLVER_IP, DEV_IP, 53, 40000,
+                                 struct.pack("!H", len(response)) + response))
+    #A query, with the response flag clear, is not an answer
+    query = bytearray(dns_response("query.example.com", ["9.9.9.9"]))
+    query[2:4] = b"\x01\x00"
+    tracker.processPacket(packet("udp", RESOLVER_IP, DEV_IP, 53, 40000, bytes(query)))
+    assert tracker.getHosts() == [("5.6.7.8", "tcp.example.com")]
+
+
+def test_server_names_for_addresses_not_in_dns():
+    tracker = Tracker()
+    tracker.processPacket(packet("udp", RESOLVER_IP, DEV_IP, 53, 40000, dns_response("dns.example.com",
+                                                                                     ["1.1.1.1"])))
+    tracker.processPacket(packet("tcp", DEV_IP, "1.1.1.1", 40001, 443, client_hello("sni.example.com")))
+    tracker.processPacket(packet("tcp", DEV_IP, "2.2.2.2", 40002, 443, client_hello("sni.example.com")))
+    tracker.processPacket(packet("tcp", DEV_IP, "3.3.3.3", 40003, 80,
+                                 b"GET / HTTP/1.1\r\nHost: web.example.com:8080\r\n\r\n"))
+    assert tracker.getHosts() == [("1.1.1.1", "dns.example.com"), ("2.2.2.2", "sni.example.com"),
+                                  ("3.3.3.3", "web.example.com")]
+
+
+def test_malformed_payloads_are_ignored():
+    tracker = Tracker()
+    response = dns_response("cut.example.com", ["1.2.3.4"])
+    tracker.processPacket(packet("udp", RESOLVER_IP, DEV_IP, 53, 40000, response[:20]))
+    tracker.processPacket(packet("tcp", DEV_IP, "2.2.2.2", 40002, 443, client_hello("cut.example.com")[:30]))
+    #A name compression pointer to itself
+    looping = struct.pack("!HHHHHH", 1, 0x8180, 1, 0, 0, 0) + b"\xc0\x0c"
+    tracker.processPacket(packet("udp", RESOLVER_IP, DEV_IP, 53, 40000, looping))
+    #A and AAAA answers whose address has the wrong length
+    for rr_type, rdata in ((1, b"\x01\x02\x03\x04\x05"), (28, bytes(4))):
+        bad_length = (struct.pack("!HHHHHH", 1, 0x8180, 1, 1, 0, 0) + dns_name("bad.example.com")
+                      + struct.pack("!HH", 1, 1) + b"\xc0\x0c"
+                      + struct.pack("!HHIH", rr_type, 1, 300, len(rdata)) + rdata)
+        tracker.processPacket(packet("udp", RESOLVER_IP, DEV_IP, 53, 40000, bad_length))
+    assert tracker.getHosts() == []
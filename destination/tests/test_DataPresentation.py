@@ -0,0 +1,164 @@
+import os
+
+import numpy as np
+import pytest
+
+from trafficAnalyzer import Constants
+from trafficAnalyzer.DataPresentation import BarPlot, DomainExport, LinePlot, WindowExport
+from trafficAnalyzer.Device import Devices
+from trafficAnalyzer.Node import Nodes
+from trafficAnalyzer.PcapReader import FrameInfo, Layer, Packet
+
+CAMERA = "00:00:00:00:00:01"
+ROUTER = "00:00:00:00:00:fe"
+
+
+def write(path, text):
+    path.write_text(text)
+    return str(path)
+
+
+def test_sort_csv_sorts_rows_after_header(tmp_path):
+    out = write(tmp_path / "out.csv", "h1,h2\nc,3\na,2\nb,1\n")
+    DomainExport.sort_csv(out)
+    assert open(out).read() == "h1,h2\na,2\nb,1\nc,3\n"
+
+
+def test_sort_csv_keeps_rows_after_blank_lines_across_chunks(tmp_path):
+    out = write(tmp_path / "out.csv", "h1,h2\nb,1\n\na,2\nc,3\n\n\nd,4\ne,5\n\n")
+    DomainExport.sort_csv(out, chunk_rows=2)
+    assert open(out).read() == "h1,h2\na,2\nb,1\nc,3\nd,4\ne,5\n"
+
+
+def test_sort_csv_with_exact_chunks(tmp_path):
+    out = write(tmp_path / "out.csv", "h\nd\nc\nb\na\n")
+    DomainExport.sort_csv(out, chunk_rows=2)
+    assert open(out).read() == "h\na\nb\nc\nd\n"
+
+
+def test_sort_csv_header_only(tmp_path):
+    out = write(tmp_path / "out.csv", "h1,h2\n\n")
+    DomainExport.sort_csv(out, chunk_rows=2)
+    assert open(out).read() == "h1,h2\n"
+
+
+def test_remove_rows_matches_normalised_paths(tmp_path, monkeypatch):
+    (tmp_path / "in").mkdir()
+    for name in ("a.pcap", "b.pcap"):
+        (tmp_path / "in" / name).write_bytes(b"")
+    a = str(tmp_path / "in" / "a.pcap")
+    out = write(tmp_path / "out.csv", "ts,input_file\n1,%s\n2,in//a.pcap\n3,in/b.pcap\n\n" % a)
+
+    monkeypatch.chdir(tmp_path)
+    DomainExport.remove_rows(out, ["./in/../in/a.pcap"])
+    assert open(out).read() == "ts,input_file\n3,in/b.pcap\n\n"
+
+
+def test_merge_csv_merges_sorted_files(tmp_path):
+    parts = [write(tmp_path / "s1.csv", "h1,h2\na,1\nc,3\n\n"),
+             write(tmp_path / "s2.csv", "h1,h2\nb,2\nd,4\n"),
+             write(tmp_path / "s3.csv", "h1,h2\n")]
+    out = write(tmp_path / "out.csv", "old\n")
+    DomainExport.merge_csv(out, parts)
+    assert open(out).read() == "h1,h2\na,1\nb,2\nc,3\nd,4\n"
+
+
+def test_merge_csv_rejects_unsorted_file(tmp_path):
+    parts = [write(tmp_path / "s1.csv", "h\na\nc\n"), write(tmp_path / "s2.csv", "h\nd\nb\n")]
+    out = write(tmp_path / "out.csv", "old\n")
+    with pytest.raises(ValueError, match="is not sorted"):
+        DomainExport.merge_csv(out, parts)
+    assert open(out).read() == "old\n"
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["out.csv", "s1.csv", "s2.csv"]
+
+
+def test_merge_csv_rejects_different_columns(tmp_path):
+    parts = [write(tmp_path / "s1.csv", "h1,h2\na,1\n"), write(tmp_path / "s2.csv", "h1,h3\nb,2\n")]
+    out = str(tmp_path / "out.csv")
+    with pytest.raises(ValueError, match="same columns"):
+        DomainExport.merge_csv(out, parts)
+    assert not os.path.exists(out)
+
+
+class Axes(object):
+    def __init__(self):
+        self.ylabel = None
+
+    def set_ylabel(self, label):
+        self.ylabel = label
+
+
+def test_line_plot_downsample_keeps_extremes():
+    plot = LinePlot({}, Axes())
+    plot.x = [np.arange(100, dtype="float64"), np.arange(3, dtype="float64")]
+    plot.y = [np.arange(100) % 7, np.array([5, 1, 3])]
+    plot.downsample(10)
+
+    assert len(plot.x[0]) <= 20
+    assert plot.y[0].min() == 0 and plot.y[0].max() == 6
+    assert np.all(np.diff(plot.x[0]) > 0)
+    #Series with fewer points than two per bucket are left as they are
+    assert plot.y[1].tolist() == [5, 1, 3]
+
+
+def test_bar_plot_downsample_keeps_totals():
+    ax = Axes()
+    plot = BarPlot({}, ax)
+    plot.x = [np.arange(25, dtype="float64"), np.arange(10, dtype="float64")]
+    plot.y = [np.arange(25), np.full(10, 3)]
+    plot.downsample(10)
+
+    #25 packets in at most 10 bars means 3 packets per bar
+    assert plot.x[0].tolist() == list(range(0, 25, 3))
+    assert plot.y[0].sum() == sum(range(25))
+    assert plot.y[0].tolist()[:2] == [0 + 1 + 2, 3 + 4 + 5]
+    assert plot.y[1].tolist() == [9, 9, 9, 3]
+    assert ax.ylabel == "Total Packet Size per 3 Packets (bytes)"
+
+
+def test_bar_plot_downsample_leaves_few_packets():
+    ax = Axes()
+    plot = BarPlot({}, ax)
+    plot.x = [np.arange(5, dtype="float64")]
+    plot.y = [np.arange(5)]
+    plot.downsample(10)
+
+    assert plot.y[0].tolist() == [0, 1, 2, 3, 4]
+    assert ax.ylabel is None
+
+
+def test_window_export_round_trip(tmp_path):
+    devices_file = tmp_path / "devices.txt"
+    devices_file.write_text("0:0:0:0:0:1 camera\n")
+    nodes = Nodes(devices=Devices(str(devices_file)), series=Constants.Series.NONE, window=10)
+    for epoch, src, dst, length in [(100.0, CAMERA, ROUTER, 60), (105.0, CAMERA, ROUTER, 40),
+                                    (112.0, ROUTER, CAMERA, 1500), (131.0, CAMERA, ROUTER, 80)]:
+        packet = Packet(FrameInfo(epoch, length, 1))
+        packet.addLayer(Layer(Constants.Layer.ETH, src=src, dst=dst, type=0x0800))
+        nodes.processPacket(packet)
+
+    we = WindowExport(10)
+    for node_stats in nodes:
+        we.loadWindowsFor(node_stats.stats.stats, "eth", "camera")
+    window_file = WindowExport.window_file(str(tmp_path / "out_windows"), "in/a b.pcap")
+    we.save(window_file, "in/a b.pcap")
+
+    assert window_file == str(tmp_path / "out_windows" / "in_a_b.pcap.npz")
+    assert os.listdir(str(tmp_path / "out_windows")) == ["in_a_b.pcap.npz"]
+    with np.load(window_file) as data:
+        assert set(data.files) == set(WindowExport.COLUMNS) | {"window", "input_file"}
+        rows = list(zip(*[data[column].tolist() for column in WindowExport.COLUMNS]))
+        assert float(data["window"]) == 10.0
+        assert str(data["input_file"]) == "in/a b.pcap"
+    assert rows == [(100.0, "camera", "snd", ROUTER, 2, 100),
+                    (110.0, "camera", "rcv", ROUTER, 1, 1500),
+                    (130.0, "camera", "snd", ROUTER, 1, 80)]
+
+
+def test_window_export_without_windows(tmp_path):
+    window_file = str(tmp_path / "empty.npz")
+    WindowExport(60).save(window_file, "a.pcap")
+
+    with np.load(window_file) as data:
+        assert all(len(data[column]) == 0 for column in WindowExport.COLUMNS)
+        assert float(data["window"]) == 60.0
@@ -0,0 +1,120 @@
+import multiprocessing
+import threading
+import time
+
+from trafficAnalyzer.IP import HostCache, HostEnricher, RateLimiter
+
+
+'''
+Stub reverse DNS: "name" addresses have a name, "none" addresses have
+none, "error" lookups fail, "slow" lookups take 0.2 seconds and "hang"
+lookups only return once the test releases them.
+'''
+class StubResolver(object):
+    def __init__(self):
+        self.release = threading.Event()
+        self.calls = []
+
+    def __call__(self, ip):
+        self.calls.append(ip)
+        kind = ip.split("-")[0]
+        if kind == "hang":
+            self.release.wait(10)
+        elif kind == "slow":
+            time.sleep(0.2)
+        elif kind == "error":
+            raise OSError("temporary failure")
+        elif kind == "none":
+            return ""
+        return "host." + ip
+
+
+def test_resolve_with_stub(tmp_path):
+    stub = StubResolver()
+    cache = HostCache(str(tmp_path / "hosts.sqlite"))
+    enricher = HostEnricher(cache, timeout=1, workers=4, lookups={HostEnricher.HOST: stub})
+    enricher.resolve(["name-1", "name-2", "none-1", "error-1", "name-1"], HostEnricher.HOST)
+
+    assert enricher.get(HostEnricher.HOST, "name-1") == "host.name-1"
+    assert enricher.get(HostEnricher.HOST, "none-1") == "N/A"
+    assert enricher.get(HostEnricher.HOST, "error-1") == "N/A"
+    assert sorted(stub.calls) == ["error-1", "name-1", "name-2", "none-1"]
+
+    #Names and addresses without one are cached; failed lookups are not
+    assert cache.getMany(HostEnricher.HOST, ["name-1", "name-2", "none-1", "error-1"]) == {
+        "name-1": "host.name-1", "name-2": "host.name-2", "none-1": "N/A"}
+
+
+def test_timeout_is_per_lookup():
+    stub = StubResolver()
+    enricher = HostEnricher(timeout=0.3, workers=1, lookups={HostEnricher.HOST: stub})
+    ips = ["hang-1"] + ["slow-%s" % i for i in range(3)]
+    start = time.monotonic()
+    try:
+        enricher.resolve(ips, HostEnricher.HOST)
+    finally:
+        stub.release.set()
+
+    #The hung lookup times out on its own and a new thread does the others
+    assert time.monotonic() - start < 2
+    assert enricher.get(HostEnricher.HOST, "hang-1") == "N/A"
+    for ip in ips[1:]:
+        assert enricher.get(HostEnricher.HOST, ip) == "host." + ip
+
+
+def test_timed_out_thread_takes_no_new_lookups():
+    stub = StubResolver()
+    running = []
+    most = [0]
+    lock = threading.Lock()
+
+    def lookup(ip):
+        if not ip.startswith("hang"):
+            with lock:
+                running.append(ip)
+                most[0] = max(most[0], len(running))
+        try:
+            return stub(ip)
+        finally:
+            if not ip.startswith("hang"):
+                with lock:
+                    running.remove(ip)
+
+    enricher = HostEnricher(timeout=0.2, workers=1, lookups={HostEnricher.HOST: lookup})
+    #The hung lookup returns while the thread that replaced it is still busy
+    threading.Timer(0.5, stub.release.set).start()
+    enricher.resolve(["hang-1"] + ["slow-%s" % i for i in range(5)], HostEnricher.HOST)
+    assert most[0] == 1
+
+
+def test_hung_lookup_does_not_block_exit():
+    stub = StubResolver()
+    enricher = HostEnricher(timeout=0.1, workers=2, lookups={HostEnricher.HOST: stub})
+    try:
+        enricher.resolve(["hang-1"], HostEnricher.HOST)
+        hung = [t for t in threading.enumerate() if t is not threading.current_thread() and t.is_alive()
+                and not t.daemon]
+        assert hung == []
+    finally:
+        stub.release.set()
+
+
+def wait_times(limiter, calls, times):
+    for _ in range(calls):
+        limiter.wait()
+        times.put(time.monotonic())
+
+
+def test_rate_limiter_is_shared_by_processes():
+    limiter = RateLimiter(20)
+    times = multiprocessing.get_context("fork").Queue()
+    procs = [multiprocessing.get_context("fork").Process(target=wait_times, args=(limiter, 5, times))
+             for _ in range(3)]
+    for p in procs:
+        p.start()
+    stamps = sorted(times.get(timeout=10) for _ in range(15))
+    for p in procs:
+        p.join()
+
+    #15 calls at 20 per second take 0.7 seconds, not 0.2 as with a limiter per process
+    assert stamps[-1] - stamps[0] >= 0.65
@@ -0,0 +1,117 @@
+import os
+
+import pytest
+
+from trafficAnalyzer.DataPresentation import DomainExport
+from trafficAnalyzer.Journal import Journal
+from trafficAnalyzer.Manifest import Manifest
+
+HEADER = "ts,input_file\n"
+
+
+def setup_output(tmp_path):
+    out = tmp_path / "out.csv"
+    out.write_text(HEADER)
+    pcaps = []
+    for name in ("a.pcap", "b.pcap"):
+        (tmp_path / name).write_bytes(name.encode())
+        pcaps.append(str(tmp_path / name))
+    journal = Journal.forOutput(str(out))
+    journal.reset()
+    return str(out), journal, Manifest.forOutput(str(out)), pcaps
+
+
+def append_rows(out, journal, manifest, pcap, rows, commit=True, add=True):
+    with open(out, "a") as f:
+        f.write(rows)
+        f.flush()
+        info = Manifest.fileInfo(pcap)
+        if commit:
+            journal.commit(info, f.tell())
+        if commit and add:
+            manifest.add(info)
+
+
+def test_recover_removes_uncommitted_rows(tmp_path):
+    out, journal, manifest, (a, b) = setup_output(tmp_path)
+    append_rows(out, journal, manifest, a, "1,a\n")
+    append_rows(out, journal, manifest, b, "2,b\n3,b", commit=False)
+
+    removed = journal.recover(Manifest.forOutput(out))
+    assert removed == len("2,b\n3,b")
+    assert open(out).read() == HEADER + "1,a\n"
+    assert journal.recover(Manifest.forOutput(out)) == 0
+
+
+def test_recover_adds_committed_files_missing_from_manifest(tmp_path):
+    out, journal, manifest, (a, b) = setup_output(tmp_path)
+    append_rows(out, journal, manifest, a, "1,a\n")
+    append_rows(out, journal, manifest, b, "2,b\n", add=False)
+
+    reloaded = Manifest.forOutput(out)
+    assert b not in reloaded
+    journal.recover(reloaded)
+    assert open(out).read() == HEADER + "1,a\n2,b\n"
+    assert Manifest.forOutput(out).isCurrent(Manifest.fileInfo(b))
+
+
+def test_recover_keeps_rewritten_file(tmp_path):
+    out, journal, manifest, (a, b) = setup_output(tmp_path)
+    append_rows(out, journal, manifest, a, "1,a\n")
+    journal.rewrite()
+    #The rewrite replaced the file with a longer one before the checkpoint was written
+    with open(out, "w") as f:
+        f.write(HEADER + "\"1\",a\n")
+
+    assert journal.recover(Manifest.forOutput(out)) == 0
+    assert open(out).read() == HEADER + "\"1\",a\n"
+
+
+@pytest.mark.parametrize("rows_removed", [False, True])
+def test_recover_finishes_interrupted_removal(tmp_path, rows_removed):
+    out, journal, manifest, (a, b) = setup_output(tmp_path)
+    append_rows(out, journal, manifest, a, "1,%s\n" % a)
+    append_rows(out, journal, manifest, b, "2,%s\n" % b)
+
+    #A run analyzing a again died after starting to remove its rows, before
+    #its manifest entry was removed
+    journal.rewrite([a])
+    if rows_removed:
+        DomainExport.remove_rows(out, [a])
+
+    reloaded = Manifest.forOutput(out)
+    assert journal.recover(reloaded) == 0
+    assert open(out).read() == HEADER + "2,%s\n" % b
+    for loaded in (reloaded, Manifest.forOutput(out)):
+        assert a not in loaded
+        assert loaded.isCurrent(Manifest.fileInfo(b))
+
+
+def test_recover_without_commits_keeps_file(tmp_path):
+    out = tmp_path / "out.csv"
+    out.write_text(HEADER + "1,a\n")
+    journal = Journal.forOutput(str(out))
+    assert journal.recover(Manifest.forOutput(str(out))) == 0
+    assert out.read_text() == HEADER + "1,a\n"
+    assert os.path.isfile(journal.fileName)
+
+
+def test_failures_and_warnings_of_last_run(tmp_path):
+    out, journal, manifest, (a, b) = setup_output(tmp_path)
+    journal.start(1)
+    journal.begin(a, "P0")
+    journal.fail(a, "P0", "old error")
+
+    journal.start(3)
+    journal.begin(a, "P0")
+    journal.fail(a, "P0", "PcapError: bad file")
+    journal.begin(b, "P1")
+    append_rows(out, journal, manifest, b, "2,b\n")
+    journal.warn(b, "P1", "Plots not generated")
+    journal.fail(b, "P1", "a failure after the commit")
+    journal.begin("c.pcap", "P2")
+
+    assert journal.failures({"P2": -9}) == [
+        (a, "PcapError: bad file"),
+        ("c.pcap", "the process P2 analyzing it exited with code -9")]
+    assert journal.warnings() == [(b, "Plots not generated")]
@@ -0,0 +1,85 @@
+import json
+import os
+
+from trafficAnalyzer.Manifest import Manifest
+
+
+def make_pcap(tmp_path, name="a.pcap", data=b"pcap"):
+    pcap_dir = tmp_path / "in"
+    pcap_dir.mkdir(exist_ok=True)
+    pcap = pcap_dir / name
+    pcap.write_bytes(data)
+    return str(pcap)
+
+
+def test_entries_survive_reload(tmp_path):
+    pcap = make_pcap(tmp_path)
+    manifest = Manifest.forOutput(str(tmp_path / "out.csv"))
+    manifest.add(Manifest.fileInfo(pcap))
+
+    reloaded = Manifest.forOutput(str(tmp_path / "out.csv"))
+    assert reloaded.isCurrent(Manifest.fileInfo(pcap))
+    assert pcap in reloaded
+
+
+def test_paths_are_normalised(tmp_path, monkeypatch):
+    pcap = make_pcap(tmp_path)
+    manifest = Manifest.forOutput(str(tmp_path / "out.csv"))
+    manifest.add(Manifest.fileInfo(pcap))
+
+    monkeypatch.chdir(tmp_path / "in")
+    assert manifest.isCurrent(Manifest.fileInfo("a.pcap"))
+    assert manifest.isCurrent(Manifest.fileInfo(".//a.pcap"))
+    assert manifest.isCurrent(Manifest.fileInfo("../in/a.pcap"))
+    os.symlink(str(tmp_path / "in"), str(tmp_path / "link"))
+    assert manifest.isCurrent(Manifest.fileInfo(str(tmp_path / "link" / "a.pcap")))
+
+
+def test_relative_entries_are_normalised_on_load(tmp_path, monkeypatch):
+    pcap = make_pcap(tmp_path)
+    info = Manifest.fileInfo(pcap)
+    info["path"] = "in//a.pcap"
+    (tmp_path / "out_manifest.jsonl").write_text(json.dumps(info) + "\n")
+
+    monkeypatch.chdir(tmp_path)
+    manifest = Manifest.forOutput("out.csv")
+    assert manifest.isCurrent(Manifest.fileInfo(pcap))
+
+
+def test_changed_file_is_not_current(tmp_path):
+    pcap = make_pcap(tmp_path)
+    manifest = Manifest.forOutput(str(tmp_path / "out.csv"))
+    manifest.add(Manifest.fileInfo(pcap))
+    with open(pcap, "ab") as f:
+        f.write(b"more")
+    assert not manifest.isCurrent(Manifest.fileInfo(pcap))
+    assert pcap in manifest
+
+
+def test_remove_and_cut_lines(tmp_path):
+    a = make_pcap(tmp_path, "a.pcap")
+    b = make_pcap(tmp_path, "b.pcap")
+    manifest = Manifest.forOutput(str(tmp_path / "out.csv"))
+    manifest.add(Manifest.fileInfo(a))
+    manifest.add(Manifest.fileInfo(b))
+    manifest.remove([a])
+    with open(manifest.fileName, "a") as f:
+        f.write('{"path": "cut')
+
+    reloaded = Manifest.forOutput(str(tmp_path / "out.csv"))
+    assert a not in reloaded
+    assert b in reloaded
+
+
+def test_merge_replaces_entries(tmp_path):
+    a = make_pcap(tmp_path, "a.pcap")
+    b = make_pcap(tmp_path, "b.pcap")
+    shards = [Manifest.forOutput(str(tmp_path / ("shard%s.csv" % i))) for i in (1, 2)]
+    shards[0].add(Manifest.fileInfo(a))
+    shards[1].add(Manifest.fileInfo(b))
+    merged = Manifest.forOutput(str(tmp_path / "out.csv"))
+    merged.add(Manifest.fileInfo(make_pcap(tmp_path, "old.pcap")))
+    merged.merge(shards)
+
+    reloaded = Manifest.forOutput(str(tmp_path / "out.csv"))
+    assert sorted(reloaded.entries) == sorted([Manifest.key(a), Manifest.key(b)])
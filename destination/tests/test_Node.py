@@ -0,0 +1,66 @@
+import pytest
+
+from trafficAnalyzer import Constants
+from trafficAnalyzer.Device import Devices
+from trafficAnalyzer.Node import Nodes
+from trafficAnalyzer.PcapReader import FrameInfo, Layer, Packet
+
+CAMERA = "00:00:00:00:00:01"
+PLUG = "00:00:00:00:00:02"
+ROUTER = "00:00:00:00:00:fe"
+OTHER = "00:00:00:00:00:fd"
+
+
+@pytest.fixture
+def nodes(tmp_path):
+    devices_file = tmp_path / "devices.txt"
+    devices_file.write_text("0:0:0:0:0:1 camera\n0:0:0:0:0:2 plug\n")
+    return Nodes(devices=Devices(str(devices_file)))
+
+
+def packet(src, dst, length=100):
+    packet = Packet(FrameInfo(1.0, length, 1))
+    packet.addLayer(Layer(Constants.Layer.ETH, src=src, dst=dst, type=0x0800))
+    return packet
+
+
+#The per address packet counts of each device and direction
+def counts(nodes):
+    return {(node.nodeId.deviceName, key): dict(stats.addrpcktnum)
+            for node in nodes for key, stats in node.stats.stats.items()}
+
+
+def test_device_packets_go_to_their_device(nodes):
+    nodes.processPacket(packet(CAMERA, ROUTER))
+    nodes.processPacket(packet(ROUTER, CAMERA))
+    nodes.processPacket(packet(ROUTER, CAMERA))
+
+    assert set(node.nodeId.mac for node in nodes) == {CAMERA}
+    assert counts(nodes) == {("camera", "eth-snd"): {ROUTER: 1}, ("camera", "eth-rcv"): {ROUTER: 2}}
+
+
+def test_packet_between_devices_counts_once_for_each(nodes):
+    nodes.processPacket(packet(CAMERA, PLUG, 60))
+
+    assert counts(nodes) == {("camera", "eth-snd"): {"plug": 1}, ("plug", "eth-rcv"): {"camera": 1}}
+    assert nodes[CAMERA].stats.stats["eth-snd"].addrpcktsize == {"plug": 60}
+    assert nodes[PLUG].stats.stats["eth-rcv"].addrpcktsize == {"camera": 60}
+
+
+def test_packet_between_unknown_macs_is_ignored(nodes):
+    nodes.processPacket(packet(ROUTER, OTHER))
+    nodes.processPacket(packet(OTHER, OTHER))
+
+    assert list(nodes) == []
+
+
+def test_packet_to_itself_counts_once(nodes):
+    nodes.processPacket(packet(PLUG, PLUG))
+
+    assert counts(nodes) == {("plug", "eth-snd"): {"plug": 1}}
+
+
+def test_packet_without_eth_is_ignored(nodes):
+    nodes.processPacket(Packet(FrameInfo(1.0, 100, 1)))
+
+    assert list(nodes) == []
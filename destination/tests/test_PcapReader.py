@@ -0,0 +1,147 @@
+import socket
+import struct
+
+import pytest
+
+from trafficAnalyzer.PcapReader import PcapError, PcapReader
+
+DEV_MAC = "02:00:00:00:00:0a"
+GW_MAC = "02:00:00:00:00:01"
+
+
+def ethernet(src_mac, dst_mac, eth_type, payload):
+    return (bytes.fromhex(dst_mac.replace(":", "")) + bytes.fromhex(src_mac.replace(":", ""))
+            + struct.pack("!H", eth_type) + payload)
+
+
+def udp_ipv4(src_ip, dst_ip, sport, dport, payload):
+    segment = struct.pack("!HHHH", sport, dport, 8 + len(payload), 0) + payload
+    return (struct.pack("!BBHHHBBH", 0x45, 0, 20 + len(segment), 0, 0, 64, 17, 0)
+            + socket.inet_aton(src_ip) + socket.inet_aton(dst_ip) + segment)
+
+
+def tcp_ipv6(src_ip, dst_ip, sport, dport, payload):
+    segment = struct.pack("!HHIIBBHHH", sport, dport, 1, 1, 5 << 4, 0x18, 65535, 0, 0) + payload
+    return (struct.pack("!IHBB", 6 << 28, len(segment), 6, 64) + socket.inet_pton(socket.AF_INET6, src_ip)
+            + socket.inet_pton(socket.AF_INET6, dst_ip) + segment)
+
+
+def write_pcap(path, frames, tail=b"", link_type=1):
+    with open(path, "wb") as f:
+        f.write(struct.pack("<IHHiIII", 0xA1B2C3D4, 2, 4, 0, 0, 65535, link_type))
+        for ts, frame in frames:
+            sec = int(ts)
+            f.write(struct.pack("<IIII", sec, int(round((ts - sec) * 1e6)), len(frame), len(frame)))
+            f.write(frame)
+        f.write(tail)
+    return str(path)
+
+
+def write_pcapng(path, frames):
+    def block(block_type, body):
+        body += bytes(-len(body) % 4)
+        return struct.pack("<II", block_type, len(body) + 12) + body + struct.pack("<I", len(body) + 12)
+
+    with open(path, "wb") as f:
+        f.write(block(0x0A0D0D0A, struct.pack("<IHHq", 0x1A2B3C4D, 1, 0, -1)))
+        f.write(block(0x00000001, struct.pack("<HHI", 1, 0, 65535)))
+        for ts, frame in frames:
+            usec = int(round(ts * 1e6))
+            f.write(block(0x00000006, struct.pack("<IIIII", 0, usec >> 32, usec & 0xFFFFFFFF,
+                                                  len(frame), len(frame)) + frame))
+    return str(path)
+
+
+FRAMES = [
+    (1556329377.25, ethernet(DEV_MAC, GW_MAC, 0x0800, udp_ipv4("192.168.0.10", "192.168.0.1", 40000, 53,
+                                                                 b"query"))),
+    (1556329378.5, ethernet(GW_MAC, DEV_MAC, 0x86DD, tcp_ipv6("2001:db8::1", "2001:db8::10", 443, 40001,
+                                                                bytes(100)))),
+]
+
+
+def check_packets(packets):
+    assert len(packets) == 2
+    udp, tcp = packets
+    assert abs(udp.frame_info.time_epoch - 1556329377.25) < 1e-6
+    assert udp.eth.src == DEV_MAC and udp.eth.dst == GW_MAC
+    assert (udp.ip.src, udp.ip.dst) == ("192.168.0.10", "192.168.0.1")
+    assert (udp.udp.srcport, udp.udp.dstport) == (40000, 53)
+    assert udp.payload == b"query"
+    assert [layer.layer_name for layer in udp.layers] == ["eth", "ip", "udp"]
+
+    assert tcp.eth.src == GW_MAC
+    assert (tcp.ipv6.src, tcp.ipv6.dst) == ("2001:db8::1", "2001:db8::10")
+    assert (tcp.tcp.srcport, tcp.tcp.dstport, tcp.tcp.len) == (443, 40001, 100)
+    assert tcp.length == len(FRAMES[1][1])
+
+
+def test_read_pcap(tmp_path):
+    with PcapReader(write_pcap(tmp_path / "a.pcap", FRAMES)) as cap:
+        check_packets(list(cap))
+        assert cap.runts == 0 and not cap.truncated
+
+
+def test_read_pcapng(tmp_path):
+    with PcapReader(write_pcapng(tmp_path / "a.pcapng", FRAMES)) as cap:
+        check_packets(list(cap))
+        assert cap.runts == 0 and not cap.truncated
+
+
+def test_runt_frames_are_skipped_and_counted(tmp_path):
+    frames = [(1556329377.0, b"\x02\x00\x00"), FRAMES[0], (1556329378.0, bytes(13)), FRAMES[1]]
+    with PcapReader(write_pcap(tmp_path / "a.pcap", frames)) as cap:
+        packets = list(cap)
+        check_packets(packets)
+        assert cap.runts == 2
+        #Frame numbers still count the skipped frames, as in Wireshark
+        assert [p.frame_info.number for p in packets] == [2, 4]
+
+
+def test_truncated_last_record(tmp_path):
+    cut_record = struct.pack("<IIII", 1556329379, 0, 60, 60) + bytes(30)
+    with PcapReader(write_pcap(tmp_path / "a.pcap", FRAMES, cut_record)) as cap:
+        check_packets(list(cap))
+        assert cap.truncated
+
+    with PcapReader(write_pcap(tmp_path / "b.pcap", FRAMES, bytes(10))) as cap:
+        check_packets(list(cap))
+        assert cap.truncated
+
+
+def test_empty_file(tmp_path):
+    (tmp_path / "empty.pcap").write_bytes(b"")
+    with PcapReader(str(tmp_path / "empty.pcap")) as cap:
+        assert list(cap) == []
+
+
+#The Linux cooked capture frames of FRAMES: the sender of the first one is the
+#capturing host (outgoing), the second one is received from the gateway
+def cooked_frames(sll2):
+    frames = []
+    for (ts, frame), packet_type in zip(FRAMES, (4, 0)):
+        src, eth_type, payload = frame[6:12], frame[12:14], frame[14:]
+        if sll2:
+            header = eth_type + bytes(2) + struct.pack("!IHBB", 2, 1, packet_type, 6) + src + bytes(2)
+        else:
+            header = struct.pack("!HHH", packet_type, 1, 6) + src + bytes(2) + eth_type
+        frames.append((ts, header + payload))
+    return frames
+
+
+def test_read_linux_cooked_captures(tmp_path):
+    for sll2, link_type in ((False, 113), (True, 276)):
+        frames = cooked_frames(sll2) + [(1556329379.0, bytes(15 if sll2 else 12))]
+        with PcapReader(write_pcap(tmp_path / ("%s.pcap" % link_type), frames, link_type=link_type)) as cap:
+            udp, tcp = list(cap)
+            assert cap.runts == 1
+        assert (udp.eth.src, udp.eth.dst, udp.eth.type) == (DEV_MAC, "", 0x0800)
+        assert (udp.ip.src, udp.udp.dstport, udp.payload) == ("192.168.0.10", 53, b"query")
+        assert (tcp.eth.src, tcp.eth.dst) == (GW_MAC, "")
+        assert (tcp.ipv6.dst, tcp.tcp.len) == ("2001:db8::10", 100)
+
+
+def test_unsupported_link_type(tmp_path):
+    with PcapReader(write_pcap(tmp_path / "wifi.pcap", FRAMES, link_type=105)) as cap:
+        with pytest.raises(PcapError, match="unsupported link type 105"):
+            list(cap)
@@ -0,0 +1,28 @@
+from trafficAnalyzer.IP import PrefixIndex
+
+
+def test_prefix_index_longest_match(tmp_path):
+    table = tmp_path / "prefixes.csv"
+    table.write_text("prefix,start,end,org\n"
+                     "10.0.0.0/8,,,big\n"
+                     "10.1.0.0/16,,,small\n"
+                     "10.1.0.0/16,,,duplicate\n"
+                     ",192.168.0.0,192.168.2.255,range\n"
+                     "2001:db8::/32,,,v6\n"
+                     "2001:db8:1::/48,,,v6-small\n")
+    index = PrefixIndex()
+    index.loadCsv(str(table))
+
+    #192.168.0.0-192.168.2.255 is split into a /23 and a /24, and the first
+    #row of a network wins
+    assert len(index) == 6
+    assert index.lookup("10.1.2.3")["org"] == "small"
+    assert index.lookup("10.2.0.1")["org"] == "big"
+    assert index.lookup("192.168.1.7")["org"] == "range"
+    assert index.lookup("192.168.2.255")["org"] == "range"
+    assert index.lookup("192.168.3.0") is None
+    assert index.lookup("2001:db8:1::5")["org"] == "v6-small"
+    assert index.lookup("2001:db8:2::5")["org"] == "v6"
+    assert index.lookup("2001:db9::1") is None
+    assert index.lookup("not an address") is None
+    assert index.lookup(None) is None
@@ -0,0 +1,154 @@
+import random
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from trafficAnalyzer import Constants, Stats
+from trafficAnalyzer.PcapReader import Layer
+from trafficAnalyzer.Stats import StatsMerge
+
+
+#The alignment done one point at a time, as mergeStats documents it
+def merge_reference(x1, x2, y1_list, y2):
+    x = sorted(x1 + x2)
+    y_list = []
+    for xs, ys in [(x1, y1) for y1 in y1_list] + [(x2, y2)]:
+        last = dict(zip(xs, ys))
+        y_list.append([last.get(v, 0) for v in x])
+    return x, y_list
+
+
+def test_merge_stats_aligns_series():
+    x, y_list = StatsMerge().mergeStats([1, 3, 3], [2, 3], [[10, 30, 31], [1, 2, 3]], [20, 32])
+    assert x.tolist() == [1, 2, 3, 3, 3]
+    assert [y.tolist() for y in y_list] == [[10, 0, 31, 31, 31], [1, 0, 3, 3, 3], [0, 20, 32, 32, 32]]
+
+
+def test_merge_stats_with_empty_series():
+    x, y_list = StatsMerge().mergeStats([], [5.0, 4.0], [], np.array([1, 2]))
+    assert x.tolist() == [4.0, 5.0]
+    assert [y.tolist() for y in y_list] == [[2, 1]]
+
+    x, y_list = StatsMerge().mergeStats([5.0], [], [np.array([7])], np.array([], dtype=int))
+    assert x.tolist() == [5.0]
+    assert [y.tolist() for y in y_list] == [[7], [0]]
+
+
+def test_merge_stats_matches_reference():
+    rng = random.Random(1)
+    sm = StatsMerge()
+    for _ in range(50):
+        x1 = [rng.randint(0, 20) for _ in range(rng.randint(0, 30))]
+        x2 = [rng.randint(0, 20) for _ in range(rng.randint(0, 30))]
+        y1_list = [[rng.randint(1, 100) for _ in x1] for _ in range(rng.randint(1, 3))]
+        y2 = [rng.randint(1, 100) for _ in x2]
+
+        x, y_list = sm.mergeStats(x1, x2, y1_list, y2)
+        ref_x, ref_y_list = merge_reference(x1, x2, y1_list, y2)
+        assert x.tolist() == ref_x
+        assert [y.tolist() for y in y_list] == ref_y_list
+
+
+#A node, packet and layer with only what StatsData.processLayer reads
+def process_packets(series, packets, window=None):
+    node = SimpleNamespace(series=series, window=window, baseTS=100.0)
+    stats = Stats.StatsData(node, Constants.Layer.UDP, Constants.Direction.SND)
+    for epoch, addr, length in packets:
+        packet = SimpleNamespace(addr=SimpleNamespace(key=addr), length=length,
+                                 frame_info=SimpleNamespace(time_epoch=epoch))
+        stats.processLayer(packet, Layer(Constants.Layer.UDP, srcport=53, dstport=5353,
+                                         length=length - 28))
+    return stats
+
+
+def make_packets(count):
+    rng = random.Random(count)
+    return [(100.0 + i * 0.25, rng.choice(["a", "b", "c"]), rng.randint(60, 1500))
+            for i in range(count)]
+
+
+@pytest.mark.parametrize("count", [0, 1, 7, 8, 16, 21])
+def test_spilled_columns_match_memory(monkeypatch, count):
+    monkeypatch.setattr(Stats, "SPILL_CHUNK", 8)
+    packets = make_packets(count)
+    memory = process_packets(Constants.Series.MEMORY, packets)
+    disk = process_packets(Constants.Series.DISK, packets)
+
+    assert len(disk.packetTS) == count
+    #Only the values after the last full chunk stay in memory
+    assert len(disk.packetTS.buffer) == count % 8
+    for name in Stats.StatsData.COLUMNS:
+        assert disk.getColumn(name).tolist() == memory.getColumn(name).tolist()
+    assert disk.addrpcktnum == memory.addrpcktnum
+    assert disk.addrpcktsize == memory.addrpcktsize
+
+
+def test_spill_array_appends_after_to_numpy(monkeypatch):
+    monkeypatch.setattr(Stats, "SPILL_CHUNK", 4)
+    spill = Stats.SpillArray("q")
+    for i in range(6):
+        spill.append(i)
+    assert spill.toNumPy("int64").tolist() == list(range(6))
+    for i in range(6, 9):
+        spill.append(i)
+    assert spill.toNumPy("int64").tolist() == list(range(9))
+
+
+def test_series_none_keeps_address_counts():
+    packets = make_packets(20)
+    memory = process_packets(Constants.Series.MEMORY, packets, window=2)
+    none = process_packets(Constants.Series.NONE, packets, window=2)
+
+    assert none.packetTS is None
+    assert len(none.getColumn("packetSize")) == 0
+    assert none.addrpcktnum == memory.addrpcktnum
+    assert none.addrpcktsize == memory.addrpcktsize
+    assert none.windowpcktnum == memory.windowpcktnum
+    assert sum(none.addrpcktnum.values()) == 20
+    assert sum(none.addrpcktsize.values()) == sum(length for _, _, length in packets)
+
+
+#The points minMaxValues documents it keeps, worked out one bucket at a time
+def min_max_reference(x, y, buckets):
+    low, high = min(x), max(x)
+    groups = {}
+    for i, v in enumerate(x):
+        bucket = min(int((v - low) / (high - low) * buckets), buckets - 1) if high > low else 0
+        groups.setdefault(bucket, []).append(i)
+    keep = set()
+    for idx in groups.values():
+        by_y = sorted(idx, key=lambda i: (y[i], i))
+        keep.update([by_y[0], by_y[-1]])
+    return sorted(keep)
+
+
+def test_min_max_values_keeps_extremes_in_order():
+    x, y = StatsMerge().minMaxValues([0, 1, 2, 3, 4, 5, 6, 7], [5, 1, 9, 4, 2, 8, 3, 7], 2)
+    #Bucket [0, 3.5) keeps y 1 and 9, bucket [3.5, 7] keeps y 2 and 8
+    assert x.tolist() == [1, 2, 4, 5]
+    assert y.tolist() == [1, 9, 2, 8]
+
+
+def test_min_max_values_matches_reference():
+    rng = random.Random(2)
+    sm = StatsMerge()
+    for _ in range(50):
+        count = rng.randint(1, 60)
+        x = sorted(rng.uniform(0, 10) for _ in range(count))
+        y = [rng.randint(0, 5) for _ in range(count)]
+        buckets = rng.randint(1, 10)
+
+        new_x, new_y = sm.minMaxValues(x, y, buckets)
+        if count <= 2 * buckets:
+            assert new_x.tolist() == x and new_y.tolist() == y
+            continue
+        keep = min_max_reference(x, y, buckets)
+        assert new_x.tolist() == [x[i] for i in keep]
+        assert new_y.tolist() == [y[i] for i in keep]
+
+
+def test_min_max_values_with_equal_x():
+    x, y = StatsMerge().minMaxValues([3.0] * 6, [4, 0, 7, 7, 0, 2], 2)
+    assert x.tolist() == [3.0, 3.0]
+    assert y.tolist() == [0, 7]
@@ -0,0 +1,65 @@
+import argparse
+
+from trafficAnalyzer.Device import Devices
+from trafficAnalyzer.Manifest import Manifest
+
+CAMERA_MAC = "00:11:22:33:44:55"
+PLUG_MAC = "66:77:88:99:aa:bb"
+
+
+def setup_jobs(tmp_path, monkeypatch, analyze, jobs, all_devices=False):
+    dev_list = tmp_path / "devices.txt"
+    dev_list.write_text("%s camera\n%s plug\n" % (CAMERA_MAC, PLUG_MAC))
+    (tmp_path / "in").mkdir()
+    for name in ("a.pcap", "b.pcap"):
+        (tmp_path / "in" / name).write_bytes(b"")
+    job_file = tmp_path / "jobs.csv"
+    job_file.write_text(jobs)
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(analyze, "args", argparse.Namespace(
+        dev="", mac_addr="", lab="lab", experiment="exp", network="net", dev_list=str(dev_list),
+        all_devices=all_devices))
+    monkeypatch.setattr(analyze, "devices", Devices(str(dev_list)))
+    return str(job_file)
+
+
+def test_load_jobs(tmp_path, monkeypatch, analyze):
+    job_file = setup_jobs(tmp_path, monkeypatch, analyze,
+                          "pcap,device,experiment,lab,network\n"
+                          "in/a.pcap,camera,power,,\n"
+                          " in/b.pcap , 66:77:88:99:AA:BB ,,other,\n")
+    jobs, errors = analyze.load_jobs(job_file)
+    assert not errors
+    assert [(j["dev"], j["mac"], j["experiment"], j["lab"], j["network"]) for j in jobs] == [
+        ("camera", CAMERA_MAC, "power", "lab", "net"), ("plug", PLUG_MAC, "exp", "other", "net")]
+    assert [j["files"] for j in jobs] == [[Manifest.key("in/a.pcap")], [Manifest.key("in/b.pcap")]]
+
+
+def test_load_jobs_reports_bad_lines(tmp_path, monkeypatch, analyze, capsys):
+    job_file = setup_jobs(tmp_path, monkeypatch, analyze,
+                          "pcap,device,experiment,lab,network\n"
+                          "in/missing.pcap,camera,,,\n"
+                          "in/a.pcap,doorbell,,,\n"
+                          "in/b.pcap,,,,\n"
+                          ",camera,,,\n")
+    jobs, errors = analyze.load_jobs(job_file)
+    assert errors
+    err = capsys.readouterr().err
+    assert 'line 2: The pcap file or directory "in/missing.pcap" does not exist' in err
+    assert 'line 3: The device "doorbell"' in err
+    assert "line 4: No device given" in err
+    assert 'line 5: The pcap file or directory "" does not exist' in err
+
+
+def test_load_jobs_rejects_pcap_file_in_two_jobs(tmp_path, monkeypatch, analyze, capsys):
+    job_file = setup_jobs(tmp_path, monkeypatch, analyze,
+                          "pcap,device,experiment,lab,network\n"
+                          "in/a.pcap,camera,,,\n"
+                          "in,plug,,,\n")
+    jobs, errors = analyze.load_jobs(job_file)
+    assert errors
+    err = capsys.readouterr().err
+    assert 'line 3: The pcap file "%s" is already in the job on line 2' % Manifest.key("in/a.pcap") in err
+    assert "--all-devices" in err
+    assert Manifest.key("in/b.pcap") not in err
@@ -0,0 +1,110 @@
+import argparse
+import os
+import zlib
+
+import pytest
+
+from trafficAnalyzer.Manifest import Manifest
+
+
+def make_pcaps(tmp_path, sizes):
+    pcaps = []
+    for idx, size in enumerate(sizes):
+        path = tmp_path / ("f%s.pcap" % idx)
+        path.write_bytes(bytes(size))
+        pcaps.append(str(path))
+    return pcaps
+
+
+def set_args(monkeypatch, analyze, **values):
+    defaults = {"shard_plan": "", "merge_shards": "", "out_file": "", "overwrite": False}
+    defaults.update(values)
+    monkeypatch.setattr(analyze, "args", argparse.Namespace(**defaults))
+
+
+def test_parse_shard(analyze):
+    assert analyze.parse_shard("2/5") == (2, 5)
+    for value in ("0/3", "4/3", "1/0", "1", "a/b", "1/2/3"):
+        assert analyze.parse_shard(value) is None
+
+
+def test_crc_shards_cover_every_file_once(analyze, monkeypatch):
+    set_args(monkeypatch, analyze)
+    job_files = [("/data/capture%s.pcap" % i, {"dev": "d"}) for i in range(200)]
+    for num in (1, 3, 7):
+        shards = [analyze.select_shard(job_files, (idx, num)) for idx in range(1, num + 1)]
+        selected = sorted(f for shard in shards for f, _ in shard)
+        assert selected == sorted(f for f, _ in job_files)
+        #The shard only depends on the path, so every machine selects the same files
+        for idx, shard in enumerate(shards, 1):
+            assert all(zlib.crc32(f.encode("utf-8")) % num + 1 == idx for f, _ in shard)
+            assert analyze.select_shard(list(reversed(job_files)), (idx, num)) == list(reversed(shard))
+    assert len(analyze.select_shard(job_files, (1, 1))) == len(job_files)
+
+
+def test_shard_plan_balances_sizes(analyze, tmp_path):
+    pcaps = make_pcaps(tmp_path, [100, 60, 50, 40, 10])
+    plan_file = str(tmp_path / "plan.csv")
+    plan = analyze.load_shard_plan(plan_file, pcaps + pcaps[:1], 2)
+
+    #Largest first, each to the shard with the smallest total so far
+    assert [plan[f] for f in pcaps] == [1, 2, 2, 1, 2]
+    totals = {1: 0, 2: 0}
+    for f, shard in plan.items():
+        totals[shard] += os.path.getsize(f)
+    assert totals == {1: 140, 2: 120}
+    assert analyze.load_shard_plan(plan_file, pcaps, 2) == plan
+
+
+def test_shard_plan_normalises_paths_and_warns_about_missing_files(analyze, tmp_path, monkeypatch, capsys):
+    pcaps = make_pcaps(tmp_path, [10, 20, 30])
+    plan_file = tmp_path / "plan.csv"
+    plan_file.write_text("pcap,size,shard,shards\nf0.pcap,10,1,2\n./sub/../f1.pcap,20,2,2\n")
+    monkeypatch.chdir(tmp_path)
+
+    plan = analyze.load_shard_plan(str(plan_file), [Manifest.key(f) for f in pcaps], 2)
+    assert plan == {Manifest.key(pcaps[0]): 1, Manifest.key(pcaps[1]): 2}
+    err = capsys.readouterr().err
+    assert "1 pcap files are not in the shard plan" in err
+    assert Manifest.key(pcaps[2]) in err
+
+
+def test_shard_plan_with_other_number_of_shards(analyze, tmp_path):
+    plan_file = tmp_path / "plan.csv"
+    plan_file.write_text("pcap,size,shard,shards\nf0.pcap,10,1,2\n")
+    with pytest.raises(SystemExit):
+        analyze.load_shard_plan(str(plan_file), [], 3)
+
+
+def write_shards(analyze, out, num):
+    for idx in range(1, num + 1):
+        shard = analyze.shard_file(out, idx, num)
+        with open(shard, "w") as f:
+            f.write("ts,input_file\n%s,f%s.pcap\n" % (idx, idx))
+        with open(Manifest.forOutput(shard).fileName, "w") as f:
+            f.write('{"path": "/f%s.pcap", "size": 1, "mtime": 1}\n' % idx)
+
+
+def test_merge_shards(analyze, tmp_path, monkeypatch):
+    out = str(tmp_path / "out.csv")
+    write_shards(analyze, out, 2)
+    set_args(monkeypatch, analyze, merge_shards="2", out_file=out)
+    analyze.merge_shards()
+    assert open(out).read() == "ts,input_file\n1,f1.pcap\n2,f2.pcap\n"
+    assert sorted(Manifest.forOutput(out).entries) == ["/f1.pcap", "/f2.pcap"]
+
+
+def test_merge_shards_keeps_existing_rows_unless_asked(analyze, tmp_path, monkeypatch):
+    out = str(tmp_path / "out.csv")
+    write_shards(analyze, out, 2)
+    with open(out, "w") as f:
+        f.write("ts,input_file\n0,f0.pcap\n")
+
+    set_args(monkeypatch, analyze, merge_shards="2", out_file=out)
+    with pytest.raises(SystemExit):
+        analyze.merge_shards()
+    assert open(out).read() == "ts,input_file\n0,f0.pcap\n"
+
+    set_args(monkeypatch, analyze, merge_shards="2", out_file=out, overwrite=True)
+    analyze.merge_shards()
+    assert open(out).read() == "ts,input_file\n1,f1.pcap\n2,f2.pcap\n"
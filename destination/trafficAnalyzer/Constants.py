@@ -4,6 +4,7 @@ class Layer(object):
     ETH = 'eth'
     ARP = 'arp'
     IP = 'ip'
+    IPV6 = 'ipv6'
     ICMP = 'icmp'
     UDP = 'udp'
     TCP = 'tcp'
@@ -19,13 +20,30 @@ class Direction(object):
     SND = 'snd'
     RCV = 'rcv'
 
+
+#How StatsData keeps the per packet time series
+class Series(object):
+    MEMORY = 'memory' #typed arrays in memory
+    DISK = 'disk' #arrays spilled to temporary files, read back memory-mapped
+    NONE = 'none' #not kept, only the per address counts
+
+#Stages of the analysis timed with --timing
+class Stage(object):
+    LOAD = 'load' #loading the tables shared by every pcap file, in the main process
+    DECODE = 'decode' #reading and decoding the packets
+    AGGREGATE = 'aggregate' #counting the packets in NodeStats
+    HOSTS = 'hosts' #tracking DNS, TLS and HTTP names and mapping IP addresses to hosts
+    EXPORT = 'export' #DomainExport and the windowed counts
+    PLOT = 'plot'
+    TOTAL = 'total' #the whole analysis of a pcap file
+
 RED = "\033[31;1m"
 END = "\033[0m"
 PATH = sys.argv[0]
 BEG = RED + PATH
 
 USAGE_STM = """
-Usage: python3 {prog_name} -i IN_DIR {{-m MAC_ADDR | -d DEV}} [OPTION]... [-g PLOTS -p PROTOS [GRAPH_OPTION]...]
+Usage: python3 {prog_name} {{-i IN_DIR | --jobs JOB_LIST}} {{-m MAC_ADDR | -d DEV | --all-devices}} [OPTION]... [-g PLOTS -p PROTOS [GRAPH_OPTION]...]
 
 Performs destination analysis on several pcap files. Produces a CSV file detailing
 the organizations that traffic in the pcap files have been to and the number of
@@ -49,7 +67,8 @@ Options:
   -s HOSTS    path to a directory containing text (.txt) files produced by TShark
                 extracting hosts from IN_DIR; host filenames should match input
                 pcap but with .txt extension; generate host file using "tshark -r
-                [input_pcap] -q -z hosts > HOSTS/[input_pcap].txt"
+                [input_pcap] -q -z hosts > HOSTS/[input_pcap].txt"; HOSTS may
+                also be a single hosts file used for every pcap file
   -b LAB      name of the lab that the pcap files in IN_DIR were generated in
   -e EXP      name of the experiment that the pcap files in IN_DIR are a part of
   -w NETWORK  name of the network
@@ -58,9 +77,72 @@ Options:
   -f FIG_DIR  path to a directory to place generated plots; will be generated
                 if it does not currently exist (Default = figures/)
   -o OUT_CSV  path to the output CSV file; if it exists, results will be
-                appended, else, it will be created (Default = results.csv)
+                appended, else, it will be created; pcap files already analyzed
+                into it are skipped (Default = results.csv)
   -n NUM_PROC number of processes to use to analyze the pcap files (Default = 1)
   -h          print this usage statement and exit
+  --host-cache HOST_CACHE
+              path to an SQLite file caching reverse DNS and WHOIS lookups
+                between runs; an empty string disables the cache (Default =
+                cache/hosts.sqlite)
+  --ripe-db RIPE_DB
+              path to the SQLite database storing the locations found with the
+                RIPE IPmap API for RipeCountry (Default = cache/ripe.sqlite)
+  --prefix-table PREFIX_TABLE
+              CSV file of networks, in a "prefix" column in CIDR notation or
+                "start" and "end" columns, with org, country and asn columns;
+                used for IP addresses not in aux/ipToOrg.csv and
+                aux/ipToCountry.csv
+  --tshark-hosts
+              map IP addresses to hosts by running TShark on each pcap file
+                instead of reading the DNS, TLS and HTTP traffic while the
+                packets are processed
+  --jobs JOB_LIST
+              CSV file with the header "pcap,device,experiment,lab,network" and
+                one analysis job per line, used instead of -i; pcap is a pcap
+                file or a directory of them and device is a name in DEV_LIST
+                or a MAC address; empty columns take the value of -d/-m, -e,
+                -b and -w; all jobs are run by the same NUM_PROC processes;
+                a pcap file can only be in one job
+  --stream    keep memory use bounded on long captures: without plots, only
+                the per address counts are kept; with plots, the per packet
+                series are written to temporary files (in TMPDIR) and read
+                back memory-mapped
+  --window SECONDS
+              also count the packets and bytes sent to and received from each
+                address per window of SECONDS seconds, and write them for each
+                pcap file as a NumPy .npz file in [OUT_CSV without
+                .csv]_windows/ (Default = 0, no windows)
+  --all-devices
+              analyze the traffic of every device in DEV_LIST in one pass over
+                each pcap file, instead of one device given with -m or -d; the
+                rows of each device are named after it and its plots are put
+                in FIG_DIR/[DEVICE]/
+  --timing TIMING_FILE
+              append the wall time, CPU time, packets and peak RSS of each
+                stage of the analysis of each pcap file, by each process, to
+                TIMING_FILE as JSON lines
+  --timing-prom PROM_FILE
+              also write the timings of this run to PROM_FILE in the
+                Prometheus text format, e.g. for the node exporter textfile
+                collector
+  --shard I/N only analyze shard I of N of the pcap files (1 <= I <= N), and write
+                the results to [OUT_CSV without .csv]_shardIofN.csv; pcap
+                files are assigned to shards by a hash of their path, or
+                with SHARD_PLAN
+  --shard-plan SHARD_PLAN
+              CSV file assigning the pcap files to shards so that the shards
+                have about the same total size; created from the input pcap
+                files if it does not exist; pcap files not in it are assigned
+                by the hash of their path
+  --merge-shards N
+              merge the sorted results of shards 1 to N of OUT_CSV into
+                OUT_CSV and exit; no other option is needed; refused if
+                OUT_CSV already has rows, unless --overwrite is given
+  --overwrite replace the rows of OUT_CSV and its manifest with --merge-shards
+  --reanalyze analyze all pcap files in IN_DIR, replacing their rows in OUT_CSV,
+                instead of only those that are new or changed since they were
+                last analyzed
 
 Graph options:
   -g PLOTS  comma-delimited list of graph types to plot; choose from StackPlot,
@@ -71,11 +153,14 @@ Graph options:
               period-delimited format: "[send_protocol].[receive_protocol]"
   -l IPLOCS comma-delimited list of methods to map an IP address to a host
               or country for each plot; choose from Country, Host, IP,
-              RipeCountry, or TSharkHost; RipeCountry currently does not
-              function properly (Default = IP)
+              RipeCountry, or TSharkHost (Default = IP)
   -r IPATTS comma-delimited list of IP packet attributes to display for each
               plot; choose from either addrPcktSize or addrPcktNum (Default =
               addrPcktSize)
+  --no-downsample
+            plot every packet in line, scatter and bar plots; by default, line
+              and scatter plots keep the lowest and highest packet per pixel
+              and bar plots merge consecutive packets into one bar per pixel
 
 Notes:
  - The position of an argument in the comma-delimited lists in the graph options
@@ -99,16 +184,40 @@ DOWNLOAD_DB = RED + "Please go to the README for instructions to download the da
 NO_PERM = BEG + ": Error: The %s \"%s\" does not have %s permission." + END
 PIE_STM = "***PiePlot currently does not function properly. Please choose a different plot.\n"\
           "   Currently available plots: BarHPlot, BarPlot, LinePlot, ScatterPlot, StackPlot"
-RP_STM = "***RipeCountry currently does not function properly. Please choose a different IP"\
-         " mapping method.\n   Currently available methods: Country, Host, IP, TSharkHost"
 
 INVAL = BEG + ": Error: %s \"%s\" is not a %s." + END
 WRONG_EXT = BEG + ": Error: %s must be a %s file. Received \"%s\"" + END
 
 NO_IN_DIR = BEG + ": Error: Pcap input directory (-i) required." + END
 NO_MAC = BEG + ": Error: Either the MAC address (-m) or device name (-d) must be specified." + END
+JOBS_IN_DIR = BEG + ": Error: The input directory (-i) cannot be used with --jobs." + END
+JOB_NO_PCAP = BEG + ": Error: Job list \"%s\", line %s: The pcap file or directory \"%s\" does not exist." + END
+JOB_NO_DEV = BEG + ": Error: Job list \"%s\", line %s: The device \"%s\" does not exist in the device"\
+             " list \"%s\"." + END
+JOB_NO_MAC = BEG + ": Error: Job list \"%s\", line %s: No device given, and neither the MAC address (-m)"\
+             " nor device name (-d) is specified." + END
+JOB_DUP_PCAP = BEG + ": Error: Job list \"%s\", line %s: The pcap file \"%s\" is already in the job on line"\
+               " %s. A pcap file can only be in one job; use --all-devices to analyze the traffic of"\
+               " several devices in the same pcap file." + END
+ALL_DEV_MAC = BEG + ": Error: The MAC address (-m) and device name (-d) cannot be used with"\
+              " --all-devices." + END
 INVAL_MAC = BEG + ": Error: Invalid MAC address \"%s\". Valid format xx:xx:xx:xx:xx:xx" + END
 NO_DEV = BEG + ": Error: The device \"%s\" does not exist in the device list \"%s\"." + END
+INVAL_WINDOW = BEG + ": Error: The window length (--window) must be a non-negative number of seconds."\
+               " Received \"%s\"." + END
+INVAL_SHARD = BEG + ": Error: The shard (--shard) must be in the format \"I/N\" with 1 <= I <= N."\
+              " Received \"%s\"." + END
+PLAN_NO_SHARD = BEG + ": Error: The shard plan (--shard-plan) can only be used with --shard." + END
+PLAN_MISSING = BEG + ": Warning: %s pcap files are not in the shard plan \"%s\" and are assigned to"\
+               " shards by the hash of their path:" + END
+PLAN_SHARDS = BEG + ": Error: The shard plan \"%s\" divides the pcap files into %s shards, not %s." + END
+INVAL_MERGE = BEG + ": Error: The number of shards to merge (--merge-shards) must be a positive integer."\
+              " Received \"%s\"." + END
+NO_SHARD_OUT = BEG + ": Error: The output file of shard %s of %s, \"%s\", does not exist." + END
+OVERWRITE_NO_MERGE = BEG + ": Error: --overwrite can only be used with --merge-shards." + END
+MERGE_EXISTS = BEG + ": Error: The output file \"%s\" already has rows, which merging the shards would"\
+               " replace. Use --overwrite to replace them." + END
+MERGE_ERR = BEG + ": Error: The shards cannot be merged: %s." + END
 NON_POS = BEG + ": Error: The number of processes must be a positive integer. Received \"%s\"." + END
 
 INVAL_PLT = BEG + ": Error: \"%s\" is not a valid plot type.\n    Must be either \"BarHPlot\","\
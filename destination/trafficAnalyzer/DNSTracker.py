@@ -1,11 +1,197 @@
+import socket
+import struct
+
+from . import Constants
+
+
+DNS_PORT = 53
+DNS_TYPE_A = 1
+DNS_TYPE_CNAME = 5
+DNS_TYPE_AAAA = 28
+
+TLS_HANDSHAKE = 0x16
+TLS_CLIENT_HELLO = 0x01
+TLS_EXT_SERVER_NAME = 0x0000
+
+HTTP_METHODS = (b"GET ", b"POST ", b"HEAD ", b"PUT ", b"DELETE ", b"OPTIONS ", b"PATCH ", b"CONNECT ")
+
+
+'''
+Builds the IP to hostname mapping while the packets are being processed, so
+the pcap file does not need to be decoded again by TShark. Names are taken
+from DNS answers (the name that was queried, same as the corrected output of
+"tshark -z hosts"), and from the TLS SNI extension and the HTTP Host header
+for servers whose address was not looked up in the capture.
+'''
 class Tracker(object):
     def __init__(self):
-        pass
+        self.answers = Answers()
+        self.serverNames = {}
+
+    def processPacket(self, packet):
+        payload = packet.payload
+        if not payload:
+            return
+
+        try:
+            if hasattr(packet, Constants.Layer.UDP):
+                if packet.udp.srcport == DNS_PORT:
+                    self.processDNS(packet, payload)
+            elif hasattr(packet, Constants.Layer.TCP):
+                if packet.tcp.srcport == DNS_PORT:
+                    #DNS over TCP prefixes the message with its length
+                    self.processDNS(packet, payload[2:])
+                elif payload[0] == TLS_HANDSHAKE:
+                    self.addServerName(packet, self.getSNI(payload))
+                elif payload.startswith(HTTP_METHODS):
+                    self.addServerName(packet, self.getHTTPHost(payload))
+        except (IndexError, struct.error, ValueError):
+            #Truncated or malformed payload
+            pass
+
+    def processDNS(self, packet, payload):
+        record = Record(payload)
+        if not record.isResponse or len(record.questions) == 0:
+            return
+
+        question = record.questions[0]
+        names = [question.question] + [answer.name for answer in record.answers]
+        for answer in record.answers:
+            #Addresses of the wrong length have no data
+            if answer.type in (DNS_TYPE_A, DNS_TYPE_AAAA) and answer.data is not None:
+                self.answers.addAnswer(packet, answer, question, names)
+
+    def getSNI(self, payload):
+        if payload[5] != TLS_CLIENT_HELLO:
+            return None
+
+        #Skip record header (5), handshake header (4), version (2) and random (32)
+        offset = 43
+        offset += 1 + payload[offset]
+        offset += 2 + struct.unpack_from("!H", payload, offset)[0]
+        offset += 1 + payload[offset]
+        end = offset + 2 + struct.unpack_from("!H", payload, offset)[0]
+        offset += 2
+        while offset + 4 <= min(end, len(payload)):
+            ext_type, ext_len = struct.unpack_from("!HH", payload, offset)
+            offset += 4
+            if ext_type == TLS_EXT_SERVER_NAME:
+                #Server name list length (2), name type (1), name length (2)
+                name_len = struct.unpack_from("!H", payload, offset + 3)[0]
+                return payload[offset + 5:offset + 5 + name_len].decode("ascii")
+            offset += ext_len
+
+        return None
+
+    def getHTTPHost(self, payload):
+        headers = payload[:payload.find(b"\r\n\r\n")]
+        for line in headers.split(b"\r\n")[1:]:
+            if line[:5].lower() == b"host:":
+                host = line[5:].strip().decode("ascii")
+                #Remove the port, but leave bracketed IPv6 addresses alone
+                if host.count(":") == 1:
+                    host = host.split(":")[0]
+                return host
+
+        return None
+
+    def addServerName(self, packet, name):
+        if not name:
+            return
+
+        ip = self.getDestination(packet)
+        if ip is None:
+            return
+        names = self.serverNames.setdefault(ip, [])
+        if name not in names:
+            names.append(name)
+
+    def getDestination(self, packet):
+        for layer in [Constants.Layer.IP, Constants.Layer.IPV6]:
+            if hasattr(packet, layer):
+                return getattr(packet, layer).dst
+        return None
+
+    '''
+    Returns a list of (ip, host) pairs. Hosts learnt from DNS come first,
+    followed by TLS/HTTP server names for addresses never seen in a DNS
+    answer.
+    '''
+    def getHosts(self):
+        hosts = []
+        for ip, answers in self.answers.answers.items():
+            for host in answers:
+                hosts.append((ip, host))
+
+        for ip, names in self.serverNames.items():
+            if ip not in self.answers.answers:
+                for host in names:
+                    hosts.append((ip, host))
+
+        return hosts
+
+    '''
+    Returns the name that was queried in the DNS response that contains
+    both the given address and host (either as the query, a CNAME or an
+    answer name), or None if there is no such response.
+    '''
+    def getQuestion(self, ip, host):
+        return self.answers.index.get((ip, host))
 
 
 class Record(object):
-    def __init__(self):
-        pass
+    def __init__(self, payload):
+        self.payload = payload
+        self.questions = []
+        self.answers = []
+        self.isResponse = False
+        self.parse()
+
+    def parse(self):
+        _, flags, qd_count, an_count = struct.unpack_from("!HHHH", self.payload)
+        self.isResponse = bool(flags & 0x8000)
+
+        offset = 12
+        for _ in range(qd_count):
+            name, offset = self.readName(offset)
+            self.questions.append(Question(name))
+            offset += 4
+
+        for _ in range(an_count):
+            name, offset = self.readName(offset)
+            rr_type, _, _, rd_len = struct.unpack_from("!HHIH", self.payload, offset)
+            offset += 10
+            rdata = self.payload[offset:offset + rd_len]
+            if rr_type == DNS_TYPE_A and rd_len == 4:
+                data = socket.inet_ntop(socket.AF_INET, rdata)
+            elif rr_type == DNS_TYPE_AAAA and rd_len == 16:
+                data = socket.inet_ntop(socket.AF_INET6, rdata)
+            elif rr_type == DNS_TYPE_CNAME:
+                data, _ = self.readName(offset)
+            else:
+                data = None
+            self.answers.append(Answer(name, rr_type, data))
+            offset += rd_len
+
+    def readName(self, offset):
+        labels = []
+        end = None
+        #Bound the number of compression pointers followed to avoid loops
+        for _ in range(128):
+            length = self.payload[offset]
+            if length & 0xC0 == 0xC0:
+                if end is None:
+                    end = offset + 2
+                offset = ((length & 0x3F) << 8) | self.payload[offset + 1]
+            elif length == 0:
+                if end is None:
+                    end = offset + 1
+                return ".".join(labels), end
+            else:
+                labels.append(self.payload[offset + 1:offset + 1 + length].decode("latin-1"))
+                offset += 1 + length
+
+        raise ValueError("DNS name compression loop")
 
 
 class Questions(object):
@@ -17,19 +203,23 @@ class Question(object):
     def __init__(self, question):
         self.question = question
 
-    def addQuestion(self, packet, question):
-        pass
-
 
 class Answers(object):
     def __init__(self):
         self.answers = {}
+        self.index = {}
 
-    def addAnswer(self, packet, answer):
-        pass
+    def addAnswer(self, packet, answer, question, names):
+        hosts = self.answers.setdefault(answer.data, [])
+        if question.question not in hosts:
+            hosts.append(question.question)
 
+        for name in names:
+            self.index.setdefault((answer.data, name), question.question)
 
-class Answer(object):
-    def __init__(self, answer):
-        self.answer = answer
 
+class Answer(object):
+    def __init__(self, name, rr_type, data):
+        self.name = name
+        self.type = rr_type
+        self.data = data
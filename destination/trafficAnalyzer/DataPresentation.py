@@ -1,18 +1,29 @@
 import os
 import csv
 import gc
+import heapq
+import itertools
+import shutil
+import tempfile
 
-import matplotlib.pyplot as plt
-import numpy as np
+from . import Stats, IP, Constants, Utils
 
-from . import Stats, IP, Constants
+#Imported on first use, so analyses without plots do not load matplotlib
+plt = Utils.LazyModule("matplotlib.pyplot")
+np = Utils.LazyModule("numpy")
 
+#Number of rows sort_csv sorts in memory at once
+SORT_CHUNK_ROWS = 500000
+#Resolution the plots are saved at
+PLOT_DPI = 72
 
 class PlotManager(object):
     def __init__(self, stats, graphs):
         self.graphs = graphs
         self.subPlotCounter = 1
         self.stats = stats
+        #Reduce line, scatter and bar plots to about one point per pixel
+        self.downsample = True
 
     def showGraphs(self):
         for graph in self.graphs:
@@ -60,7 +71,7 @@ class PlotManager(object):
             os.system('mkdir -pv %s' % fig_dir)
 
         graph_path = os.path.join(fig_dir, self.sanitiseFileName(pcap_file))
-        fig.savefig(graph_path, dpi=72)
+        fig.savefig(graph_path, dpi=PLOT_DPI)
         print("  P%s: Plot successfully saved to \"%s\"" % (pid, graph_path))
         #plt.show()
         fig.clf()
@@ -79,8 +90,14 @@ class PlotManager(object):
         for protocol in [options["prot_snd"], options["prot_rcv"]]:
             self.lp.addLine(protocol, "packetTS", "packetSize", protocol)
 
+        if self.downsample:
+            self.lp.downsample(self.getPixelWidth(ax))
         self.lp.plotFig()
 
+    #Width of the plotting area of ax in pixels of the saved figure
+    def getPixelWidth(self, ax):
+        return max(1, int(ax.get_window_extent().width * PLOT_DPI / ax.figure.dpi))
+
     def generatePiePlot(self, options, ax, class_name, geo_db_city, geo_db_country):
         self.pp = globals()[class_name](self.stats, ax, self.ipMap, geo_db_city, geo_db_country, class_name)
         for protocol in [options["prot_snd"], options["prot_rcv"]]:
@@ -151,8 +168,8 @@ class StackPlot(DataPresentation):
     def addDataToStack(self, layer, y_field, label, x_field = "packetTS"):
         self.labels.append(label)
         try:
-            xData = getattr(self.stats[layer], x_field)
-            yData = getattr(self.stats[layer], y_field)
+            xData = self.stats[layer].getColumn(x_field)
+            yData = self.stats[layer].getColumn(y_field)
             if len(self.x) == 0:
                 self.x = xData
                 self.y.append(yData)
@@ -178,8 +195,8 @@ class LinePlot(DataPresentation):
     def addLine(self, layer, x_field, y_field, label):
         self.labels.append(label)
         try: 
-            self.x.append(getattr(self.stats[layer], x_field))
-            self.y.append(getattr(self.stats[layer], y_field))
+            self.x.append(self.stats[layer].getColumn(x_field))
+            self.y.append(self.stats[layer].getColumn(y_field))
         except KeyError:
             print("LinePlot: There is no traffic for protocol {}.".format(layer))
 
@@ -193,6 +210,11 @@ class LinePlot(DataPresentation):
     def cumSum(self):
         self.y = self.sm.cumSumList(self.y)
 
+    #Keeps the lowest and highest point of each of buckets ranges of x
+    def downsample(self, buckets):
+        for i, (x, y) in enumerate(zip(self.x, self.y)):
+            self.x[i], self.y[i] = self.sm.minMaxValues(x, y, buckets)
+
     def plotFig(self):
         for i, _ in enumerate(self.x):
             self.ax.plot(self.x[i], self.y[i], label=self.labels[i])
@@ -209,6 +231,15 @@ class ScatterPlot(LinePlot):
 
 
 class BarPlot(LinePlot):
+    #Merges consecutive packets into about buckets bars, each as high as
+    #the sum of their values
+    def downsample(self, buckets):
+        length = max([len(x) for x in self.x] + [0])
+        if length > buckets:
+            merge_val = -(-length // buckets)
+            self.mergeData(merge_val)
+            self.ax.set_ylabel("Total Packet Size per {} Packets (bytes)".format(merge_val))
+
     def plotFig(self):
         for i, _ in enumerate(self.x):
             self.ax.bar(self.x[i], self.y[i])
@@ -285,7 +316,7 @@ class FreqPlot(DataPresentation):
         super().__init__(stats, ax)
 
     def analyzeFreq(self, layer, y_field):
-        data = getattr(self.stats[layer], y_field)
+        data = self.stats[layer].getColumn(y_field)
 
         self.fft = np.fft.fft(data)
         self.freq = np.fft.fftfreq(len(data))
@@ -342,6 +373,7 @@ class DomainExport(DataPresentation):
 
     def loadDomains(self, device, lab, experiment, network, pcap_file, baseTS):
         ips = self.getKeysFromDict(self.domains['packetSize'])
+        self.ipResolver.prefetch(ips, "TSharkHost")
         for ip in ips:
             if self.ipResolver.isIPAddr(ip):
                 domain_full = self.ipResolver.getDataPoint(ip, "TSharkHost", False)
@@ -383,9 +415,13 @@ class DomainExport(DataPresentation):
             self.dataRows.append(row)
 
     def exportDataRows(self, output_file):
-        csv_data = "\n".join([",".join(r) for r in self.dataRows]) + "\n"
         with open(output_file, 'a') as f:
-            f.write(csv_data)
+            f.write(self.getCsvData())
+
+    def getCsvData(self):
+        if len(self.dataRows) == 0:
+            return ""
+        return "\n".join([",".join(r) for r in self.dataRows]) + "\n"
 
     def getVal(self, _dict, key):
         if key in _dict:
@@ -401,12 +437,155 @@ class DomainExport(DataPresentation):
             f.write("ts,device,ip,host,host_full,traffic_snd,traffic_rcv,packet_snd,"
                     "packet_rcv,country,party,lab,experiment,network,input_file,organization\n")
 
-    def sort_csv(output_file):
-        reader = csv.reader(open(output_file))
-        header = next(reader)
-        csv_data = ",".join(header) + "\n"
-        sorted_list = sorted(reader)
-        csv_data = csv_data + "\n".join([",".join(r) for r in sorted_list]) + "\n"
-        with open(output_file, "w") as f:
-            f.write(csv_data)
+    #Removes the rows generated from the given pcap files. Paths are compared
+    #by their real path, so rows written with relative paths are found too
+    def remove_rows(output_file, pcap_files):
+        pcap_files = set(os.path.realpath(f) for f in pcap_files)
+        real_paths = {}
+        out_dirname = os.path.dirname(output_file) or "."
+        tmp_fd, tmp_file = tempfile.mkstemp(dir=out_dirname, suffix=".csv")
+        with open(output_file) as f_in, os.fdopen(tmp_fd, "w") as f_out:
+            header = next(f_in)
+            f_out.write(header)
+            col = header.rstrip("\n").split(",").index("input_file")
+            for line in f_in:
+                fields = line.rstrip("\n").split(",")
+                if len(fields) > col:
+                    path = fields[col]
+                    if path not in real_paths:
+                        real_paths[path] = os.path.realpath(path)
+                    if real_paths[path] in pcap_files:
+                        continue
+                f_out.write(line)
+        shutil.copymode(output_file, tmp_file)
+        os.replace(tmp_file, output_file)
+
+    '''
+    Sorts the rows of the CSV file, keeping the header first. The rows are
+    sorted in chunks of chunk_rows rows which are written to temporary files
+    and then merged, so memory use does not grow with the size of the file.
+    '''
+    def sort_csv(output_file, chunk_rows=SORT_CHUNK_ROWS):
+        out_dirname = os.path.dirname(output_file) or "."
+        chunks = []
+        try:
+            with open(output_file) as f:
+                reader = csv.reader(f)
+                header = next(reader)
+                #Blank lines, such as those left for pcap files without rows, are dropped
+                rows_left = (row for row in reader if row)
+                while True:
+                    rows = sorted(itertools.islice(rows_left, chunk_rows))
+                    if len(rows) == 0:
+                        break
+                    chunk = tempfile.TemporaryFile("w+", newline="", dir=out_dirname)
+                    csv.writer(chunk).writerows(rows)
+                    chunk.seek(0)
+                    chunks.append(chunk)
+
+            tmp_fd, tmp_file = tempfile.mkstemp(dir=out_dirname, suffix=".csv")
+            with os.fdopen(tmp_fd, "w") as f:
+                f.write(",".join(header) + "\n")
+                for row in heapq.merge(*[csv.reader(chunk) for chunk in chunks]):
+                    f.write(",".join(row) + "\n")
+            shutil.copymode(output_file, tmp_file)
+            os.replace(tmp_file, output_file)
+        finally:
+            for chunk in chunks:
+                chunk.close()
 
+    '''
+    Merges CSV files sorted by sort_csv, which all have the same header, into
+    output_file, replacing it. The files are merged one row at a time, so
+    memory use does not grow with their size.
+    '''
+    def merge_csv(output_file, csv_files):
+        out_dirname = os.path.dirname(output_file) or "."
+        files = [open(csv_file, newline="") for csv_file in csv_files]
+        try:
+            readers = [csv.reader(f) for f in files]
+            header = None
+            for csv_file, reader in zip(csv_files, readers):
+                file_header = next(reader, None)
+                if header is not None and file_header != header:
+                    raise ValueError("\"%s\" does not have the same columns as \"%s\""
+                                     % (csv_file, csv_files[0]))
+                header = file_header
+
+            tmp_fd, tmp_file = tempfile.mkstemp(dir=out_dirname, suffix=".csv")
+            try:
+                with os.fdopen(tmp_fd, "w") as f:
+                    f.write(",".join(header) + "\n")
+                    rows = [DomainExport.sorted_rows(csv_file, reader)
+                            for csv_file, reader in zip(csv_files, readers)]
+                    for row in heapq.merge(*rows):
+                        f.write(",".join(row) + "\n")
+            except:
+                os.remove(tmp_file)
+                raise
+            if os.path.isfile(output_file):
+                shutil.copymode(output_file, tmp_file)
+            os.replace(tmp_file, output_file)
+        finally:
+            for f in files:
+                f.close()
+
+    #Yields the rows of a CSV file, making sure they are sorted
+    def sorted_rows(csv_file, reader):
+        last = None
+        for row in reader:
+            if not row:
+                continue
+            if last is not None and row < last:
+                raise ValueError("\"%s\" is not sorted" % csv_file)
+            last = row
+            yield row
+
+
+'''
+Writes the per window counts of StatsData (see Node.NodeStats window) as a
+columnar NumPy .npz file with one entry per (window, device, direction,
+address): window_start (Unix time of the start of the window), device,
+direction, ip (the same address as the ip column of the CSV), packets and
+bytes, along with the window length in seconds and the input_file.
+'''
+class WindowExport(object):
+    COLUMNS = ["window_start", "device", "direction", "ip", "packets", "bytes"]
+
+    def __init__(self, window):
+        self.window = window
+        self.rows = []
+
+    def loadWindowsFor(self, stats, layer, device):
+        for direction in [Constants.Direction.SND, Constants.Direction.RCV]:
+            key = "{}-{}".format(layer, direction)
+            if key not in stats:
+                continue
+            data = stats[key]
+            for (window_start, ip), num in data.windowpcktnum.items():
+                self.rows.append((window_start, device, direction, ip, num,
+                                  data.windowpcktsize[(window_start, ip)]))
+
+    def save(self, output_file, pcap_file):
+        rows = sorted(self.rows)
+        columns = list(zip(*rows)) if len(rows) != 0 else [[]] * len(self.COLUMNS)
+        data = {"window_start": np.array(columns[0], dtype="float64"),
+                "device": np.array(columns[1], dtype="U"),
+                "direction": np.array(columns[2], dtype="U"),
+                "ip": np.array(columns[3], dtype="U"),
+                "packets": np.array(columns[4], dtype="int64"),
+                "bytes": np.array(columns[5], dtype="int64"),
+                "window": np.array(self.window, dtype="float64"),
+                "input_file": np.array(pcap_file, dtype="U")}
+
+        out_dirname = os.path.dirname(output_file) or "."
+        os.makedirs(out_dirname, exist_ok=True)
+        tmp_fd, tmp_file = tempfile.mkstemp(dir=out_dirname, suffix=".npz")
+        with os.fdopen(tmp_fd, "wb") as f:
+            np.savez_compressed(f, **data)
+        os.replace(tmp_file, output_file)
+
+    #Path of the file of a pcap file in the directory of windowed output
+    def window_file(window_dir, pcap_file):
+        name = "".join(c if c.isalnum() or c in "-._" else "_" for c in os.path.normpath(pcap_file))
+        return os.path.join(window_dir, name.strip("._") + ".npz")
@@ -11,6 +11,7 @@ class Device(object):
 class Devices(object):
     def __init__(self, file_name):
         self.devices = {}
+        self.names = {}
         self.fileName = file_name
         self.loadDevices()
 
@@ -22,12 +23,11 @@ class Devices(object):
             mac, name = line.strip().split()
             mac = Device.normaliseMac(mac)
             self.devices[mac] = Device(mac, name)
+            self.names[mac] = name
 
 
     def getDeviceName(self, mac):
-        if mac in self.devices:
-            return self.devices[mac].name
-        return None
+        return self.names.get(mac)
 
     def deviceInList(self, device_name):
         for device in self.devices.values():
@@ -1,61 +1,190 @@
+import csv
 import datetime
+import functools
+import ipaddress
 import json
+import multiprocessing
 import operator
 import os
 import socket
-import subprocess
-import urllib.request
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from . import Utils
+
+#Imported on first use
+geoip2 = Utils.LazyModule("geoip2", ["geoip2.database", "geoip2.errors"])
+mysql = Utils.LazyModule("mysql", ["mysql.connector"])
+tldextract = Utils.LazyModule("tldextract")
+whois = Utils.LazyModule("whois")
+urllib = Utils.LazyModule("urllib", ["urllib.request"])
+
+
+#Number of IP addresses whose GeoIP location is kept in memory
+GEO_CACHE_SIZE = 65536
+
+geoReaders = {}
+
+#Reverse DNS and WHOIS lookups made at once, and seconds to wait for each
+LOOKUP_WORKERS = 32
+LOOKUP_TIMEOUT = 10
+#h_errno of a reverse DNS lookup of an address that has no name
+HOST_NOT_FOUND = 1
+#Seconds a cached lookup is used for, and for lookups that found nothing
+HOST_CACHE_TTL = 30 * 24 * 3600
+HOST_CACHE_NEGATIVE_TTL = 24 * 3600
+#Largest number of values in one SQL "IN (...)" list
+SQLITE_BATCH = 500
+#RIPE IPmap API, probes made at once, probes per second and seconds to wait for each
+RIPE_URL = "https://openipmap.ripe.net/api/v1/locate/{}/"
+RIPE_WORKERS = 8
+RIPE_RATE = 10
+RIPE_TIMEOUT = 20
+#Location store of the RipeProbe used unless another one is set
+RIPE_DB = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "cache", "ripe.sqlite")
+#Public suffix list snapshot used to extract domains, so tldextract never
+#downloads one
+PUBLIC_SUFFIX_LIST = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "aux",
+                                  "public_suffix_list.dat")
+
+
+#GeoIP readers are opened once per process, memory mapping the database, and
+#shared by every IPResolver
+def getGeoReader(db_file):
+    if db_file not in geoReaders:
+        geoReaders[db_file] = geoip2.database.Reader(db_file, mode=geoip2.database.MODE_MMAP)
+    return geoReaders[db_file]
+
+
+@functools.lru_cache(maxsize=GEO_CACHE_SIZE)
+def lookupCity(db_file, ip):
+    try:
+        resp = getGeoReader(db_file).city(ip)
+        return resp.country.iso_code, resp.subdivisions.most_specific.name, resp.city.name
+    except geoip2.errors.AddressNotFoundError:
+        return "N/A", "", ""
+
+
+domainExtractor = None
+
+
+def extractDomainParts(host_name):
+    global domainExtractor
+    if domainExtractor is None:
+        domainExtractor = tldextract.TLDExtract(cache_dir=None,
+                                                suffix_list_urls=["file://" + os.path.abspath(PUBLIC_SUFFIX_LIST)],
+                                                fallback_to_snapshot=True)
+    return domainExtractor(host_name)
+
+
+#Reverse DNS and WHOIS lookups, used by HostEnricher unless it is given others
+def reverseLookup(ip):
+    try:
+        return socket.gethostbyaddr(ip)[0]
+    except socket.herror as e:
+        #The address has no name; other errors may not happen again
+        if e.errno == HOST_NOT_FOUND:
+            return ""
+        raise
+
+
+def whoisLookup(ip):
+    w = whois.whois(ip)
+    if isinstance(w.domain_name, (list,)):
+        return w.domain_name[0].lower()
+
+    if w.domain_name != "" and w.domain_name is not None:
+        return w.domain_name.lower()
+
+    if w.emails != "" and w.emails is not None:
+        ext = ""
+        if isinstance(w.emails, (list,)):
+            for email in reversed(w.emails):
+                ext = extractDomainParts(email)
+                if ext.domain.lower() != "apnic":
+                    break
+        else:
+            ext = extractDomainParts(w.emails)
+
+        return "{}.{}".format(ext.domain.lower(), ext.suffix.lower())
+
+    return "N/A"
+
+
+hostEnricher = None
+
+
+#Sets the HostEnricher used by every IPResolver in the process
+def setHostEnricher(enricher):
+    global hostEnricher
+    hostEnricher = enricher
+
 
-import geoip2.database
-import mysql.connector
-import pandas as pd
-import tldextract
-import whois
+def getHostEnricher():
+    if hostEnricher is None:
+        setHostEnricher(HostEnricher())
+    return hostEnricher
+
+
+ripeProbe = None
+
+
+#Sets the RipeProbe used for the RipeCountry method by every IPResolver in the process
+def setRipeProbe(probe):
+    global ripeProbe
+    ripeProbe = probe
+
+
+def getRipeProbe():
+    if ripeProbe is None:
+        setRipeProbe(RipeProbe(SQLiteLocationStore(RIPE_DB)))
+    return ripeProbe
 
 
 class IPResolver(object):
     def __init__(self, ipMapping, geoDbCity, geoDbCountry):
-        self.ipCity = geoip2.database.Reader(geoDbCity)
-        self.ipCountry = geoip2.database.Reader(geoDbCountry)
+        self.geoDbCity = geoDbCity
+        self.ipCity = getGeoReader(geoDbCity)
+        self.ipCountry = getGeoReader(geoDbCountry)
         self.ipMap = ipMapping
-        #self.ripeProbe = RipeProbe() #RipeCountry argument to the -l option, commented out because SQL database missing
+        self.enricher = getHostEnricher()
 
     def getCountryAndCity(self, ip):
-        try:
-            resp = self.ipCity.city(ip)
-            return resp.country.iso_code, resp.subdivisions.most_specific.name, resp.city.name
-        except geoip2.errors.AddressNotFoundError:
-            return "N/A", "", ""
+        return lookupCity(self.geoDbCity, ip)
       
     def getHostByAddr(self, ip):
-        try: 
-            host_name, alias_list, ip_addr_list = socket.gethostbyaddr(ip)
-            host_name = self.extractDomain(host_name)
-            return host_name, alias_list, ip_addr_list
-        except:
-            return "N/A", [], []
+        host_name = self.extractDomain(self.enricher.get(HostEnricher.HOST, ip))
+        return host_name, [], []
 
     def getWhois(self, ip):
-        w = whois.whois(ip)
-        if isinstance(w.domain_name, (list,)):
-            return w.domain_name[0].lower()
-    
-        if w.domain_name != "" and w.domain_name is not None:
-            return w.domain_name.lower()
-    
-        if w.emails != "" and w.emails is not None:
-            ext = ""
-            if isinstance(w.emails, (list,)):
-                for email in reversed(w.emails):
-                    ext = tldextract.extract(email)
-                    if ext.domain.lower() != "apnic":
-                        break
-            else:
-                ext = tldextract.extract(w.emails)
+        return self.enricher.get(HostEnricher.WHOIS, ip)
+
+    '''
+    Resolves, concurrently, the reverse DNS, WHOIS or RIPE lookups that
+    getDataPoint will need for the given addresses with the given method,
+    so the lookups are not made one at a time.
+    '''
+    def prefetch(self, ips, method):
+        method = method.lower()
+        if method not in ["host", "tsharkhost", "ripecountry"]:
+            return
+
+        ips = [ip for ip in ips if self.isIPAddr(ip) and not self.isLocalAddr(ip)
+               and not self.isMulticastAddr(ip)]
+        if method == "ripecountry":
+            getRipeProbe().getIPLocations(ips, 'countryCodeAlpha2')
+            return
 
-            return "{}.{}".format(ext.domain.lower(), ext.suffix.lower())
+        if method == "tsharkhost":
+            ips = [ip for ip in ips if self.ipMap.getHost(ip)[0] == "N/A"]
 
-        return "N/A"
+        self.enricher.resolve(ips, HostEnricher.HOST)
+        if method == "tsharkhost":
+            ips = [ip for ip in ips if self.getHostByAddr(ip)[0] == "N/A"
+                   or self.isIPAddr(self.getHostByAddr(ip)[0])]
+            self.enricher.resolve(ips, HostEnricher.WHOIS)
 
     def extractDomain(self, host_name):
         if host_name == "N/A":
@@ -63,13 +192,15 @@ class IPResolver(object):
         elif self.isIPAddr(host_name):
             return host_name
 
-        ext = tldextract.extract(host_name)
+        ext = extractDomainParts(host_name)
         return "{}.{}".format(ext.domain, ext.suffix)
 
     def splitIPBy(self, ip_dict, method, data=None):
         if data is None:
             data = {}
 
+        self.prefetch(ip_dict.keys(), method)
+
         for ip, val in ip_dict.items():
             if not self.isIPAddr(ip):
                 continue
@@ -93,7 +224,8 @@ class IPResolver(object):
             data_point = ip
         elif method == "country":
             data_point, _, _ = self.getCountryAndCity(ip)
-            #print (ip, data_point)
+            if data_point in ["N/A", None] and self.ipMap.getPrefixField(ip, 'country') != "N/A":
+                data_point = self.ipMap.getPrefixField(ip, 'country')
         elif method == "host":
             data_point, _, _ = self.getHostByAddr(ip)
         elif method == "tsharkhost":
@@ -103,7 +235,7 @@ class IPResolver(object):
                 if data_point == "N/A" or self.isIPAddr(data_point):
                     data_point = self.getWhois(ip)
         elif method == "ripecountry":
-            data_point = self.ripeProbe.getIPLocation(ip, 'countryCodeAlpha2')
+            data_point = getRipeProbe().getIPLocation(ip, 'countryCodeAlpha2')
             if data_point == "N/A":
                 data_point, _, _ = self.getCountryAndCity(ip)
         elif method == "countrymapping":
@@ -142,49 +274,217 @@ class IPResolver(object):
         return False
 
 
-class RipeProbe(object):
-    def __init__(self):
-        self.cnx = mysql.connector.connect(user='meddle', password='meddle',
-            host='127.0.0.1', database='MeddleDB')
-        self.cursor = self.cnx.cursor(dictionary=True)
-        self.url = "https://openipmap.ripe.net/api/v1/locate/{}/"
-
-    def getIPLocation(self, ip, loc_type):
-        loc = self.loadIP(ip, 1)
-        if len(loc) == 0:
-            loc = self.loadIP(ip, 0)
-      
-            if len(loc) == 0:
-                loc = self.probe(ip)
-                #print ("Probing, len loc: ", len(loc['locations']))
-
-                if 'locations' in loc:
-                    self.saveIPLocations(ip, loc['locations'])
-                    self.chooseLocationForIP(ip)
-
-        else:
-            return loc[0][loc_type]
+'''
+SQLite database opened by the process that uses it, so objects holding one
+can be created before the processes are started.
+'''
+class SQLiteDB(object):
+    SCHEMA = []
+
+    def __init__(self, file_name):
+        self.fileName = file_name
+        self.cnx = None
+        self.pid = None
+
+    def connect(self):
+        if self.cnx is None or self.pid != os.getpid():
+            dirname = os.path.dirname(self.fileName)
+            if dirname != "" and not os.path.isdir(dirname):
+                os.makedirs(dirname, exist_ok=True)
+            self.cnx = sqlite3.connect(self.fileName, timeout=60)
+            self.cnx.row_factory = sqlite3.Row
+            with self.cnx:
+                for statement in self.SCHEMA:
+                    self.cnx.execute(statement)
+            self.pid = os.getpid()
+        return self.cnx
+
+
+'''
+Persistent cache of reverse DNS and WHOIS results, stored in an SQLite
+database. Entries expire after ttl seconds, or negative_ttl seconds for
+lookups that found nothing.
+'''
+class HostCache(SQLiteDB):
+    SCHEMA = ["CREATE TABLE IF NOT EXISTS lookup (kind TEXT, ip TEXT, value TEXT, expires REAL, "
+              "PRIMARY KEY (kind, ip))"]
+
+    def __init__(self, file_name, ttl=HOST_CACHE_TTL, negative_ttl=HOST_CACHE_NEGATIVE_TTL):
+        super().__init__(file_name)
+        self.ttl = ttl
+        self.negativeTtl = negative_ttl
+
+    def getMany(self, kind, ips):
+        cnx = self.connect()
+        found = {}
+        ips = list(ips)
+        now = time.time()
+        for i in range(0, len(ips), SQLITE_BATCH):
+            batch = ips[i:i + SQLITE_BATCH]
+            query = ("SELECT ip, value FROM lookup WHERE kind = ? AND expires > ? AND ip IN ({})"
+                     .format(", ".join(["?"] * len(batch))))
+            for ip, value in cnx.execute(query, [kind, now] + batch):
+                found[ip] = value
+        return found
+
+    def putMany(self, kind, values):
+        now = time.time()
+        rows = [(kind, ip, value, now + (self.negativeTtl if value == "N/A" else self.ttl))
+                for ip, value in values.items()]
+        with self.connect() as cnx:
+            cnx.executemany("INSERT OR REPLACE INTO lookup VALUES (?, ?, ?, ?)", rows)
+
+
+'''
+Reverse DNS and WHOIS lookups of IP addresses, made concurrently by at most
+workers threads, each lookup given timeout seconds from when it starts.
+Results are kept in memory and, if a HostCache is given, on disk between
+runs. The functions doing the lookups can be replaced, e.g. by a local stub
+in tests; each takes an IP address and returns a name, or an empty value if
+there is none. Lookups that raise an exception or time out count as "N/A"
+for the rest of the run, but are not cached, so the next run tries them
+again.
+
+A lookup that times out cannot be stopped, so its thread is left to finish
+in the background, and exits when it does, while another thread takes its
+place; at most workers threads take new lookups. The threads are
+daemon threads, so a lookup that hangs does not keep the process from
+exiting.
+'''
+class HostEnricher(object):
+    HOST = "host"
+    WHOIS = "whois"
+
+    def __init__(self, cache=None, timeout=LOOKUP_TIMEOUT, workers=LOOKUP_WORKERS, lookups=None):
+        self.cache = cache
+        self.timeout = timeout
+        self.workers = workers
+        self.lookups = {self.HOST: reverseLookup, self.WHOIS: whoisLookup}
+        if lookups is not None:
+            self.lookups.update(lookups)
+        self.results = {kind: {} for kind in self.lookups}
+
+    def get(self, kind, ip):
+        if ip not in self.results[kind]:
+            self.resolve([ip], kind)
+        return self.results[kind][ip]
+
+    def resolve(self, ips, kind):
+        results = self.results[kind]
+        ips = [ip for ip in set(ips) if ip not in results]
+        if len(ips) == 0:
+            return
 
-        return 'N/A'
+        if self.cache is not None:
+            cached = self.cache.getMany(kind, ips)
+            results.update(cached)
+            ips = [ip for ip in ips if ip not in cached]
+            if len(ips) == 0:
+                return
 
-    def loadIP(self, ip, chosen):
-        query = "SELECT * FROM IPLocation WHERE ip = %s AND chosen = %s"
-        try: 
-            self.cursor.execute(query, (str(ip), chosen))
-        except mysql.connector.errors.ProgrammingError as err:
-            print(self.cursor.statement)
-            print("Error: {}".format(err))
-    
-        try: 
-            rows = self.cursor.fetchall()
-        except mysql.connector.errors.InterfaceError:
-            return []
+        lookup = self.lookups[kind]
+        pending = list(reversed(ips))
+        started = {} #Time each running lookup started
+        resolved = {} #Names found, or None for lookups that failed or timed out
+        done = threading.Condition()
+
+        def work():
+            while True:
+                with done:
+                    if len(pending) == 0:
+                        return
+                    ip = pending.pop()
+                    started[ip] = time.monotonic()
+                try:
+                    value = lookup(ip) or "N/A"
+                except Exception:
+                    value = None
+                with done:
+                    #A lookup that timed out has had its thread replaced
+                    if started.pop(ip, None) is None:
+                        return
+                    resolved[ip] = value
+                    done.notify()
+
+        def startWorker():
+            threading.Thread(target=work, daemon=True).start()
+
+        with done:
+            for _ in range(min(self.workers, len(ips))):
+                startWorker()
+            while len(resolved) < len(ips):
+                now = time.monotonic()
+                for ip, start in list(started.items()):
+                    if now - start >= self.timeout:
+                        #The thread of a lookup that timed out is replaced
+                        del started[ip]
+                        resolved[ip] = None
+                        if len(pending) != 0:
+                            startWorker()
+                if len(resolved) < len(ips):
+                    first = min(started.values(), default=now)
+                    done.wait(max(first + self.timeout - now, 0.01))
+
+        results.update({ip: "N/A" if value is None else value for ip, value in resolved.items()})
+        if self.cache is not None:
+            self.cache.putMany(kind, {ip: value for ip, value in resolved.items() if value is not None})
+
+
+'''
+Locates IP addresses with the RIPE IPmap API. Locations are stored in a
+location store (SQLiteLocationStore, or MySQLLocationStore for the MeddleDB
+server) and looked up for many addresses at once. A store has the methods
+loadIPs(ips, chosen=None), returning ip -> list of its locations ordered by
+score, highest first (only those with the given chosen flag, if any),
+saveLocations(rows) and selectChosenLocations(location_ids). Rows are
+dictionaries with at least the id, ip, score, chosen and countryCodeAlpha2
+fields. Addresses that are not
+stored yet are probed concurrently, at most rate requests per second, and
+their locations are saved in one transaction. The API is reached through
+url, so a local fake server can stand in for it.
+'''
+class RipeProbe(object):
+    def __init__(self, store, url=RIPE_URL, workers=RIPE_WORKERS, rate=RIPE_RATE, timeout=RIPE_TIMEOUT):
+        self.store = store
+        self.url = url
+        self.workers = workers
+        self.timeout = timeout
+        self.rateLimiter = RateLimiter(rate)
+        self.results = {}
 
-        return rows
+    def getIPLocation(self, ip, loc_type):
+        return self.getIPLocations([ip], loc_type)[ip]
+
+    '''
+    Returns a dictionary with the loc_type field of the chosen location of
+    every IP address, or "N/A" if no location has been chosen for it.
+    '''
+    def getIPLocations(self, ips, loc_type):
+        ips = set(ips)
+        missing = [ip for ip in ips if ip not in self.results]
+        if len(missing) != 0:
+            chosen = self.store.loadIPs(missing, 1)
+            unchosen = self.store.loadIPs([ip for ip in missing if ip not in chosen], 0)
+            #Addresses already probed whose location could not be chosen yet are not probed again
+            probed = self.probeMany([ip for ip in missing if ip not in chosen and ip not in unchosen])
+            self.saveIPLocations(probed)
+            chosen.update(self.chooseLocations(list(probed)))
+
+            for ip in missing:
+                self.results[ip] = chosen[ip][0] if ip in chosen else None
+
+        return {ip: self.getField(ip, loc_type) for ip in ips}
+
+    def getField(self, ip, loc_type):
+        loc = self.results.get(ip)
+        if loc is None:
+            return 'N/A'
+        return loc[loc_type]
 
     def probe(self, ip):
+        self.rateLimiter.wait()
         try:
-            response = urllib.request.urlopen(self.url.format(ip), timeout=20)
+            response = urllib.request.urlopen(self.url.format(ip), timeout=self.timeout)
             res = response.read()
             jRes = json.loads(res)
       
@@ -193,59 +493,58 @@ class RipeProbe(object):
             print ('RIPE Request fail...', e, self.url.format(ip))
             return {}
 
-    def saveIPLocations(self, ip, locs):
-        timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        for loc in locs:
-            loc['ip'] = str(ip)
-            loc['probedAt'] = timestamp
-            loc['locationId'] = loc.pop('id')
-            try:
-                if loc['stateName'] is None:
-                    loc['stateName'] = ""
-            except KeyError:
-                loc['stateNme'] = ""
-            self.saveIPLocation(loc)
+    def probeMany(self, ips):
+        if len(ips) == 0:
+            return {}
 
-        self.cnx.commit()
+        with ThreadPoolExecutor(max_workers=min(self.workers, len(ips))) as executor:
+            responses = dict(zip(ips, executor.map(self.probe, ips)))
 
-    def saveIPLocation(self, loc):
-        placeholders = ', '.join(["%s"] * len(loc))
-        fields = ", ".join(list(loc.keys()))
-        query = "INSERT INTO IPLocation ({}) VALUES({})".format(fields, placeholders)
-        try: 
-            self.cursor.execute(query, list(loc.values()))
-        except(mysql.connector.errors.ProgrammingError, mysql.connector.errors.IntegrityError) as err:
-            print(self.cursor.statement)
-            print("Error: {}".format(err))
-            print(query, list(loc.values()))
-            #sys.exit()
+        return {ip: res['locations'] for ip, res in responses.items() if 'locations' in res}
 
-    def chooseLocationForIP(self, ip):
-        query = "SELECT * FROM IPLocation WHERE ip = %s ORDER BY score DESC"
-    
-        try: 
-            self.cursor.execute(query, [str(ip)])
-        except mysql.connector.errors.ProgrammingError as err:
-            print(self.cursor.statement)
-            print("Error: {}".format(err))
-    
-        try:
-            rows = self.cursor.fetchall()
-        except mysql.connector.errors.InterfaceError:
-            # if there are no locations, return
-            return
-    
+    def saveIPLocations(self, probed):
+        timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        rows = []
+        for ip, locs in probed.items():
+            for loc in locs:
+                loc = dict(loc)
+                loc['ip'] = str(ip)
+                loc['probedAt'] = timestamp
+                loc['locationId'] = loc.pop('id')
+                if loc.get('stateName') is None:
+                    loc['stateName'] = ""
+                rows.append(loc)
+
+        if len(rows) != 0:
+            self.store.saveLocations(rows)
+
+    '''
+    Chooses a location for each of the IP addresses from its stored
+    locations and returns the chosen ones, in the same form as the loadIPs
+    method of the store.
+    '''
+    def chooseLocations(self, ips):
+        chosen = {}
+        if len(ips) == 0:
+            return chosen
+
+        for ip, rows in self.store.loadIPs(ips).items():
+            loc = self.chooseLocation(rows)
+            if loc is not None:
+                chosen[ip] = [loc]
+
+        self.store.selectChosenLocations([loc[0]['id'] for loc in chosen.values()])
+        return chosen
+
+    #rows are the locations of one IP address, ordered by score
+    def chooseLocation(self, rows):
         # if there is at least 90% confidence, choose the location
-        try:
-            if rows[0]['score'] >= 90:
-                self.selectChosenLocation(rows[0]['id'])
-                return
-        except IndexError:
-            return 
-    
+        if rows[0]['score'] >= 90:
+            return rows[0]
+
         # if there are not enough records, try again later
         if len(rows) < 20:
-            return
+            return None
 
         # lets choose the country using weighted average and choose the location
         # with highest score from given country
@@ -260,12 +559,127 @@ class RipeProbe(object):
     
         for loc in rows:
             if loc['countryCodeAlpha2'] == country:
-                self.selectChosenLocation(loc['id'])
-                return 
+                return loc
+
+
+'''
+Spaces out calls to wait() so at most rate of them return per second. The
+time of the next free slot is kept in shared memory, behind a lock shared
+by threads and processes, so the processes forked after the RateLimiter is
+made share the rate instead of each having its own: analyze.py -n N still
+makes at most rate requests per second in total.
+'''
+class RateLimiter(object):
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0
+        self.next = multiprocessing.Value("d", 0.0)
+
+    def wait(self):
+        with self.next.get_lock():
+            now = time.monotonic()
+            start = max(now, self.next.value)
+            self.next.value = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+#Returns ip -> list of the location rows of each IP address, in the order of rows
+def groupByIP(rows):
+    locs = {}
+    for row in rows:
+        locs.setdefault(row['ip'], []).append(row)
+    return locs
+
+
+class SQLiteLocationStore(SQLiteDB):
+    COLUMNS = ["ip", "locationId", "countryCodeAlpha2", "stateName", "cityName", "score", "probedAt"]
+    SCHEMA = ["CREATE TABLE IF NOT EXISTS IPLocation (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+              "ip TEXT NOT NULL, locationId INTEGER, countryCodeAlpha2 TEXT, stateName TEXT, "
+              "cityName TEXT, score REAL, chosen INTEGER NOT NULL DEFAULT 0, probedAt TEXT, "
+              "location TEXT)",
+              "CREATE INDEX IF NOT EXISTS IPLocationIP ON IPLocation (ip, chosen)"]
+
+    def loadIPs(self, ips, chosen=None):
+        cnx = self.connect()
+        ips = list(ips)
+        rows = []
+        for i in range(0, len(ips), SQLITE_BATCH):
+            batch = ips[i:i + SQLITE_BATCH]
+            query = "SELECT * FROM IPLocation WHERE ip IN ({})".format(", ".join(["?"] * len(batch)))
+            if chosen is not None:
+                query += " AND chosen = {:d}".format(chosen)
+            query += " ORDER BY score DESC"
+            rows.extend(self.toDict(row) for row in cnx.execute(query, batch))
+        return groupByIP(rows)
+
+    def toDict(self, row):
+        loc = json.loads(row['location'] or "{}")
+        loc.update({key: row[key] for key in row.keys() if key != 'location'})
+        return loc
+
+    def saveLocations(self, rows):
+        values = [[row.get(col) for col in self.COLUMNS] + [json.dumps(row)] for row in rows]
+        query = "INSERT INTO IPLocation ({}, location) VALUES ({})".format(
+            ", ".join(self.COLUMNS), ", ".join(["?"] * (len(self.COLUMNS) + 1)))
+        with self.connect() as cnx:
+            cnx.executemany(query, values)
+
+    def selectChosenLocations(self, location_ids):
+        with self.connect() as cnx:
+            cnx.executemany("UPDATE IPLocation SET chosen = 1 WHERE id = ?",
+                            [[location_id] for location_id in location_ids])
+
+
+class MySQLLocationStore(object):
+    def __init__(self):
+        self.cnx = mysql.connector.connect(user='meddle', password='meddle',
+            host='127.0.0.1', database='MeddleDB')
+        self.cursor = self.cnx.cursor(dictionary=True)
+
+    def loadIPs(self, ips, chosen=None):
+        ips = [str(ip) for ip in ips]
+        if len(ips) == 0:
+            return {}
+
+        query = "SELECT * FROM IPLocation WHERE ip IN ({})".format(", ".join(["%s"] * len(ips)))
+        params = list(ips)
+        if chosen is not None:
+            query += " AND chosen = %s"
+            params.append(chosen)
+        query += " ORDER BY score DESC"
+        try: 
+            self.cursor.execute(query, params)
+        except mysql.connector.errors.ProgrammingError as err:
+            print(self.cursor.statement)
+            print("Error: {}".format(err))
+    
+        try: 
+            rows = self.cursor.fetchall()
+        except mysql.connector.errors.InterfaceError:
+            return {}
+
+        return groupByIP(rows)
 
-    def selectChosenLocation(self, locationId):
+    def saveLocations(self, rows):
+        #Rows with the same fields are inserted together
+        groups = {}
+        for row in rows:
+            groups.setdefault(tuple(row.keys()), []).append(list(row.values()))
+
+        for fields, values in groups.items():
+            placeholders = ', '.join(["%s"] * len(fields))
+            query = "INSERT INTO IPLocation ({}) VALUES({})".format(", ".join(fields), placeholders)
+            try: 
+                self.cursor.executemany(query, values)
+            except(mysql.connector.errors.ProgrammingError, mysql.connector.errors.IntegrityError) as err:
+                print(self.cursor.statement)
+                print("Error: {}".format(err))
+
+        self.cnx.commit()
+
+    def selectChosenLocations(self, location_ids):
         query = "UPDATE IPLocation set chosen = 1 WHERE id = %s"
-        self.cursor.execute(query, [locationId])
+        self.cursor.executemany(query, [[location_id] for location_id in location_ids])
         self.cnx.commit()
 
 
@@ -273,41 +687,114 @@ class IPMapping(object):
     def __init__(self):
         self.host = {}
         self.ip = {}
+        self.prefixIndex = PrefixIndex()
 
     #tshark -z option seems to return a CNAME but is sometimes not the correct one
     #However, the correct host is in the details of running "tshark -r [pcap_file]"
-    #This method searches for the line containing the host name and checks
-    #accuracy by making sure that the ip is also in that line
-    def get_correct_host(self, details, host, ip):
+    #The lines of the details that contain an A record are indexed once by
+    #index_details, so each correction is a dictionary lookup
+    def index_details(self, details):
+        exact = {}
+        lines = {}
         for line in details.splitlines(): #loop through lines in detailed tshark output
-            if host in line and ip in line:
-                line = line.split()
-                for idx, word in enumerate(line): #loop through words in line
-                    if word == "A":
-                        return line[idx + 1]
+            words = line.split()
+            try:
+                answer = words[words.index("A") + 1]
+            except (ValueError, IndexError):
+                continue
+
+            for ip in words:
+                if not self.isIPAddr(ip):
+                    continue
+                lines.setdefault(ip, []).append((line, answer))
+                for word in words:
+                    exact.setdefault((ip, word), answer)
+
+        return exact, lines
+
+    #Returns the host from the first line containing both the host name and
+    #the ip. Whole words are looked up directly; partial host names fall back
+    #to checking the lines that contain the ip.
+    def get_correct_host(self, details, host, ip):
+        exact, lines = details
+        if (ip, host) in exact:
+            return exact[(ip, host)]
+
+        for line, answer in lines.get(ip, []):
+            if host in line:
+                return answer
 
         return None
 
-    def extractFromFile(self, pcap_file, host_file=""):
+    def isIPAddr(self, ip):
+        for family in [socket.AF_INET, socket.AF_INET6]:
+            try:
+                socket.inet_pton(family, ip)
+                return True
+            except OSError:
+                pass
+        return False
+
+    #hosts is a list of (ip, host) pairs already read with readHostFile; it is
+    #used instead of host_file so a shared hosts file is only parsed once
+    def extractFromFile(self, pcap_file, host_file="", hosts=None):
         #run "tshark -r [pcap_file]" - gets the details which contain correct host
-        details = str(os.popen("tshark -r %s" % pcap_file).read())
+        details = self.index_details(str(os.popen("tshark -r %s" % pcap_file).read()))
+        if hosts is None:
+            hosts = self.readHostFile(host_file)
+        if hosts is None:
+            hosts = self.parseHostLines(os.popen("tshark -r %s -q -z hosts" % pcap_file).read()
+                                        .split("\n"))
+
+        for ip, host in hosts:
+            #Get the correct host name
+            tmp_host = self.get_correct_host(details, host, ip)
+            if tmp_host is not None:
+                host = tmp_host
+
+            self.addHostIP(host.strip(), ip)
+
+    def extractFromTracker(self, tracker, host_file="", hosts=None):
+        if hosts is None:
+            hosts = self.readHostFile(host_file)
+
+        for ip, host in hosts or []:
+            #Same correction as get_correct_host, using the DNS responses in the pcap
+            tmp_host = tracker.getQuestion(ip, host)
+            if tmp_host is not None:
+                host = tmp_host
+
+            self.addHostIP(host.strip(), ip)
+
+        for ip, host in tracker.getHosts():
+            self.addHostIP(host, ip)
+
+    #Returns the (ip, host) pairs of a "tshark -z hosts" file, or None if the
+    #file cannot be read
+    def readHostFile(self, host_file):
         if host_file == "" or not os.path.isfile(host_file) or not os.access(host_file, os.R_OK):
-            hosts = str(os.popen("tshark -r %s -q -z hosts" % pcap_file).read()).split("\n")
-        else:
-            with open(host_file) as f:
-                hosts = f.readlines()
-                
-        for host_line in hosts:
+            return None
+
+        with open(host_file) as f:
+            return self.parseHostLines(f)
+
+    def parseHostLines(self, lines):
+        hosts = []
+        for host_line in lines:
             try:
                 ip, host = host_line.strip().split("\t")
-                #Get the correct host name
-                tmp_host = self.get_correct_host(details, host, ip)
-                if tmp_host is not None:
-                    host = tmp_host
-
-                self.addHostIP(host.strip(), ip)
+                hosts.append((ip, host))
             except ValueError:
-                pass 
+                pass
+
+        return hosts
+
+    #Makes this mapping use the org and country tables already loaded by
+    #another mapping instead of loading them again
+    def shareMappings(self, ip_map):
+        self.orgIndex = ip_map.orgIndex
+        self.countryIndex = ip_map.countryIndex
+        self.prefixIndex = ip_map.prefixIndex
 
     def addHostIP(self, host, ip):
         if ip not in self.ip:
@@ -329,27 +816,114 @@ class IPMapping(object):
         return ["N/A"]
 
     def loadOrgMapping(self, file_name):
-        self.orgMapping = pd.read_csv(file_name)
+        self.orgIndex = self.indexMapping(file_name)
 
     def loadCountryMapping(self, file_name):
-        self.countryMapping = pd.read_csv(file_name)
+        self.countryIndex = self.indexMapping(file_name)
+
+    #Adds the networks of an ASN/prefix table, used for addresses that are not
+    #in the org and country tables
+    def loadPrefixTable(self, file_name):
+        self.prefixIndex.loadCsv(file_name)
+
+    #Builds an ip -> row dictionary so lookups do not scan the whole table.
+    #The first row of an ip wins, as it did with iloc[0] on the filtered table.
+    def indexMapping(self, file_name):
+        index = {}
+        with open(file_name, newline="") as f:
+            for row in csv.DictReader(f):
+                index.setdefault(row["ip"], row)
+        return index
 
     def getOrg(self, ip, column = "org"):
-        org = self.orgMapping[self.orgMapping['ip'] == ip]
-        if org.empty:
+        org = self.orgIndex.get(ip)
+        if org is None:
+            return self.getPrefixField(ip, column)
+        if org[column] == "":
             return "N/A"
-        return org.iloc[0][column]
+        return org[column]
 
     def getCountry(self, ip):
-        country = self.countryMapping[self.countryMapping['ip'] == ip]
+        country = self.countryIndex.get(ip)
 
-        if country.empty:
+        if country is None:
             country = self.getOrg(ip, 'country')
-            if country != "None":
+            if country not in ["None", "N/A"]:
                 return country
+            return self.getPrefixField(ip, 'country')
+
+        return country['country']
+
+    def getPrefixField(self, ip, column):
+        row = self.prefixIndex.lookup(ip)
+        if row is None or not row.get(column) or row[column] == "None":
             return "N/A"
+        return row[column]
+
 
-        return country.iloc[0]['country']
+'''
+Longest-prefix-match index over IPv4 and IPv6 networks. Each family keeps a
+dictionary per prefix length, keyed by the network address shifted down to
+its prefix bits, so a lookup is one dictionary probe per prefix length in
+the table, most specific first, however many networks are loaded. Values
+are the table rows, as dictionaries.
+'''
+class PrefixIndex(object):
+    BITS = {4: 32, 6: 128}
+
+    def __init__(self):
+        self.networks = {4: {}, 6: {}}
+        self.lengths = {4: [], 6: []}
+
+    def __len__(self):
+        return sum(len(nets) for family in self.networks.values() for nets in family.values())
+
+    def add(self, network, row):
+        network = ipaddress.ip_network(network, strict=False)
+        shift = self.BITS[network.version] - network.prefixlen
+        nets = self.networks[network.version].get(network.prefixlen)
+        if nets is None:
+            nets = self.networks[network.version][network.prefixlen] = {}
+            self.lengths[network.version] = sorted(self.networks[network.version], reverse=True)
+        #The first row of a network wins, as in IPMapping.indexMapping
+        nets.setdefault(int(network.network_address) >> shift, row)
+
+    '''
+    Loads a CSV file with a header. Networks are given either in a "prefix"
+    column in CIDR notation or as a range in "start" and "end" columns, which
+    is split into the networks covering it. The other columns (e.g. org,
+    country, asn) are returned by lookup.
+    '''
+    def loadCsv(self, file_name):
+        with open(file_name, newline="") as f:
+            for row in csv.DictReader(f):
+                if row.get("prefix"):
+                    self.add(row["prefix"].strip(), row)
+                else:
+                    start = ipaddress.ip_address(row["start"].strip())
+                    end = ipaddress.ip_address(row["end"].strip())
+                    for network in ipaddress.summarize_address_range(start, end):
+                        self.add(network, row)
+
+    #Returns the row of the most specific network containing ip, or None
+    def lookup(self, ip):
+        try:
+            if ":" in ip:
+                version = 6
+                addr = int.from_bytes(socket.inet_pton(socket.AF_INET6, ip), "big")
+            else:
+                version = 4
+                addr = int.from_bytes(socket.inet_aton(ip), "big")
+        except (OSError, TypeError):
+            return None
+
+        networks = self.networks[version]
+        bits = self.BITS[version]
+        for length in self.lengths[version]:
+            row = networks[length].get(addr >> (bits - length))
+            if row is not None:
+                return row
+        return None
 
 
 class UndefinedMethodError(Exception):
@@ -0,0 +1,189 @@
+import json
+import os
+import tempfile
+import time
+
+from . import DataPresentation
+
+'''
+Journal of an output CSV file, which makes appending the rows of a pcap
+file to it a transaction. It is stored next to the CSV as a JSON lines
+file. The process writing the output appends the rows of a pcap file,
+syncs them to disk, and then commits them with a line holding the new size
+of the CSV. Rows after the last commit were written by a run that was
+interrupted; they are removed when the next run starts, and their pcap
+files are analyzed again. Rewriting the whole CSV (removing or sorting
+rows) is marked before it starts, with the pcap files whose rows are
+removed, and ends with a checkpoint of the new size.
+
+The processes analyzing the pcap files also record each file they begin
+and each file they fail to analyze, with the reason, so the files that
+failed in a run can be listed at its end. A file fails only if its rows
+are not committed; problems after the commit, such as a plot that cannot
+be drawn, are recorded as warnings. Every line is appended with one
+write, so the lines of different processes do not mix.
+'''
+class Journal(object):
+    START = "start"
+    BEGIN = "begin"
+    COMMIT = "commit"
+    FAIL = "fail"
+    WARN = "warn"
+    REWRITE = "rewrite"
+    CHECKPOINT = "checkpoint"
+
+    def __init__(self, file_name, out_file):
+        self.fileName = file_name
+        self.outFile = out_file
+
+    @staticmethod
+    def forOutput(out_file):
+        return Journal(os.path.splitext(out_file)[0] + "_journal.jsonl", out_file)
+
+    def load(self):
+        events = []
+        if not os.path.isfile(self.fileName):
+            return events
+
+        with open(self.fileName) as f:
+            for line in f:
+                try:
+                    events.append(json.loads(line))
+                except ValueError:
+                    #A line cut short by an interrupted run
+                    pass
+        return events
+
+    def append(self, event, sync=False):
+        fd = os.open(self.fileName, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, (json.dumps(event) + "\n").encode("utf-8"))
+            if sync:
+                os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    '''
+    Brings the output file back to its last committed state: removes the rows
+    written after the last commit, unless the file was being rewritten, in
+    which case it is whole either way. Adds the pcap files committed since the
+    last checkpoint to the manifest, in case the run stopped before it could.
+    If the rewrite was removing the rows of some pcap files, their rows are
+    removed again, as the file may still be the old one, and so are their
+    manifest entries, so they are analyzed again. The journal is then
+    replaced by a checkpoint of the output file.
+    Returns the number of bytes removed.
+    '''
+    def recover(self, manifest):
+        end = None
+        rewriting = False
+        removing = []
+        committed = []
+        for event in self.load():
+            if event["event"] == Journal.REWRITE:
+                rewriting = True
+                removing = event.get("files", [])
+            elif event["event"] == Journal.CHECKPOINT:
+                end = event["end"]
+                rewriting = False
+                committed = []
+            elif event["event"] == Journal.COMMIT:
+                end = event["end"]
+                committed.append(event["file"])
+
+        removed = 0
+        size = os.path.getsize(self.outFile)
+        if end is not None and not rewriting and size > end:
+            with open(self.outFile, "r+b") as f:
+                f.truncate(end)
+                os.fsync(f.fileno())
+            removed = size - end
+
+        for info in committed:
+            if not manifest.isCurrent(info):
+                manifest.add(info)
+
+        if rewriting and len(removing) != 0:
+            DataPresentation.DomainExport.remove_rows(self.outFile, removing)
+            manifest.remove(removing)
+
+        self.reset()
+        return removed
+
+    #Replaces the journal with a checkpoint of the output file
+    def reset(self):
+        dirname = os.path.dirname(self.fileName) or "."
+        tmp_fd, tmp_file = tempfile.mkstemp(dir=dirname, suffix=".jsonl")
+        with os.fdopen(tmp_fd, "w") as f:
+            f.write(json.dumps(self.event(Journal.CHECKPOINT, end=os.path.getsize(self.outFile))) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp_file, 0o644)
+        os.replace(tmp_file, self.fileName)
+
+    def event(self, kind, **fields):
+        fields["event"] = kind
+        fields["time"] = time.time()
+        return fields
+
+    def start(self, files):
+        self.append(self.event(Journal.START, files=files))
+
+    def begin(self, pcap_file, worker):
+        self.append(self.event(Journal.BEGIN, path=pcap_file, worker=worker))
+
+    #Commits the rows of a pcap file, once they are synced to disk, and the output file ends at end
+    def commit(self, info, end):
+        self.append(self.event(Journal.COMMIT, path=info["path"], file=info, end=end), sync=True)
+
+    def fail(self, pcap_file, worker, error):
+        self.append(self.event(Journal.FAIL, path=pcap_file, worker=worker, error=error))
+
+    def warn(self, pcap_file, worker, warning):
+        self.append(self.event(Journal.WARN, path=pcap_file, worker=worker, warning=warning))
+
+    #Marks the start of a rewrite of the output file removing the rows of pcap_files
+    def rewrite(self, pcap_files=()):
+        self.append(self.event(Journal.REWRITE, files=list(pcap_files)), sync=True)
+
+    def checkpoint(self):
+        self.append(self.event(Journal.CHECKPOINT, end=os.path.getsize(self.outFile)), sync=True)
+
+    #Returns the events of the last run
+    def lastRun(self):
+        events = []
+        for event in self.load():
+            if event["event"] == Journal.START:
+                events = []
+            events.append(event)
+        return events
+
+    '''
+    Returns the pcap files that failed in the last run, with the reasons,
+    sorted by path. Files whose rows were committed did not fail. Files that
+    were begun but neither committed nor failed were being analyzed by a
+    process that died; exit_codes maps the workers to the exit codes of
+    their processes.
+    '''
+    def failures(self, exit_codes):
+        begun = {}
+        failed = {}
+        committed = set()
+        for event in self.lastRun():
+            if event["event"] == Journal.BEGIN:
+                begun[event["path"]] = event["worker"]
+            elif event["event"] == Journal.FAIL:
+                failed[event["path"]] = event["error"]
+            elif event["event"] == Journal.COMMIT:
+                committed.add(event["path"])
+
+        for pcap_file, worker in begun.items():
+            if pcap_file not in failed:
+                failed[pcap_file] = ("the process %s analyzing it exited with code %s"
+                                     % (worker, exit_codes.get(worker)))
+        return sorted((f, error) for f, error in failed.items() if f not in committed)
+
+    #Returns the warnings of the last run, sorted by path
+    def warnings(self):
+        return sorted((event["path"], event["warning"]) for event in self.lastRun()
+                      if event["event"] == Journal.WARN)
@@ -0,0 +1,84 @@
+import json
+import os
+import tempfile
+
+
+'''
+Record of the pcap files whose rows are already in an output CSV file. It
+is stored next to the CSV as a JSON lines file with one entry per analyzed
+pcap file, keyed by path and identified by size and modification time. New
+entries are appended as files are written, so an interrupted run keeps what
+it has finished; the last entry of a path wins.
+'''
+class Manifest(object):
+    def __init__(self, file_name):
+        self.fileName = file_name
+        self.entries = {}
+        self.load()
+
+    @staticmethod
+    def forOutput(out_file):
+        return Manifest(os.path.splitext(out_file)[0] + "_manifest.jsonl")
+
+    #Entries are keyed by the real path of the pcap file, so the same file is
+    #found however it was reached (trailing slashes, .., symlinks, another cwd)
+    @staticmethod
+    def key(pcap_file):
+        return os.path.realpath(pcap_file)
+
+    @staticmethod
+    def fileInfo(pcap_file):
+        st = os.stat(pcap_file)
+        return {"path": Manifest.key(pcap_file), "size": st.st_size, "mtime": st.st_mtime_ns}
+
+    def load(self):
+        if not os.path.isfile(self.fileName):
+            return
+
+        with open(self.fileName) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                    #Entries written before paths were normalised are relative to the cwd
+                    entry["path"] = Manifest.key(entry["path"])
+                    self.entries[entry["path"]] = entry
+                except (ValueError, KeyError):
+                    #A line cut short by an interrupted run
+                    pass
+
+    def isCurrent(self, info):
+        entry = self.entries.get(info["path"])
+        return entry is not None and entry["size"] == info["size"] and entry["mtime"] == info["mtime"]
+
+    def __contains__(self, pcap_file):
+        return Manifest.key(pcap_file) in self.entries
+
+    def add(self, info):
+        self.entries[info["path"]] = info
+        with open(self.fileName, "a") as f:
+            f.write(json.dumps(info) + "\n")
+
+    def remove(self, pcap_files):
+        for pcap_file in pcap_files:
+            self.entries.pop(Manifest.key(pcap_file), None)
+        self.save()
+
+    #Replaces the entries with those of other manifests, e.g. those of the shards of an output file
+    def merge(self, manifests):
+        self.entries = {}
+        for manifest in manifests:
+            self.entries.update(manifest.entries)
+        self.save()
+
+    def clear(self):
+        self.entries = {}
+        self.save()
+
+    #Rewrites the file with one line per entry
+    def save(self):
+        dirname = os.path.dirname(self.fileName) or "."
+        tmp_fd, tmp_file = tempfile.mkstemp(dir=dirname, suffix=".jsonl")
+        with os.fdopen(tmp_fd, "w") as f:
+            for entry in self.entries.values():
+                f.write(json.dumps(entry) + "\n")
+        os.replace(tmp_file, self.fileName)
@@ -4,28 +4,60 @@ from . import Stats
 from . import Constants
 
 
+'''
+NodeStats of every device in a device list, keyed by MAC address. Each
+packet is given to the devices that sent or received it, so a capture
+containing several devices is processed once for all of them. Packets
+between two unknown MAC addresses are ignored.
+'''
 class Nodes(object):
-    def __init__(self):
+    def __init__(self, base_ts=0, devices=None, series=Constants.Series.MEMORY, window=0):
         self.nodes = {}
-
-    def __getitem__(self, nodeId):
-        if nodeId not in self.nodes:
-            self.nodes[nodeId] = NodeStats(nodeId)
+        self.baseTS = base_ts
+        self.devices = devices
+        self.series = series
+        self.window = window
+
+    def __getitem__(self, mac):
+        if mac not in self.nodes:
+            node_id = NodeId(mac)
+            node_id.deviceName = self.devices.getDeviceName(mac)
+            self.nodes[mac] = NodeStats(node_id, self.baseTS, self.devices, self.series,
+                                        self.window)
     
-        return self.nodes[nodeId]
+        return self.nodes[mac]
 
-    def __contains__(self, nodeId):
-        if nodeId in self.nodes:
+    def __contains__(self, mac):
+        if mac in self.nodes:
             return True
         return False
 
+    def __iter__(self):
+        return iter(self.nodes.values())
+
+    def processPacket(self, packet):
+        try:
+            src = packet.eth.src
+            dst = packet.eth.dst
+        except AttributeError:
+            return
+
+        if self.devices.getDeviceName(src) is not None:
+            self[src].processPacket(packet)
+        if dst != src and self.devices.getDeviceName(dst) is not None:
+            self[dst].processPacket(packet)
+
 
 class NodeStats(object):
-    def __init__(self, node_id, base_ts=0, devices=None):
+    def __init__(self, node_id, base_ts=0, devices=None, series=Constants.Series.MEMORY, window=0):
         self.nodeId = node_id
         self.desc = ""
         self.baseTS = base_ts
+        self.series = series
+        self.window = window
         self.devices = devices
+        self.deviceNames = devices.names if devices is not None else {}
+        self.addrs = {}
         self.stats = Stats.Stats(self)
         self.extractLayers()
 
@@ -37,15 +69,33 @@ class NodeStats(object):
             self.proc_pckt(packet, Constants.Direction.SND, Constants.Direction.RCV)
 
     def proc_pckt(self, packet, dir1, dir2):
-        addr = NodeId()
-        addr.extractFromPacket(packet, dir1, self.devices)
-        packet.addr = addr
+        packet.addr = self.getAddr(packet, dir1)
         for layer in packet.layers:
             if layer.layer_name not in self.layersToProcess:
                 continue
             stats = self.stats.getStats(layer.layer_name, dir2)
             stats.processLayer(packet, layer)
 
+    #The NodeId of the other end of a packet. There is one NodeId per (mac, ip)
+    #pair, shared by all of its packets, instead of a new one per packet.
+    def getAddr(self, packet, direction):
+        ip_layer = getattr(packet, Constants.Layer.IP, None)
+        if direction == Constants.Direction.SND:
+            mac = packet.eth.src
+            ip = ip_layer.src if ip_layer is not None else None
+        else:
+            mac = packet.eth.dst
+            ip = ip_layer.dst if ip_layer is not None else None
+
+        try:
+            return self.addrs[(mac, ip)]
+        except KeyError:
+            addr = self.addrs[(mac, ip)] = NodeId(mac)
+            addr.ip = ip
+            addr.deviceName = self.deviceNames.get(mac)
+            addr.key = addr.getAddr()
+            return addr
+
     def extractLayers(self):
         layers = defaultdict(int)
         layers['eth'] += 1
@@ -54,11 +104,15 @@ class NodeStats(object):
 
 
 class NodeId(object):
+    __slots__ = ["mac", "ip", "deviceName", "ipHistory", "key"]
+
     def __init__(self, mac=None, ip=None, time=0):
         self.mac = mac
         self.ip = ip
         self.deviceName = None
         self.ipHistory = []
+        #Address the packets of this NodeId are counted under in Stats
+        self.key = None
         if ip is not None:
             self.ipHistory.append((ip, time))
     
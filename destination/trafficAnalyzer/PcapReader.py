@@ -0,0 +1,307 @@
+import socket
+import struct
+import sys
+
+from . import Constants
+
+
+'''
+Native pcap/pcapng reader. The packets it yields expose the subset of the
+pyshark packet interface used by Node.NodeStats and Stats.StatsData
+(packet.eth, packet.ip, packet.frame_info.time_epoch, packet.length and
+packet.layers), so the aggregation code does not depend on where the
+packets come from. Only the Ethernet, IPv4, IPv6, TCP and UDP headers are
+decoded; everything above the transport layer is left in packet.payload.
+Linux cooked captures (SLL and SLL2, e.g. from "tcpdump -i any") are read
+too: their header has no destination address, so their eth layer only has
+the link-layer address of the sender as src, and an empty dst.
+Frames shorter than their link-layer header are skipped and counted in runts,
+and a last record cut short by an interrupted capture sets truncated, so
+the caller can report both.
+'''
+
+PCAP_MAGIC = {
+    b"\xd4\xc3\xb2\xa1": ("<", 1e-6),
+    b"\xa1\xb2\xc3\xd4": (">", 1e-6),
+    b"\x4d\x3c\xb2\xa1": ("<", 1e-9),
+    b"\xa1\xb2\x3c\x4d": (">", 1e-9),
+}
+PCAPNG_SHB = 0x0A0D0D0A
+PCAPNG_BYTE_ORDER = 0x1A2B3C4D
+PCAPNG_IDB = 0x00000001
+PCAPNG_PB = 0x00000002
+PCAPNG_SPB = 0x00000003
+PCAPNG_EPB = 0x00000006
+PCAPNG_IF_TSRESOL = 9
+
+LINKTYPE_ETHERNET = 1
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_LINUX_SLL2 = 276
+#Length of the link-layer header of each supported link type
+LINK_HEADER_LEN = {LINKTYPE_ETHERNET: 14, LINKTYPE_LINUX_SLL: 16, LINKTYPE_LINUX_SLL2: 20}
+
+ETH_IPV4 = 0x0800
+ETH_IPV6 = 0x86DD
+ETH_VLAN = (0x8100, 0x88A8, 0x9100)
+IP_PROTO_TCP = 6
+IP_PROTO_UDP = 17
+IPV6_EXT_HEADERS = (0, 43, 60)
+IPV6_FRAGMENT = 44
+
+
+class PcapError(Exception):
+    pass
+
+
+class Layer(object):
+    def __init__(self, layer_name, **fields):
+        self.layer_name = layer_name
+        self.field_names = list(fields)
+        self.__dict__.update(fields)
+
+
+class FrameInfo(object):
+    def __init__(self, time_epoch, length, number):
+        self.time_epoch = time_epoch
+        self.len = length
+        self.number = number
+
+
+class Packet(object):
+    def __init__(self, frame_info):
+        self.frame_info = frame_info
+        self.length = frame_info.len
+        self.layers = []
+        self.payload = b""
+
+    def addLayer(self, layer):
+        self.layers.append(layer)
+        setattr(self, layer.layer_name, layer)
+
+
+class PcapReader(object):
+    def __init__(self, file_name):
+        self.fileName = file_name
+        self.file = open(file_name, "rb")
+        self.packetNum = 0
+        self.runts = 0
+        self.truncated = False
+        self.macCache = {}
+        self.ipCache = {}
+
+    def __iter__(self):
+        magic = self.file.read(4)
+        self.file.seek(0)
+        if magic in PCAP_MAGIC:
+            return self.readPcap()
+        elif len(magic) == 4 and struct.unpack("<I", magic)[0] == PCAPNG_SHB:
+            return self.readPcapng()
+        elif len(magic) == 0:
+            return iter(())
+        raise PcapError("\"%s\" is not a pcap or pcapng file" % self.fileName)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.file.close()
+
+    def readPcap(self):
+        header = self.file.read(24)
+        if len(header) < 24:
+            return
+        endian, resolution = PCAP_MAGIC[header[:4]]
+        link_type = struct.unpack(endian + "I", header[20:24])[0] & 0x0FFFFFFF
+        self.checkLinkType(link_type)
+
+        record = struct.Struct(endian + "IIII")
+        read = self.file.read
+        while True:
+            rec_header = read(16)
+            if len(rec_header) < 16:
+                self.truncated = len(rec_header) != 0
+                return
+            ts_sec, ts_frac, incl_len, orig_len = record.unpack(rec_header)
+            data = read(incl_len)
+            if len(data) < incl_len:
+                self.truncated = True
+                return
+            packet = self.decode(data, ts_sec + ts_frac * resolution, orig_len, link_type)
+            if packet is not None:
+                yield packet
+
+    def readPcapng(self):
+        read = self.file.read
+        endian = "<"
+        interfaces = []
+        while True:
+            block_header = read(8)
+            if len(block_header) < 8:
+                self.truncated = len(block_header) != 0
+                return
+            block_type, block_len = struct.unpack(endian + "II", block_header)
+            if block_len < 12:
+                raise PcapError("\"%s\" contains a corrupt pcapng block" % self.fileName)
+            if block_type == PCAPNG_SHB:
+                #Every section may have a different byte order
+                byte_order = read(4)
+                endian = "<" if struct.unpack("<I", byte_order)[0] == PCAPNG_BYTE_ORDER else ">"
+                block_len = struct.unpack(endian + "I", block_header[4:])[0]
+                body = read(block_len - 12)
+                interfaces = []
+                continue
+
+            body = read(block_len - 8)
+            if len(body) < block_len - 8:
+                self.truncated = True
+                return
+            if block_type == PCAPNG_IDB:
+                link_type = struct.unpack_from(endian + "H", body)[0]
+                interfaces.append((link_type, self.tsResolution(body[8:-4], endian)))
+            elif block_type in (PCAPNG_EPB, PCAPNG_PB):
+                if block_type == PCAPNG_EPB:
+                    if_id, ts_high, ts_low, cap_len, orig_len = struct.unpack_from(endian + "IIIII", body)
+                else:
+                    if_id, _, ts_high, ts_low, cap_len, orig_len = struct.unpack_from(endian + "HHIIII",
+                                                                                      body)
+                link_type, resolution = interfaces[if_id]
+                self.checkLinkType(link_type)
+                packet = self.decode(body[20:20 + cap_len], ((ts_high << 32) | ts_low) * resolution,
+                                     orig_len, link_type)
+                if packet is not None:
+                    yield packet
+            elif block_type == PCAPNG_SPB:
+                #Simple packet blocks carry no timestamp and always belong to the first interface
+                orig_len = struct.unpack_from(endian + "I", body)[0]
+                link_type, _ = interfaces[0]
+                self.checkLinkType(link_type)
+                packet = self.decode(body[4:4 + min(orig_len, len(body) - 8)], 0.0, orig_len, link_type)
+                if packet is not None:
+                    yield packet
+
+    def tsResolution(self, options, endian):
+        offset = 0
+        while offset + 4 <= len(options):
+            code, length = struct.unpack_from(endian + "HH", options, offset)
+            if code == 0:
+                break
+            if code == PCAPNG_IF_TSRESOL and length >= 1:
+                tsresol = options[offset + 4]
+                if tsresol & 0x80:
+                    return 2.0 ** -(tsresol & 0x7F)
+                return 10.0 ** -tsresol
+            offset += 4 + ((length + 3) & ~3)
+        return 1e-6
+
+    def checkLinkType(self, link_type):
+        if link_type not in LINK_HEADER_LEN:
+            raise PcapError("\"%s\" has unsupported link type %s; only Ethernet and Linux cooked"
+                            " captures can be read" % (self.fileName, link_type))
+
+    #Returns None for a frame too short to hold its link-layer header
+    def decode(self, data, time_epoch, length, link_type=LINKTYPE_ETHERNET):
+        self.packetNum += 1
+        offset = LINK_HEADER_LEN[link_type]
+        if len(data) < offset:
+            self.runts += 1
+            return None
+
+        packet = Packet(FrameInfo(time_epoch, length, self.packetNum))
+        if link_type == LINKTYPE_ETHERNET:
+            dst = self.mac(data[0:6])
+            src = self.mac(data[6:12])
+            eth_type = (data[12] << 8) | data[13]
+        elif link_type == LINKTYPE_LINUX_SLL:
+            dst = ""
+            src = self.mac(data[6:6 + min((data[4] << 8) | data[5], 8)])
+            eth_type = (data[14] << 8) | data[15]
+        else:
+            dst = ""
+            src = self.mac(data[12:12 + min(data[11], 8)])
+            eth_type = (data[0] << 8) | data[1]
+
+        while eth_type in ETH_VLAN and len(data) >= offset + 4:
+            eth_type = (data[offset + 2] << 8) | data[offset + 3]
+            offset += 4
+        packet.addLayer(Layer(Constants.Layer.ETH, dst=dst, src=src, type=eth_type))
+
+        if eth_type == ETH_IPV4:
+            self.decodeIPv4(packet, data, offset)
+        elif eth_type == ETH_IPV6:
+            self.decodeIPv6(packet, data, offset)
+
+        return packet
+
+    def decodeIPv4(self, packet, data, offset):
+        if len(data) < offset + 20:
+            return
+        ihl = (data[offset] & 0x0F) * 4
+        total_len = (data[offset + 2] << 8) | data[offset + 3]
+        frag_offset = ((data[offset + 6] & 0x1F) << 8) | data[offset + 7]
+        proto = data[offset + 9]
+        packet.addLayer(Layer(Constants.Layer.IP, src=self.ip(data[offset + 12:offset + 16]),
+                              dst=self.ip(data[offset + 16:offset + 20]), len=total_len, proto=proto))
+
+        #Only the first fragment contains the transport header
+        if frag_offset == 0:
+            end = min(len(data), offset + total_len) if total_len >= ihl else len(data)
+            self.decodeTransport(packet, data[offset + ihl:end], proto)
+
+    def decodeIPv6(self, packet, data, offset):
+        if len(data) < offset + 40:
+            return
+        payload_len = (data[offset + 4] << 8) | data[offset + 5]
+        next_header = data[offset + 6]
+        packet.addLayer(Layer(Constants.Layer.IPV6, src=self.ip(data[offset + 8:offset + 24]),
+                              dst=self.ip(data[offset + 24:offset + 40]), plen=payload_len,
+                              nxt=next_header))
+
+        end = min(len(data), offset + 40 + payload_len)
+        offset += 40
+        while next_header in IPV6_EXT_HEADERS or next_header == IPV6_FRAGMENT:
+            if len(data) < offset + 8:
+                return
+            if next_header == IPV6_FRAGMENT:
+                if ((data[offset + 2] << 8) | data[offset + 3]) & 0xFFF8:
+                    return
+                ext_len = 8
+            else:
+                ext_len = (data[offset + 1] + 1) * 8
+            next_header = data[offset]
+            offset += ext_len
+
+        self.decodeTransport(packet, data[offset:end], next_header)
+
+    def decodeTransport(self, packet, segment, proto):
+        if proto == IP_PROTO_TCP and len(segment) >= 20:
+            data_offset = (segment[12] >> 4) * 4
+            packet.payload = segment[data_offset:]
+            packet.addLayer(Layer(Constants.Layer.TCP, srcport=(segment[0] << 8) | segment[1],
+                                  dstport=(segment[2] << 8) | segment[3],
+                                  len=len(packet.payload),
+                                  flags=((segment[12] & 0x01) << 8) | segment[13]))
+        elif proto == IP_PROTO_UDP and len(segment) >= 8:
+            packet.payload = segment[8:]
+            packet.addLayer(Layer(Constants.Layer.UDP, srcport=(segment[0] << 8) | segment[1],
+                                  dstport=(segment[2] << 8) | segment[3],
+                                  length=(segment[4] << 8) | segment[5]))
+
+    #MAC and IP strings repeat for nearly every packet, so the formatted values
+    #are cached and interned; they end up as the address keys in Stats
+    def mac(self, raw):
+        try:
+            return self.macCache[raw]
+        except KeyError:
+            mac = self.macCache[raw] = sys.intern(":".join("%02x" % b for b in raw))
+            return mac
+
+    def ip(self, raw):
+        try:
+            return self.ipCache[raw]
+        except KeyError:
+            family = socket.AF_INET if len(raw) == 4 else socket.AF_INET6
+            ip = self.ipCache[raw] = sys.intern(socket.inet_ntop(family, raw))
+            return ip
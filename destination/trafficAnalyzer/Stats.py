@@ -1,5 +1,12 @@
-import numpy as np
-from . import Constants
+import tempfile
+from array import array
+
+from . import Constants, Utils
+
+np = Utils.LazyModule("numpy")
+
+#Values of a SpillArray kept in memory before they are written to its file
+SPILL_CHUNK = 65536
 
 
 class Stats(object):
@@ -20,21 +27,48 @@ class Stats(object):
             print("{}: {}".format(key, val))
 
 
+'''
+The per packet values are kept in typed arrays instead of lists of Python
+objects, which keeps long captures small in memory. getColumn returns them
+as NumPy arrays sharing the same memory. Depending on node.series, the
+arrays are instead spilled to disk as they grow (Constants.Series.DISK) or
+not kept at all (Constants.Series.NONE), in which case only the per
+address counts used by DomainExport are kept. If node.window is set, the
+packets and bytes per address are also counted per window of that many
+seconds, keyed by (window start, address).
+'''
 class StatsData(object):
+    __slots__ = ["node", "layerName", "direction", "packets", "packetTS", "packetDiff", "packetSize",
+                 "addrpcktnum", "addrpcktsize", "srcPort", "destPort", "flags", "options",
+                 "layerFields", "lastTS", "window", "windowpcktnum", "windowpcktsize"]
+
+    COLUMNS = {"packetTS": "float64", "packetDiff": "float64", "packetSize": "int64"}
+
     def __init__(self, node, layer_name, direction):
         self.node = node
         self.layerName = layer_name
         self.direction = direction
         self.packets = []
-        self.packetTS = []
-        self.packetDiff = []
-        self.packetSize = []
+        self.packetTS = self.packetDiff = self.packetSize = None
+        if node.series == Constants.Series.MEMORY:
+            self.packetTS = array("d")
+            self.packetDiff = array("d")
+            self.packetSize = array("q")
+        elif node.series == Constants.Series.DISK:
+            self.packetTS = SpillArray("d")
+            self.packetDiff = SpillArray("d")
+            self.packetSize = SpillArray("q")
+        self.lastTS = None
+        self.window = node.window
+        self.windowpcktnum = {}
+        self.windowpcktsize = {}
         self.addrpcktnum = {}
         self.addrpcktsize = {}
         self.srcPort = {}
         self.destPort = {}
         self.flags = []
         self.options = []
+        self.layerFields = None
 
     def increaseCount(self, _dict, key, val = 1):
         if key not in _dict:
@@ -45,31 +79,68 @@ class StatsData(object):
     def processLayer(self, packet, layer):
         """ Currently it is not needed to store all packets """
         #self.packets.append(layer)
-        time = float(packet.frame_info.time_epoch) - self.node.baseTS
-        self.packetTS.append(time)
-        try:
-            self.packetDiff.append(time - self.packetTS[-2])
-        except IndexError:
+        #A StatsData only sees one layer, so which fields it has is worked out once
+        if self.layerFields is None:
+            self.layerFields = self.getLayerFields(layer)
+        length_field, has_port, has_flags, has_options = self.layerFields
+
+        addr = packet.addr.key
+        self.increaseCount(self.addrpcktnum, addr)
+        self.increaseCount(self.addrpcktsize, addr, packet.length)
+    
+        if has_port:
+            self.increaseCount(self.srcPort, layer.srcport)
+            self.increaseCount(self.destPort, layer.dstport)
+
+        epoch = float(packet.frame_info.time_epoch)
+        if self.window:
+            key = (epoch // self.window * self.window, addr)
+            self.increaseCount(self.windowpcktnum, key)
+            self.increaseCount(self.windowpcktsize, key, packet.length)
+
+        if self.packetTS is None:
+            return
+
+        time = epoch - self.node.baseTS
+        if self.lastTS is not None:
+            self.packetDiff.append(time - self.lastTS)
+        else:
             self.packetDiff.append(0)
+        self.packetTS.append(time)
+        self.lastTS = time
   
-        length = self.getDataLength(layer)
-        if length >= 0:
-            self.packetSize.append(length)
+        if length_field is not None:
+            self.packetSize.append(self.toInt(getattr(layer, length_field)))
         else:
             self.packetSize.append(packet.length)
     
-        self.increaseCount(self.addrpcktnum, packet.addr.getAddr())
-        self.increaseCount(self.addrpcktsize, packet.addr.getAddr(), packet.length)
-    
-        if self.layerHasPort(layer):
-            self.increaseCount(self.srcPort, layer.srcport)
-            self.increaseCount(self.destPort, layer.dstport)
-    
-        if 'flags' in layer.field_names:
+        if has_flags:
             self.flags.append(layer.flags)
-        if 'options' in layer.field_names:
+        if has_options:
             self.options.append(layer.options)
 
+    def getLayerFields(self, layer):
+        field_names = set(layer.field_names)
+        length_field = None
+        for field in ['len', 'data_len', 'length']:
+            if field in field_names:
+                length_field = field
+                break
+
+        return (length_field, self.layerHasPort(layer), 'flags' in field_names,
+                'options' in field_names)
+
+    def getColumn(self, name):
+        column = getattr(self, name)
+        if column is None:
+            return np.zeros(0, dtype=self.COLUMNS[name])
+        if isinstance(column, SpillArray):
+            return column.toNumPy(self.COLUMNS[name])
+        return np.frombuffer(column, dtype=self.COLUMNS[name])
+
+    def getColumns(self):
+        return {name: self.getColumn(name) for name in self.COLUMNS}
+
     def getOtherAddr(self, layer):
         try:
             if self.direction == Constants.Direction.SND:
@@ -84,42 +155,101 @@ class StatsData(object):
         return False
 
     def getDataLength(self, layer):
-        intersect = list(set(layer.field_names) & {'len', 'data_len', 'length'})
-        if len(intersect) == 1:
-            return int(getattr(layer, intersect[0]), 0)
-        elif len(intersect) > 1:
-            #print("intersect:",intersect, layer.field_names, layer.layer_name)
-            return int(getattr(layer, intersect[0]), 0)
-        else:
+        length_field = self.getLayerFields(layer)[0]
+        if length_field is None:
             return -1
+        return self.toInt(getattr(layer, length_field))
+
+    def toInt(self, val):
+        #PcapReader layers hold ints, pyshark layers hold strings
+        if isinstance(val, int):
+            return val
+        return int(val, 0)
 
     def __str__(self):
         return "addr: {}".format(self.srcPort)
 
 
+'''
+Append-only typed array whose values are written to an unnamed temporary
+file every SPILL_CHUNK values, so only the last chunk is in memory. The
+file is created on the first write, in the directory given by TMPDIR, and
+is deleted when the array is.
+'''
+class SpillArray(object):
+    __slots__ = ["typecode", "buffer", "file", "length"]
+
+    def __init__(self, typecode):
+        self.typecode = typecode
+        self.buffer = array(typecode)
+        self.file = None
+        self.length = 0
+
+    def __len__(self):
+        return self.length
+
+    def append(self, val):
+        self.buffer.append(val)
+        self.length += 1
+        if len(self.buffer) >= SPILL_CHUNK:
+            self.flush()
+
+    def flush(self):
+        if len(self.buffer) == 0:
+            return
+        if self.file is None:
+            self.file = tempfile.TemporaryFile(prefix="stats_")
+        self.buffer.tofile(self.file)
+        self.file.flush()
+        self.buffer = array(self.typecode)
+
+    #Returns the values as a read-only array memory-mapping the file
+    def toNumPy(self, dtype):
+        self.flush()
+        if self.length == 0:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(self.file, dtype=dtype, mode="r", shape=(self.length,))
+
+
 class StatsMerge(object):
     def __init__(self):
         pass
 
+    '''
+    Aligns the series y1_list (all over x1) and y2 (over x2) on the sorted
+    concatenation of x1 and x2. Each series takes its value at every x, the
+    last one if x occurs several times in the series, or 0 if it does not
+    have x. The alignment is done with NumPy: each series is reduced to its
+    sorted unique x values and looked up with searchsorted.
+    '''
     def mergeStats(self, x1, x2, y1_list, y2):
-        y_dict_list = []
-        y_list = [[] for i in range(len(y1_list)+1)]
+        x1 = np.asarray(x1)
+        x2 = np.asarray(x2)
+        x = np.sort(np.concatenate((x1, x2)), kind="stable")
 
-        for y1 in y1_list:
-            y_dict_list.append(dict(zip(x1, y1)))
-
-        y_dict_list.append(dict(zip(x2, y2)))
-        x = sorted(x1 + x2)
-    
-        for xVal in x:
-            for i, yDict in enumerate(y_dict_list):
-                if xVal in yDict:
-                    y_list[i].append(yDict[xVal])
-                else:
-                    y_list[i].append(0)
+        unique_x1, last_y1_list = self.lastValues(x1, y1_list)
+        y_list = [self.alignValues(x, unique_x1, y1) for y1 in last_y1_list]
+        unique_x2, (last_y2,) = self.lastValues(x2, [y2])
+        y_list.append(self.alignValues(x, unique_x2, last_y2))
 
         return x, y_list
 
+    #Returns the sorted unique values of x and, for each series, its last
+    #value at each of them
+    def lastValues(self, x, y_list):
+        order = np.argsort(x, kind="stable")
+        sorted_x = x[order]
+        last = np.ones(len(sorted_x), dtype=bool)
+        last[:-1] = sorted_x[1:] != sorted_x[:-1]
+        return sorted_x[last], [np.asarray(y)[order][last] for y in y_list]
+
+    #Returns the values of the series at each of x, or 0 where it has no value
+    def alignValues(self, x, unique_x, y):
+        if len(unique_x) == 0:
+            return np.zeros(len(x), dtype=y.dtype)
+        idx = np.minimum(np.searchsorted(unique_x, x), len(unique_x) - 1)
+        return np.where(unique_x[idx] == x, y[idx], 0)
+
     def cumSumList(self, y_list):
         y_listNew = []
     
@@ -128,6 +258,34 @@ class StatsMerge(object):
     
         return y_listNew
 
+    '''
+    Decimates a series for plotting: x is split into buckets ranges of equal
+    width (e.g. one per pixel) and only the points with the lowest and the
+    highest y of each range are kept, in their original order, so the
+    plotted shape and extremes are preserved.
+    '''
+    def minMaxValues(self, x, y, buckets):
+        x = np.asarray(x)
+        y = np.asarray(y)
+        if len(x) <= 2 * buckets:
+            return x, y
+
+        low, high = x.min(), x.max()
+        if high > low:
+            bucket = np.minimum(((x - low) / (high - low) * buckets).astype("int64"), buckets - 1)
+        else:
+            bucket = np.zeros(len(x), dtype="int64")
+
+        #Sort by bucket, then by y; the first and last point of each bucket are kept
+        order = np.lexsort((y, bucket))
+        sorted_bucket = bucket[order]
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = sorted_bucket[1:] != sorted_bucket[:-1]
+        last = np.ones(len(order), dtype=bool)
+        last[:-1] = first[1:]
+        keep = np.sort(order[first | last])
+        return x[keep], y[keep]
+
     def mergeValues(self, val_list, merge_val):
         return np.add.reduceat(val_list, np.arange(0, len(val_list), merge_val))
 
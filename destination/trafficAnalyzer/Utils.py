@@ -1,13 +1,163 @@
-import datetime
-import psutil
+import importlib
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
 
-debug = False 
 
-def sysUsage(info="Usage"):
-    cpu_perc = psutil.cpu_percent()
-    # you can convert that object to a dictionary 
-    mem = dict(psutil.virtual_memory()._asdict())
+'''
+Stands in for a module that is only imported the first time one of its
+attributes is used, so the heavy dependencies are not loaded by analyses
+that do not need them (e.g. matplotlib without plots, mysql without RIPE).
+The modules in imports, by default only name itself, are imported before
+the attributes of name are looked up, so submodules can be reached as
+attributes of their package.
+'''
+class LazyModule(object):
+    def __init__(self, name, imports=None):
+        self._name = name
+        self._imports = imports if imports is not None else [name]
+        self._module = None
 
-    if debug:
-        print("{}: Time: {} CPU: {} Mem: {}".format(info, datetime.datetime.now(), cpu_perc, mem))
+    def __getattr__(self, attr):
+        return getattr(self.importNow(), attr)
 
+    def importNow(self):
+        if self._module is None:
+            for name in self._imports:
+                importlib.import_module(name)
+            self._module = importlib.import_module(self._name)
+        return self._module
+
+
+'''
+Timing of one stage of the analysis of a pcap file by one worker: its wall
+time, CPU time, the packets it handled and the peak RSS of the worker when
+it ended. A span is timed with "with timing.span(...)" or, if the stage runs
+in pieces, by calling start() and stop() around each piece, or add() with
+times measured by the caller, and end() once.
+'''
+class Span(object):
+    def __init__(self, timing, stage, worker, pcap_file):
+        self.timing = timing
+        self.stage = stage
+        self.worker = worker
+        self.pcapFile = pcap_file
+        self.begin = None
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.packets = 0
+        self.wallStart = 0.0
+        self.cpuStart = 0.0
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+        if exc_type is None:
+            self.end()
+
+    def start(self):
+        if self.begin is None:
+            self.begin = time.time()
+        self.wallStart = time.perf_counter()
+        self.cpuStart = time.process_time()
+
+    def stop(self):
+        self.wall += time.perf_counter() - self.wallStart
+        self.cpu += time.process_time() - self.cpuStart
+
+    #Adds time measured by the caller, for stages run in pieces too small to time one by one
+    def add(self, wall, cpu, begin):
+        if self.begin is None:
+            self.begin = begin
+        self.wall += wall
+        self.cpu += cpu
+
+    def end(self):
+        self.timing.write(self)
+
+    def toDict(self):
+        return {"run": self.timing.run, "worker": self.worker, "pcap": self.pcapFile, "stage": self.stage,
+                "start": self.begin, "wall": self.wall, "cpu": self.cpu, "packets": self.packets,
+                "peak_rss": peakRss()}
+
+
+'''
+Writes the spans of a run as JSON lines, one per span, to file_name. Every
+worker appends to the same file with one write per line, so the lines of
+different workers do not mix. Without a file name, the spans are not
+written and timing is disabled.
+'''
+class Timing(object):
+    def __init__(self, file_name="", run=None):
+        self.fileName = file_name
+        self.enabled = file_name != ""
+        self.run = run if run is not None else "%d-%d" % (time.time(), os.getpid())
+
+    def span(self, stage, worker, pcap_file=""):
+        return Span(self, stage, worker, pcap_file)
+
+    def write(self, span):
+        if not self.enabled:
+            return
+        fd = os.open(self.fileName, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, (json.dumps(span.toDict()) + "\n").encode("utf-8"))
+        finally:
+            os.close(fd)
+
+    #Returns the spans of this run written so far
+    def load(self):
+        spans = []
+        if not self.enabled or not os.path.isfile(self.fileName):
+            return spans
+        with open(self.fileName) as f:
+            for line in f:
+                try:
+                    span = json.loads(line)
+                except ValueError:
+                    continue
+                if span.get("run") == self.run:
+                    spans.append(span)
+        return spans
+
+    #Writes the spans of this run in the Prometheus text format, replacing
+    #prom_file at once so a collector never reads half of it
+    def writePrometheus(self, prom_file):
+        metrics = [("destination_stage_seconds", "Wall time of the stage.", "wall"),
+                   ("destination_stage_cpu_seconds", "CPU time of the stage.", "cpu"),
+                   ("destination_stage_packets", "Packets handled by the stage.", "packets"),
+                   ("destination_stage_peak_rss_bytes", "Peak RSS of the worker at the end of the stage.",
+                    "peak_rss")]
+        spans = self.load()
+        lines = []
+        for name, description, key in metrics:
+            lines.append("# HELP %s %s" % (name, description))
+            lines.append("# TYPE %s gauge" % name)
+            for span in spans:
+                lines.append("%s{run=\"%s\",worker=\"%s\",pcap=\"%s\",stage=\"%s\"} %s"
+                             % (name, promLabel(span["run"]), promLabel(span["worker"]),
+                                promLabel(span["pcap"]), promLabel(span["stage"]), span[key]))
+
+        dirname = os.path.dirname(prom_file) or "."
+        tmp_fd, tmp_file = tempfile.mkstemp(dir=dirname, suffix=".prom")
+        with os.fdopen(tmp_fd, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.chmod(tmp_file, 0o644)
+        os.replace(tmp_file, prom_file)
+
+
+def promLabel(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+#Peak resident set size of the process, in bytes
+def peakRss():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    #Linux reports kilobytes, macOS bytes
+    return rss if sys.platform == "darwin" else rss * 1024
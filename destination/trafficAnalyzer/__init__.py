@@ -1 +1 @@
-__all__ = ["Stats", "Node", "Constants", "IP", "DataPresentation", "DNSTracker", "Device", "Utils"]
+__all__ = ["Stats", "Node", "Constants", "IP", "DataPresentation", "DNSTracker", "Device", "Journal", "Manifest", "PcapReader", "Utils"]